@@ -4,18 +4,14 @@
 
 import argcomplete
 import argparse
+import importlib
 import logging
 import os
 import sys
 import warnings
+from collections import OrderedDict
 
 from icvmapper import __version__
-from icvmapper import gui
-from icvmapper.segment import icvmapper
-from icvmapper.convert import filetype
-from icvmapper.preprocess import biascorr, trim_like
-from icvmapper.qc import seg_qc, reg_svg
-from icvmapper.stats import summary_icv_vols
 from icvmapper.utils.depends_manager import add_paths
 
 warnings.simplefilter("ignore")
@@ -27,102 +23,136 @@ os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
 # --------------
 # functions
+# subcommand modules are imported when the subcommand runs, not when the cli starts
 
 
 def run_filetype(args):
+    from icvmapper.convert import filetype
     filetype.main(args)
 
 
 def run_icvmapper(args):
+    from icvmapper.segment import icvmapper
     icvmapper.main(args)
 
 
 def run_icv_seg_summary(args):
+    from icvmapper.stats import summary_icv_vols
     summary_icv_vols.main(args)
 
 
 def run_seg_qc(args):
+    from icvmapper.qc import seg_qc
     seg_qc.main(args)
 
 def run_reg_svg(args):
+    from icvmapper.qc import reg_svg
     reg_svg.main(args)
 
 def run_utils_biascorr(args):
+    from icvmapper.preprocess import biascorr
     biascorr.main(args)
 
 
 def run_trim_like(args):
+    from icvmapper.preprocess import trim_like
     trim_like.main(args)
 
+
+def run_serve(args):
+    from icvmapper.segment import server
+    server.main(args)
+
+
+def run_watch(args):
+    from icvmapper.segment import watch
+    watch.main(args)
+
+
+def run_plan(args):
+    from icvmapper.segment import plan
+    plan.main(args)
+
+
+def run_local_shards(args):
+    from icvmapper.segment import run_shards
+    run_shards.main(args)
+
+
+def run_merge_shards(args):
+    from icvmapper.segment import merge_shards
+    merge_shards.main(args)
+
+
+def run_freeze_model(args):
+    from icvmapper.deep import freeze
+    freeze.main(args)
+
+
+def run_quantize_model(args):
+    from icvmapper.deep import quantize
+    quantize.main(args)
+
 # --------------
 # parser
 
-
-def get_parser():
+# subcommand: (module defining its parsefn, run function, help, usage override)
+SUBCOMMANDS = OrderedDict([
+    ('seg_icv', ('icvmapper.segment.icvmapper_args', run_icvmapper,
+                 "Segment intracranial volume using a trained CNN", None)),
+    ('seg_qc', ('icvmapper.qc.seg_qc', run_seg_qc,
+                "Create tiled mosaic of segmentation overlaid on structural image", None)),
+    ('reg_svg', ('icvmapper.qc.reg_svg', run_reg_svg, None, None)),
+    ('bias_corr', ('icvmapper.preprocess.biascorr', run_utils_biascorr, "Bias field correct images using N4", None)),
+    ('filetype', ('icvmapper.convert.filetype', run_filetype, "Convert the Analyse format to Nifti", None)),
+    ('stats_icv', ('icvmapper.stats.summary_icv_vols', run_icv_seg_summary,
+                   "Generates volumetric summary of ICV segmentations", None)),
+    ('trim_like', ('icvmapper.preprocess.trim_like', run_trim_like,
+                   "Trim or expand image in same space like reference",
+                   '%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\nTrim or expand image in same space like reference')),
+    ('serve', ('icvmapper.segment.server', run_serve,
+               "Serve seg_icv jobs from a local daemon keeping the models warm", None)),
+    ('watch', ('icvmapper.segment.watch', run_watch, "Watch a dir and segment the scans dropped into it", None)),
+    ('plan', ('icvmapper.segment.plan', run_plan,
+              "Split a cohort into cost-balanced shards and write their array job manifests", None)),
+    ('run_shards', ('icvmapper.segment.run_shards', run_local_shards,
+                    "Run the shards of a plan as local processes, without a scheduler", None)),
+    ('merge_shards', ('icvmapper.segment.merge_shards', run_merge_shards,
+                      "Merge the logs, timings and ICV volumes of the shards of a plan", None)),
+    ('freeze_model', ('icvmapper.deep.freeze', run_freeze_model,
+                      "Export the trained models as frozen, inference only graphs", None)),
+    ('quantize_model', ('icvmapper.deep.quantize', run_quantize_model,
+                        "Calibrate and validate reduced precision (fp16 / int8) model weights", None)),
+])
+
+
+def selected_subcommand(args):
+    """
+    Subcommand named on the command line (or on the line being tab-completed), None if there is none
+    """
+    if '_ARGCOMPLETE' in os.environ:
+        args = os.environ.get('COMP_LINE', '').split()[1:]
+
+    return next((arg for arg in args if arg in SUBCOMMANDS), None)
+
+
+def get_parser(args=None):
+    """
+    cli parser. Only the arguments of the selected subcommand are defined, so only its module is imported
+    :param args: command line arguments, None to define every subcommand
+    """
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
-    # --------------
-
-    # seg intracranial volume  (icv)
-    icv_parser = icvmapper.parsefn()
-    parser_seg_icv = subparsers.add_parser('seg_icv', add_help=False, parents=[icv_parser],
-                                            help="Segment intracranial volume using a trained CNN",
-                                            usage=icv_parser.usage)
-    parser_seg_icv.set_defaults(func=run_icvmapper)
-
-    # --------------
-
-    # seg qc
-    seg_qc_parser = seg_qc.parsefn()
-    parser_seg_qc = subparsers.add_parser('seg_qc', add_help=False, parents=[seg_qc_parser],
-                                          help="Create tiled mosaic of segmentation overlaid on structural image",
-                                          usage=seg_qc_parser.usage)
-    parser_seg_qc.set_defaults(func=run_seg_qc)
-
-    # --------------
-    
-    # reg_svg
-    reg_svg_parser = reg_svg.parsefn()
-    parser_reg_svg = subparsers.add_parser('reg_svg', add_help=False, parents=[reg_svg_parser], usage=reg_svg_parser.usage)
-    parser_reg_svg.set_defaults(func=run_reg_svg)
-
-    # --------------
-
-    # utils biascorr
-    biascorr_parser = biascorr.parsefn()
-    parser_utils_biascorr = subparsers.add_parser('bias_corr', add_help=False, parents=[biascorr_parser],
-                                                  help="Bias field correct images using N4",
-                                                  usage=biascorr_parser.usage)
-    parser_utils_biascorr.set_defaults(func=run_utils_biascorr)
-
-    # --------------
-
-    # filetype
-    filetype_parser = filetype.parsefn()
-    parser_filetype = subparsers.add_parser('filetype', add_help=False, parents=[filetype_parser],
-                                            help="Convert the Analyse format to Nifti",
-                                            usage=filetype_parser.usage)
-    parser_filetype.set_defaults(func=run_filetype)
-
-    # --------------
-
-    # ICV vol seg
-    icv_vol_parser = summary_icv_vols.parsefn()
-    parser_stats_icv = subparsers.add_parser('stats_icv', add_help=False, parents=[icv_vol_parser],
-                                            help="Generates volumetric summary of ICV segmentations",
-                                            usage=icv_vol_parser.usage)
-    parser_stats_icv.set_defaults(func=run_icv_seg_summary)
-
-    # --------------
-
-    # trim like
-    trim_parser = trim_like.parsefn()
-
-    parser_trim_like = subparsers.add_parser('trim_like', help='Trim or expand image in same space like reference',
-                                             add_help=False, parents=[trim_parser],
-                                             usage='%(prog)s -i [ img ] -r [ ref ] -o [ out ] \n\n'
-                                                   'Trim or expand image in same space like reference')
-    parser_trim_like.set_defaults(func=run_trim_like)
+    selected = selected_subcommand(args) if args is not None else None
+
+    for name, (module, func, help_msg, usage) in SUBCOMMANDS.items():
+        if args is None or name == selected:
+            sub_parser = importlib.import_module(module).parsefn()
+            parser_sub = subparsers.add_parser(name, add_help=False, parents=[sub_parser], help=help_msg,
+                                               usage=usage if usage else sub_parser.usage)
+        else:
+            parser_sub = subparsers.add_parser(name, help=help_msg)
+        parser_sub.set_defaults(func=func)
 
     # --------------------
 
@@ -141,7 +171,7 @@ def main(args=None):
     if args is None:
         args = sys.argv[1:]
 
-    parser = get_parser()
+    parser = get_parser(args)
     argcomplete.autocomplete(parser)
     args = parser.parse_args(args)
 
@@ -149,7 +179,10 @@ def main(args=None):
 
         # set filename, file path for the log file
         log_filename = args.func.__name__.split('run_')[1]
-        if hasattr(args, 'subj'):
+        if getattr(args, 'subjects', None):
+            log_filepath = os.path.join(os.getcwd(), 'logs', '{}.log'.format(log_filename))
+
+        elif hasattr(args, 'subj'):
             if args.subj:
                 log_filepath = os.path.join(args.subj, 'logs', '{}.log'.format(log_filename))
 
@@ -166,6 +199,7 @@ def main(args=None):
 
         # log keeps console output and redirects to file
         root = logging.getLogger('interface')
+        root.setLevel(logging.INFO)
         formatter = logging.Formatter('%(asctime)s %(levelname)-8s %(message)s')
         handler = logging.FileHandler(filename=log_filepath)
         handler.setFormatter(formatter)
@@ -175,6 +209,7 @@ def main(args=None):
             args.func(args)
 
     else:
+        from icvmapper import gui
         gui.main()
 
 
@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import resource
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from icvmapper.utils import endstatement
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s [ -m models_dir ] \n\n"
+                                           "Export the trained models as frozen, inference only graphs")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-m', '--models_dir', type=str, metavar='', default=None,
+                          help="dir of the released models (default: icvmapper models dir)")
+    optional.add_argument('-j', '--json', type=str, metavar='', default=None,
+                          help="export a single model: architecture (json)")
+    optional.add_argument('-w', '--weights', type=str, metavar='', default=None,
+                          help="export a single model: weights (h5)")
+    optional.add_argument('-b', '--bench', type=int, metavar='', default=0,
+                          help="forward passes timed per model for the keras and frozen backends, 0 to skip "
+                               "(default: %(default)s)")
+    optional.add_argument('-x', '--xla', action='store_true',
+                          help="also benchmark the frozen graphs with XLA JIT")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    models_dir = args.models_dir if args.models_dir else os.path.join(Path(os.path.realpath(__file__)).parents[2],
+                                                                      'models')
+    if (args.json is None) != (args.weights is None):
+        parser.error("json (-j) and weights (-w) must be given together")
+
+    return models_dir, args.json, args.weights, args.bench, args.xla
+
+
+def model_pairs(models_dir):
+    """
+    (architecture, weights) pairs of the released models
+    """
+    pairs = []
+    for model_weights in sorted(glob.glob(os.path.join(models_dir, '*_model_weights.h5'))):
+        model_json = model_weights.replace('_model_weights.h5', '_model.json')
+        if os.path.basename(model_weights) == 'cereb_model_weights.h5':
+            # the cerebellum weights go with the full multi-modal architecture
+            model_json = os.path.join(models_dir, 'hfb_t1flt2_mcdp_contrast_model.json')
+        if os.path.exists(model_json):
+            pairs.append((model_json, model_weights))
+
+    return pairs
+
+
+def export_frozen(model_json, model_weights):
+    """
+    Fold the variables of a model into constants and keep only the inference graph of the full model and, when
+    it has one, of its deterministic prefix and stochastic suffix (see predict.split_stochastic). Dropout layers
+    are kept, the learning phase placeholder (if any) stays switchable.
+    :return: frozen graph file
+    """
+    import tensorflow as tf
+    from keras import backend as K
+    from icvmapper.deep.predict import clear_model_cache, get_model, split_stochastic, frozen_file
+
+    clear_model_cache()
+    model = get_model(model_json, model_weights)
+    parts = {'model': (model.inputs, model.outputs)}
+
+    split = split_stochastic(model)
+    if split is not None:
+        prefix, suffix, prefix_cost = split
+        parts.update(prefix=(prefix.inputs, prefix.outputs), suffix=(suffix.inputs, suffix.outputs))
+
+    spec = {name: {'inputs': [tensor.name for tensor in inputs], 'outputs': [tensor.name for tensor in outputs]}
+            for name, (inputs, outputs) in parts.items()}
+    spec['prefix_cost'] = prefix_cost if split is not None else 0.
+    spec['input_shape'] = list(model.input_shape[1:])
+
+    output_nodes = sorted(set(tensor.op.name for _, outputs in parts.values() for tensor in outputs))
+    input_nodes = sorted(set(tensor.op.name for inputs, _ in parts.values() for tensor in inputs))
+
+    session = K.get_session()
+    graph_def = tf.graph_util.convert_variables_to_constants(session, session.graph.as_graph_def(), output_nodes)
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=output_nodes + input_nodes)
+
+    learning_phase = K.learning_phase()
+    kept = set(node.name for node in graph_def.node)
+    spec['learning_phase'] = learning_phase.name \
+        if isinstance(learning_phase, tf.Tensor) and learning_phase.op.name in kept else None
+
+    out_file = frozen_file(model_weights)
+    with open(out_file, 'wb') as pb_file:
+        pb_file.write(graph_def.SerializeToString())
+    with open('%s.json' % os.path.splitext(out_file)[0], 'w') as spec_file:
+        json.dump(spec, spec_file, indent=2)
+
+    print("\n %s: %s nodes, %.1f MB%s" % (os.path.basename(out_file), len(graph_def.node),
+                                          os.path.getsize(out_file) / 1024. ** 2,
+                                          ", split at the first dropout layer" if split is not None else ""))
+    clear_model_cache()
+
+    return out_file
+
+
+def _bench_worker(model_json, model_weights, backend, xla, runs, results):
+    from icvmapper.deep import predict
+
+    start = time.time()
+    if backend == 'keras':
+        model = predict.get_model(model_json, model_weights)
+        input_shape = model.input_shape[1:]
+    else:
+        frozen = predict.get_frozen_model(model_weights, xla)
+        model = frozen.runner()
+        input_shape = frozen.spec['input_shape']
+    load_time = time.time() - start
+
+    test_data = np.random.rand(1, *input_shape).astype(np.float32)
+    # first call builds (and compiles) the predict function
+    model.predict(test_data, batch_size=1)
+
+    latencies = []
+    for _ in range(runs):
+        start = time.time()
+        model.predict(test_data, batch_size=1)
+        latencies.append(time.time() - start)
+
+    # peak resident memory of the process, in kB on linux
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+    results.put((load_time, float(np.mean(latencies)), float(np.std(latencies)), peak_mb))
+
+
+def benchmark(model_json, model_weights, runs=5, xla=False):
+    """
+    Forward pass latency and peak memory of a model with the keras and frozen backends, each measured in a
+    fresh process
+    """
+    backends = [('keras', False), ('frozen', False)] + ([('frozen', True)] if xla else [])
+    mp = multiprocessing.get_context('spawn')
+    rows = []
+
+    for backend, use_xla in backends:
+        results = mp.Queue()
+        worker = mp.Process(target=_bench_worker, args=(model_json, model_weights, backend, use_xla, runs, results))
+        worker.start()
+
+        result = None
+        while result is None:
+            try:
+                result = results.get(timeout=10)
+            except queue.Empty:
+                if not worker.is_alive():
+                    break
+        worker.join()
+
+        name = backend + ('+xla' if use_xla else '')
+        if result is None:
+            rows.append("%-12s failed (exit code %s)" % (name, worker.exitcode))
+        else:
+            rows.append("%-12s load %6.1f s   forward pass %6.2f +/- %.2f s   peak memory %7.0f MB"
+                        % ((name,) + result))
+
+    report = "%s (%s runs)\n   %s" % (os.path.basename(model_weights), runs, "\n   ".join(rows))
+    print("\n %s" % report)
+    logging.getLogger('interface').info(report)
+
+
+def main(args):
+    parser = parsefn()
+    models_dir, model_json, model_weights, bench, xla = parse_inputs(parser, args)
+
+    start_time = datetime.now()
+
+    pairs = [(model_json, model_weights)] if model_json else model_pairs(models_dir)
+    if not pairs:
+        print("\n no models found in %s" % models_dir)
+        return
+
+    for model_json, model_weights in pairs:
+        print("\n freezing %s" % os.path.basename(model_weights))
+        export_frozen(model_json, model_weights)
+
+    if bench > 0:
+        for model_json, model_weights in pairs:
+            benchmark(model_json, model_weights, runs=bench, xla=xla)
+
+    endstatement.main('Model freezing', '%s' % (datetime.now() - start_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
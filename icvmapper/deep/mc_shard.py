@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+
+class MCAccumulator(object):
+    """
+    Running (Welford) mean and variance of MC Dropout samples in float32, so memory stays
+    constant whatever the number of samples
+    """
+    def __init__(self, shape, track_var=False):
+        self.count = 0
+        self.mean = np.zeros(shape, dtype=np.float32)
+        self.m2 = np.zeros(shape, dtype=np.float32) if track_var else None
+        self._delta = np.empty(shape, dtype=np.float32)
+
+    def update(self, sample):
+        """
+        Add one sample
+        :param sample: (x, y, z) probability array
+        """
+        self.count += 1
+        np.subtract(sample, self.mean, out=self._delta)
+        self.mean += self._delta / self.count
+
+        if self.m2 is not None:
+            self.m2 += self._delta * (sample - self.mean)
+
+    def update_batch(self, samples):
+        """
+        Add a chunk of samples
+        :param samples: (n, x, y, z) probability array
+        """
+        for sample in samples:
+            self.update(sample)
+
+    def merge(self, count, mean, m2=None):
+        """
+        Add the samples of another accumulator (Chan et al. parallel update)
+        :param count: number of samples of the other accumulator
+        :param mean: their mean
+        :param m2: their sum of squared differences to the mean, required if the variance is tracked
+        """
+        if count == 0:
+            return
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * (float(count) / total)
+
+        if self.m2 is not None:
+            self.m2 += m2 + delta ** 2 * (float(self.count) * count / total)
+        self.count = total
+
+    def variance(self):
+        if self.m2 is None:
+            raise RuntimeError("variance was not tracked, create the accumulator with track_var=True")
+        return self.m2 / max(self.count, 1)
+
+    def entropy(self):
+        """
+        Binary entropy (in nats) of the mean probability
+        """
+        p = np.clip(self.mean, 1e-7, 1 - 1e-7)
+        return -(p * np.log(p) + (1 - p) * np.log(1 - p))
+
+
+def shard_sizes(num_mc, workers):
+    """
+    Split MC Dropout samples as evenly as possible across workers
+    :return: list of sample counts, one per worker that gets at least one sample
+    """
+    base, extra = divmod(num_mc, max(1, workers))
+
+    return [n for n in (base + (i < extra) for i in range(max(1, workers))) if n > 0]
+
+
+def worker_threads(workers):
+    """
+    Intra-op thread budget of each worker, the cores split evenly between them
+    """
+    return max(1, (os.cpu_count() or 1) // max(1, workers))
+
+
+def _run_shard(test_file, model_json, model_weights, num_mc, threads, seed, kwargs):
+    from icvmapper.deep import predict
+
+    predict.configure_worker(threads, seed)
+    test_data = np.load(test_file)
+
+    start = time.time()
+    mc_acc = predict.run_mc_dropout(test_data, model_json, model_weights, num_mc, **kwargs)
+
+    return mc_acc.count, mc_acc.mean, mc_acc.m2, time.time() - start
+
+
+def run_mc_sharded(test_data, model_json, model_weights, num_mc, workers, seed=None, threads=None, track_var=False,
+                   **kwargs):
+    """
+    MC Dropout inference with the samples sharded across worker processes, each with its own model, a fixed
+    intra-op thread budget and its own seed. The partial accumulators are merged in worker order, so the result
+    only depends on (seed, workers).
+    :param num_mc: number of samples (fixed, the adaptive stopping rule runs in a single process)
+    :param workers: number of worker processes
+    :param seed: base seed, worker i uses seed + i, None for random dropout masks
+    :param threads: intra-op threads per worker (default: cores / workers)
+    :param kwargs: run_mc_dropout options (mc_batch, split, backend, xla, precision)
+    :return: MCAccumulator holding the mean (and variance) of the drawn samples
+    """
+    shards = shard_sizes(num_mc, workers)
+    threads = threads if threads else worker_threads(len(shards))
+    print("\n sharding %s MC Dropout samples across %s workers (%s) with %s threads each%s"
+          % (num_mc, len(shards), ', '.join(str(n) for n in shards), threads,
+             "" if seed is None else ", seed %s" % seed))
+
+    # the workers read the tensor from disk rather than from a pickled copy per worker
+    tmp_dir = tempfile.mkdtemp(prefix='icvmapper_mc_')
+    test_file = os.path.join(tmp_dir, 'test_data.npy')
+    np.save(test_file, test_data)
+
+    # spawned workers inherit the OpenMP thread budget from the environment
+    omp_threads = os.environ.get('OMP_NUM_THREADS')
+    os.environ['OMP_NUM_THREADS'] = str(threads)
+
+    kwargs.update(track_var=track_var)
+    start = time.time()
+    try:
+        with multiprocessing.get_context('spawn').Pool(len(shards)) as pool:
+            results = pool.starmap(_run_shard, [(test_file, model_json, model_weights, n, threads,
+                                                 None if seed is None else seed + i, kwargs)
+                                                for i, n in enumerate(shards)])
+    finally:
+        if omp_threads is None:
+            os.environ.pop('OMP_NUM_THREADS', None)
+        else:
+            os.environ['OMP_NUM_THREADS'] = omp_threads
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    mc_acc = MCAccumulator(test_data.shape[2:], track_var=track_var)
+    for count, mean, m2, _ in results:
+        mc_acc.merge(count, mean, m2)
+
+    msg = "MC Dropout: %s samples in %.1f sec over %s workers (slowest shard %.1f sec)" \
+          % (mc_acc.count, time.time() - start, len(shards), max(result[3] for result in results))
+    print("\n %s" % msg)
+    logging.getLogger('interface').info(msg)
+
+    return mc_acc
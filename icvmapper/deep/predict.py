@@ -3,11 +3,19 @@
 # coding: utf-8
 
 import os
+import glob
+import json
+import logging
+from collections import OrderedDict
 import nibabel as nib
 import numpy as np
 
-from keras.models import load_model, model_from_json
+import tensorflow as tf
+from keras import backend as K
+from keras.layers import Input
+from keras.models import Model, load_model, model_from_json
 from keras_contrib.layers import InstanceNormalization
+from icvmapper.deep.mc_shard import MCAccumulator
 from icvmapper.deep.metrics import (dice_coefficient, dice_coefficient_loss, dice_coef, dice_coef_loss,
                                       weighted_dice_coefficient_loss, weighted_dice_coefficient)
 import warnings
@@ -17,6 +25,25 @@ warnings.simplefilter("ignore", FutureWarning)
 
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
+# process-wide registry of built models, keyed by (model_json, model_weights, precision)
+_MODEL_CACHE = OrderedDict()
+# deterministic prefix / stochastic suffix split of each registered model (None if it can't be split)
+_SPLIT_CACHE = {}
+
+# frozen graphs of the registered models, keyed by (frozen graph, xla)
+_FROZEN_CACHE = {}
+
+# host copies of the model weights read before forking a worker pool (see cohort.run_pool), keyed by weights file
+_PRELOADED = {}
+
+# intra-op thread budget and graph seed of MC worker processes (see mc_shard), None for the TF defaults
+_INTRA_OP_THREADS = None
+_GRAPH_SEED = None
+
+# layers that draw a new random sample on every forward pass
+STOCHASTIC_LAYERS = ('Dropout', 'SpatialDropout1D', 'SpatialDropout2D', 'SpatialDropout3D',
+                     'GaussianDropout', 'GaussianNoise', 'AlphaDropout')
+
 
 def load_old_model_json(model_json):
     print("\n loading pre-trained model")
@@ -81,16 +108,494 @@ def multi_class_prediction(prediction, affine):
     return prediction_images
 
 
-def run_test_case(test_data, model_json, model_weights, affine,
-                  output_label_map=False, threshold=0.5, labels=None):
+def get_model(model_json, model_weights, precision='fp32'):
+    """
+    Build a model from its json and weights once per process and reuse it on later calls
+    :param model_json: model architecture (json file)
+    :param model_weights: model weights (h5 file)
+    :param precision: fp32, or fp16 / int8 to validate reduced precision weights: they are rounded, then
+                      dequantized, so the model still runs in fp32 (see quantize)
+    :return: keras model
+    """
+    key = (os.path.abspath(model_json), os.path.abspath(model_weights), precision)
+
+    if key in _MODEL_CACHE:
+        _MODEL_CACHE.move_to_end(key)
+        return _MODEL_CACHE[key]
+
     json_file = open(model_json, 'r')
     loaded_model_json = json_file.read()
     json_file.close()
     model = load_old_model_json(loaded_model_json)
 
-    model.load_weights(model_weights)
+    if key[1] in _PRELOADED:
+        set_preloaded_weights(model, *_PRELOADED[key[1]])
+    else:
+        model.load_weights(model_weights)
+
+    if precision != 'fp32':
+        from icvmapper.deep import quantize
+        model.set_weights(quantize.load_quantized(model, model_weights, precision))
+
+    _MODEL_CACHE[key] = model
+
+    return model
+
+
+def preload_weights(models_dir):
+    """
+    Read the weights of every model of a dir into read-only arrays, so the workers forked afterwards share
+    their pages and build their models without reading the h5 files
+    :return: total size of the weights in MB
+    """
+    import h5py
+
+    for model_weights in sorted(glob.glob(os.path.join(models_dir, '*.h5'))):
+        with h5py.File(model_weights, 'r') as weights_file:
+            group = weights_file['model_weights'] if 'model_weights' in weights_file else weights_file
+
+            layers = []
+            for name in group.attrs['layer_names']:
+                layer_group = group[name.decode('utf8') if isinstance(name, bytes) else name]
+                arrays = []
+                for weight_name in layer_group.attrs['weight_names']:
+                    array = np.asarray(layer_group[weight_name])
+                    array.flags.writeable = False
+                    arrays.append(array)
+                if arrays:
+                    layers.append(arrays)
+
+            version, backend = (group.attrs.get(attr) for attr in ('keras_version', 'backend'))
+            _PRELOADED[os.path.abspath(model_weights)] = \
+                (layers, version.decode('utf8') if isinstance(version, bytes) else version,
+                 backend.decode('utf8') if isinstance(backend, bytes) else backend)
+
+    return sum(array.nbytes for layers, _, _ in _PRELOADED.values() for arrays in layers for array in arrays) \
+        / 1024. ** 2
+
+
+def set_preloaded_weights(model, layers, keras_version=None, keras_backend=None):
+    """
+    Set the weights of a model from preloaded arrays, matching layers by position like model.load_weights
+    """
+    from keras.engine.topology import preprocess_weights_for_loading
+
+    model_layers = [layer for layer in model.layers if layer.weights]
+    if len(model_layers) != len(layers):
+        raise ValueError("the preloaded weights have %s layers, the model %s" % (len(layers), len(model_layers)))
+
+    pairs = []
+    for layer, arrays in zip(model_layers, layers):
+        arrays = preprocess_weights_for_loading(layer, list(arrays), keras_version, keras_backend)
+        pairs.extend(zip(layer.weights, arrays))
+    K.batch_set_value(pairs)
+
+
+def cached_models():
+    """
+    List the (model_json, model_weights, precision) keys of the models currently held in the registry
+    """
+    return list(_MODEL_CACHE.keys())
+
+
+def evict_model(model_json, model_weights, precision='fp32'):
+    """
+    Remove one model from the registry
+    :param model_json: model architecture (json file)
+    :param model_weights: model weights (h5 file)
+    :param precision: weights precision
+    :return: True if the model was in the registry
+    """
+    key = (os.path.abspath(model_json), os.path.abspath(model_weights), precision)
+    _SPLIT_CACHE.pop(key, None)
+    return _MODEL_CACHE.pop(key, None) is not None
+
+
+def clear_model_cache():
+    """
+    Drop every model from the registry and release the backend graph so the memory can be reclaimed
+    """
+    _MODEL_CACHE.clear()
+    _SPLIT_CACHE.clear()
+    for frozen in _FROZEN_CACHE.values():
+        frozen.session.close()
+    _FROZEN_CACHE.clear()
+    K.clear_session()
+
+
+def configure_worker(threads=None, seed=None):
+    """
+    Fix the intra-op thread budget and the graph seed of this process, the models are rebuilt on their next use
+    :param threads: intra-op threads, None for the TF default
+    :param seed: graph seed, the dropout masks are then reproducible, None for random ones
+    """
+    global _INTRA_OP_THREADS, _GRAPH_SEED
+    _INTRA_OP_THREADS, _GRAPH_SEED = threads, seed
+
+    clear_model_cache()
+    if seed is not None:
+        tf.set_random_seed(seed)
+    K.set_session(tf.Session(graph=tf.get_default_graph(), config=session_config()))
+
+
+def frozen_file(model_weights):
+    """
+    Frozen graph exported for a model (icvmapper freeze_model), named after its weights
+    """
+    return '%s_frozen.pb' % os.path.splitext(model_weights)[0]
+
+
+def session_config(xla=False):
+    """
+    Session config enabling the grappler graph optimizations, and XLA JIT compilation if asked
+    """
+    from tensorflow.core.protobuf import rewriter_config_pb2
+
+    config = tf.ConfigProto()
+    rewrite = config.graph_options.rewrite_options
+    for option in ['constant_folding', 'arithmetic_optimization', 'dependency_optimization', 'layout_optimizer',
+                   'remapping', 'memory_optimization']:
+        setattr(rewrite, option, rewriter_config_pb2.RewriterConfig.ON)
+
+    if xla:
+        config.graph_options.optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+
+    if _INTRA_OP_THREADS:
+        config.intra_op_parallelism_threads = _INTRA_OP_THREADS
+        config.inter_op_parallelism_threads = 1
+
+    return config
+
+
+class FrozenRunner(object):
+    """
+    One part (model, prefix or suffix) of a frozen graph, with the predict call of a keras model
+    """
+    def __init__(self, frozen, part):
+        self.frozen = frozen
+        graph = frozen.graph
+        self.inputs = [graph.get_tensor_by_name(name) for name in frozen.spec[part]['inputs']]
+        self.outputs = [graph.get_tensor_by_name(name) for name in frozen.spec[part]['outputs']]
+
+    def predict(self, x, batch_size=None):
+        x = x if isinstance(x, list) else [x]
+        feed = dict(zip(self.inputs, x))
+        if self.frozen.learning_phase is not None:
+            # same phase as keras model.predict, dropout built with training=True stays on
+            feed[self.frozen.learning_phase] = self.frozen.phase
+
+        outputs = self.frozen.session.run(self.outputs, feed_dict=feed)
+
+        return outputs if len(outputs) > 1 else outputs[0]
+
+
+class FrozenModel(object):
+    """
+    Frozen inference graph of a model (variables folded to constants), run in its own session with the
+    grappler optimizations and optional XLA JIT
+    """
+    def __init__(self, frozen_pb, xla=False, phase=0):
+        with open('%s.json' % os.path.splitext(frozen_pb)[0], 'r') as spec_file:
+            self.spec = json.load(spec_file)
+
+        graph_def = tf.GraphDef()
+        with open(frozen_pb, 'rb') as pb_file:
+            graph_def.ParseFromString(pb_file.read())
+
+        if _GRAPH_SEED is not None:
+            # the random ops of a frozen graph ignore the graph seed, seed each one with its own stream
+            for i, node in enumerate(graph_def.node):
+                if 'seed2' in node.attr:
+                    node.attr['seed'].i = _GRAPH_SEED
+                    node.attr['seed2'].i = i + 1
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name='')
+
+        self.learning_phase = self.graph.get_tensor_by_name(self.spec['learning_phase']) \
+            if self.spec.get('learning_phase') else None
+        self.phase = phase
+        self.session = tf.Session(graph=self.graph, config=session_config(xla))
+
+    @property
+    def has_split(self):
+        return 'prefix' in self.spec and 'suffix' in self.spec
+
+    def runner(self, part='model'):
+        return FrozenRunner(self, part)
+
+
+def get_frozen_model(model_weights, xla=False):
+    """
+    Load the frozen graph of a model once per process
+    """
+    key = (os.path.abspath(frozen_file(model_weights)), xla)
+
+    if key not in _FROZEN_CACHE:
+        print("\n loading frozen model%s" % (" (XLA JIT)" if xla else ""))
+        _FROZEN_CACHE[key] = FrozenModel(key[0], xla=xla)
+
+    return _FROZEN_CACHE[key]
+
+
+def _inbound_nodes(layer):
+    # keras >= 2.1.3 keeps inbound nodes private
+    nodes = getattr(layer, '_inbound_nodes', None)
+    return nodes if nodes is not None else layer.inbound_nodes
+
+
+def _layer_cost(layer):
+    """
+    Approximate multiply-accumulates of one layer: weights x output voxels for layers with
+    weights, output size for element-wise layers
+    """
+    shape = layer.output_shape[0] if isinstance(layer.output_shape, list) else layer.output_shape
+    size = float(np.prod([d for d in shape[1:] if d is not None]))
+    n_params = layer.count_params()
+
+    if n_params == 0:
+        return size
+
+    channel_axis = -1 if getattr(layer, 'data_format', 'channels_first') == 'channels_last' else 1
+    channels = shape[channel_axis] or 1
+
+    return n_params * size / channels
+
+
+def split_stochastic(model):
+    """
+    Split a model at its stochastic (dropout/noise) layers into a deterministic prefix, run once
+    per subject, and a stochastic suffix, re-run for every MC sample
+    :param model: keras functional model
+    :return: (prefix model, suffix model, fraction of the model cost in the prefix), or None if
+             the model has no deterministic part worth caching
+    """
+    tainted = set()
+    for layer in model.layers:
+        node = _inbound_nodes(layer)[0]
+        if layer.__class__.__name__ in STOCHASTIC_LAYERS or \
+                any(inbound.name in tainted for inbound in node.inbound_layers):
+            tainted.add(layer.name)
+
+    if not tainted or any(len(_inbound_nodes(layer)) > 1 for layer in model.layers):
+        return None
+
+    # deterministic tensors consumed by the stochastic part
+    boundary = []
+    for layer in model.layers:
+        if layer.name in tainted:
+            node = _inbound_nodes(layer)[0]
+            for tensor, inbound in zip(node.input_tensors, node.inbound_layers):
+                if inbound.name not in tainted and not any(tensor is b for b in boundary):
+                    boundary.append(tensor)
+
+    if all(any(tensor is i for i in model.inputs) for tensor in boundary):
+        return None
+
+    prefix = Model(inputs=model.inputs, outputs=boundary)
+
+    # rebuild the stochastic part on new inputs, sharing the layers (and weights) of the model
+    suffix_inputs = [Input(shape=K.int_shape(tensor)[1:]) for tensor in boundary]
+    tensor_map = {id(tensor): new for tensor, new in zip(boundary, suffix_inputs)}
+
+    for layer in model.layers:
+        if layer.name not in tainted:
+            continue
+        node = _inbound_nodes(layer)[0]
+        inputs = [tensor_map[id(tensor)] for tensor in node.input_tensors]
+        outputs = layer(inputs[0] if len(inputs) == 1 else inputs, **(node.arguments or {}))
+        outputs = outputs if isinstance(outputs, list) else [outputs]
+        for tensor, new in zip(node.output_tensors, outputs):
+            tensor_map[id(tensor)] = new
+
+    if not all(id(tensor) in tensor_map for tensor in model.outputs):
+        return None
+
+    suffix = Model(inputs=suffix_inputs, outputs=[tensor_map[id(tensor)] for tensor in model.outputs])
+
+    prefix_cost = sum(_layer_cost(layer) for layer in model.layers if layer.name not in tainted)
+    total_cost = sum(_layer_cost(layer) for layer in model.layers)
+
+    return prefix, suffix, prefix_cost / total_cost
+
+
+def get_split_model(model_json, model_weights, precision='fp32'):
+    """
+    Registry-backed split_stochastic of a model, reporting the compute saved the first time
+    """
+    key = (os.path.abspath(model_json), os.path.abspath(model_weights), precision)
+
+    if key not in _SPLIT_CACHE:
+        split = split_stochastic(get_model(model_json, model_weights, precision))
+        if split is None:
+            print("\n %s: no deterministic prefix to cache" % os.path.basename(model_json))
+        else:
+            print("\n %s: deterministic prefix holds %.1f%% of the model compute, run once per subject "
+                  "instead of once per MC sample" % (os.path.basename(model_json), 100 * split[2]))
+        _SPLIT_CACHE[key] = split
+
+    return _SPLIT_CACHE[key]
+
+
+def get_mc_models(model_json, model_weights, split=True, backend='keras', xla=False, precision='fp32'):
+    """
+    Models of an MC Dropout run
+    :param backend: keras (model rebuilt from json) or frozen (exported frozen graph)
+    :param precision: weights precision, keras backend only
+    :return: (deterministic prefix or None, model run for every sample, fraction of the compute in the prefix)
+    """
+    if backend == 'frozen':
+        frozen = get_frozen_model(model_weights, xla)
+        if split and frozen.has_split:
+            return frozen.runner('prefix'), frozen.runner('suffix'), frozen.spec['prefix_cost']
+        return None, frozen.runner('model'), 0.
+
+    model = get_model(model_json, model_weights, precision)
+    model_split = get_split_model(model_json, model_weights, precision) if split else None
+
+    return model_split if model_split is not None else (None, model, 0.)
+
+
+def build_mc_models(model_json, model_weights, split=True, backend='keras', xla=False, precision='fp32'):
+    """
+    Build the models of an MC Dropout run and their predict functions, so the run adds nothing to the graph
+    while another thread predicts in it (see submit_test_case)
+    """
+    prefix, model, _ = get_mc_models(model_json, model_weights, split, backend, xla, precision)
+
+    if backend != 'frozen':
+        for mc_model in (prefix, model):
+            if mc_model is not None:
+                mc_model._make_predict_function()
+
+
+def predict_mc_samples(test_data, model_json, model_weights, num_mc, mc_batch=1, split=True, backend='keras',
+                       xla=False, precision='fp32'):
+    """
+    Draw Monte Carlo Dropout samples by stacking the input along the batch axis, so every
+    sample in a chunk gets its own dropout mask within a single forward pass
+    :param test_data: input tensor with a batch of one
+    :param model_json: model architecture (json file)
+    :param model_weights: model weights (h5 file)
+    :param num_mc: number of samples
+    :param mc_batch: max number of samples per forward pass (bounds memory)
+    :param split: run the layers before the first dropout layer once and only the rest per sample
+    :param backend: keras or frozen
+    :param xla: XLA JIT compile the frozen graph
+    :param precision: weights precision (fp32, fp16 or int8)
+    :return: generator of (n, x, y, z) probability arrays, one chunk at a time
+    """
+    prefix, model, _ = get_mc_models(model_json, model_weights, split, backend, xla, precision)
+    mc_batch = max(1, int(mc_batch))
+
+    if prefix is not None:
+        features = prefix.predict(test_data, batch_size=1)
+        inputs = features if isinstance(features, list) else [features]
+    else:
+        inputs = [test_data]
+
+    drawn = 0
+    while drawn < num_mc:
+        n = min(mc_batch, num_mc - drawn)
+        batch = [np.repeat(x, n, axis=0) for x in inputs]
+        prediction = model.predict(batch if len(batch) > 1 else batch[0], batch_size=n)
+        drawn += n
+
+        yield prediction[:, 0]
+
+
+def mc_change(prev_mask, mask):
+    """
+    Change between two thresholded running-mean masks
+    :return: fraction of voxels that flipped and relative volume change, both relative to the previous volume
+    """
+    prev_vol = max(int(np.count_nonzero(prev_mask)), 1)
+    flipped = np.count_nonzero(prev_mask != mask) / prev_vol
+    vol_change = abs(int(np.count_nonzero(mask)) - prev_vol) / prev_vol
+
+    return flipped, vol_change
+
+
+def run_mc_dropout(test_data, model_json, model_weights, num_mc, mc_batch=1, track_var=False,
+                   thresh=0.5, mc_tol=1e-3, mc_min=5, mc_max=30, split=True, backend='keras', xla=False,
+                   precision='fp32'):
+    """
+    Monte Carlo Dropout inference into a running accumulator
+    :param num_mc: number of samples, or None to keep sampling until the thresholded mask and its
+                   volume change less than mc_tol for two consecutive checks (at most mc_max samples)
+    :return: MCAccumulator holding the mean (and variance) of the drawn samples
+    """
+    adaptive = num_mc is None
+    mc_acc = MCAccumulator(test_data.shape[2:], track_var=track_var)
+    prev_mask = None
+    stable = 0
+
+    for preds in predict_mc_samples(test_data=test_data, model_json=model_json, model_weights=model_weights,
+                                    num_mc=mc_max if adaptive else num_mc, mc_batch=mc_batch, split=split,
+                                    backend=backend, xla=xla, precision=precision):
+        for pred in preds:
+            print("MC sample # %s" % mc_acc.count)
+            mc_acc.update(pred)
+
+        if adaptive and mc_acc.count >= mc_min:
+            mask = mc_acc.mean > thresh
+            if prev_mask is not None:
+                flipped, vol_change = mc_change(prev_mask, mask)
+                print("\n MC convergence: %.2e voxels flipped, %.2e volume change" % (flipped, vol_change))
+                stable = stable + 1 if (flipped < mc_tol and vol_change < mc_tol) else 0
+            prev_mask = mask
+
+            if stable >= 2:
+                break
+
+    if adaptive:
+        msg = "MC Dropout %s after %s samples (tol %s, max %s)" % \
+              ("converged" if stable >= 2 else "did not converge", mc_acc.count, mc_tol, mc_max)
+        print("\n %s" % msg)
+        logging.getLogger('interface').info(msg)
+
+    prefix, _, prefix_cost = get_mc_models(model_json, model_weights, split, backend, xla, precision)
+    if prefix is not None:
+        print("\n prefix caching saved ~%.1f%% of the model compute over %s samples" %
+              (100 * prefix_cost * (mc_acc.count - 1) / mc_acc.count, mc_acc.count))
+
+    return mc_acc
+
+
+def run_test_case(test_data, model_json, model_weights, affine,
+                  output_label_map=False, threshold=0.5, labels=None, backend='keras', xla=False, precision='fp32'):
+    model = get_frozen_model(model_weights, xla).runner() if backend == 'frozen' else \
+        get_model(model_json, model_weights, precision)
 
     prediction = model.predict(test_data)
 
     return prediction_to_image(prediction, affine, label_map=output_label_map, threshold=threshold,
                                labels=labels)
+
+
+def submit_test_case(executor, test_data, model_json, model_weights, affine, **kwargs):
+    """
+    Run run_test_case in a worker thread, concurrently with the MC Dropout loop of another model on the same
+    input tensor. The model is built and its predict function compiled in the calling thread, the worker runs it
+    in the same graph and session, whose inter-op pool interleaves the ops of both models. Graph construction is
+    not thread safe: build the models the calling thread runs meanwhile first (build_mc_models)
+    :param executor: concurrent.futures executor
+    :return: future of the prediction image
+    """
+    if kwargs.get('backend') == 'frozen':
+        # frozen graphs run in their own session
+        get_frozen_model(model_weights, kwargs.get('xla', False))
+        return executor.submit(run_test_case, test_data, model_json, model_weights, affine, **kwargs)
+
+    model = get_model(model_json, model_weights, kwargs.get('precision', 'fp32'))
+    model._make_predict_function()
+
+    session = K.get_session()
+    graph = session.graph
+
+    def run():
+        with graph.as_default(), session.as_default():
+            return run_test_case(test_data, model_json, model_weights, affine, **kwargs)
+
+    return executor.submit(run)
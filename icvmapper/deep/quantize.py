@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import csv
+import logging
+import os
+import sys
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+import nibabel as nib
+
+from icvmapper.utils import endstatement
+
+os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
+
+PRECISIONS = ('fp32', 'fp16', 'int8')
+
+# int8 clipping candidates: quantile of the absolute weights of each output channel mapped to 127
+CLIP_QUANTILES = (1.0, 0.9999, 0.999)
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -p [ precision ] -c [ calib ] \n\n"
+                                           "Calibrate and validate reduced precision (fp16 / int8) model weights")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-p', '--precision', type=str, metavar='', choices=PRECISIONS[1:], required=True,
+                          help="weights precision: fp16 or int8")
+    required.add_argument('-c', '--calib', type=str, metavar='', nargs='+', required=True,
+                          help="calibration tensors, one per subject: comma separated pre-processed sequences "
+                               "(pred_process_hfb/*_resampled.nii.gz) in the model channel order (t1,flair,t2)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-j', '--json', type=str, metavar='', default=None,
+                          help="model architecture (default: t1-only contrast model)")
+    optional.add_argument('-w', '--weights', type=str, metavar='', default=None,
+                          help="model weights (default: t1-only contrast model)")
+    optional.add_argument('-r', '--ref', type=str, metavar='', nargs='+', default=None,
+                          help="reference tensors for the validation report, same format as --calib "
+                               "(default: calibration tensors)")
+    optional.add_argument('-n', '--num_mc', type=int, metavar='', default=20,
+                          help="MC Dropout samples per validation run (default: %(default)s)")
+    optional.add_argument('-th', '--thresh', type=float, metavar='', default=0.5,
+                          help="threshold of the validation masks (default: %(default)s)")
+    optional.add_argument('-mv', '--max_vol_diff', type=float, metavar='', default=0.1,
+                          help="max accepted ICV volume difference to fp32, in %% (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    models_dir = os.path.join(Path(os.path.realpath(__file__)).parents[2], 'models')
+    if (args.json is None) != (args.weights is None):
+        parser.error("json (-j) and weights (-w) must be given together")
+
+    model_json = args.json if args.json else os.path.join(models_dir, 'hfb_t1only_mcdp_224iso_contrast_model.json')
+    model_weights = args.weights if args.weights else \
+        os.path.join(models_dir, 'hfb_t1only_mcdp_224iso_contrast_model_weights.h5')
+
+    assert os.path.exists(model_json), "%s does not exist ... please download and rerun script" % model_json
+    assert os.path.exists(model_weights), "%s does not exist ... please download and rerun script" % model_weights
+
+    ref = args.ref if args.ref else args.calib
+
+    return model_json, model_weights, args.precision, args.calib, ref, args.num_mc, args.thresh, args.max_vol_diff
+
+
+def quantized_file(model_weights, precision):
+    """
+    Reduced precision weights of a model, named after its weights
+    """
+    return '%s_%s.npz' % (os.path.splitext(model_weights)[0], precision)
+
+
+def quantize_weights(weights, precision, clip=1.0):
+    """
+    Round model weights to a lower precision. int8 is symmetric and per output channel (last axis) for kernels,
+    biases and normalization parameters stay fp32
+    :param weights: list of fp32 arrays (model.get_weights())
+    :param clip: quantile of the absolute weights of each channel mapped to 127 (int8 only)
+    :return: list of (array, scale) tuples, scale None if the array is stored as is
+    """
+    quantized = []
+    for w in weights:
+        if precision == 'fp16':
+            quantized.append((w.astype(np.float16), None))
+        elif precision == 'int8' and w.ndim >= 2:
+            flat = np.abs(w.reshape(-1, w.shape[-1]))
+            absmax = flat.max(axis=0) if clip >= 1.0 else np.quantile(flat, clip, axis=0)
+            scale = (np.maximum(absmax, 1e-12) / 127.).astype(np.float32)
+            quantized.append((np.clip(np.round(w / scale), -127, 127).astype(np.int8), scale))
+        else:
+            quantized.append((w.astype(np.float32), None))
+
+    return quantized
+
+
+def dequantize(quantized):
+    """
+    fp32 weights of quantized arrays
+    """
+    return [w.astype(np.float32) * scale if scale is not None else w.astype(np.float32) for w, scale in quantized]
+
+
+def save_quantized(out_file, quantized, clip, error):
+    arrays = {'clip': np.float32(clip), 'error': np.float32(error)}
+    for i, (w, scale) in enumerate(quantized):
+        arrays['w%s' % i] = w
+        if scale is not None:
+            arrays['scale%s' % i] = scale
+    np.savez(out_file, **arrays)
+
+
+def load_quantized(model, model_weights, precision):
+    """
+    Dequantized weights of a model at a lower precision, from its calibrated file (icvmapper quantize_model) or,
+    if there is none, rounded from the fp32 weights without clipping
+    :param model: model holding the fp32 weights
+    :return: list of fp32 arrays, for model.set_weights
+    """
+    weights = model.get_weights()
+    q_file = quantized_file(model_weights, precision)
+
+    if not os.path.exists(q_file):
+        print("\n %s not found, run 'icvmapper quantize_model' to calibrate it ... rounding the weights to %s"
+              % (q_file, precision))
+        return dequantize(quantize_weights(weights, precision))
+
+    with np.load(q_file) as arrays:
+        stored = len([name for name in arrays.files if name.startswith('w')])
+        if stored != len(weights):
+            raise ValueError("%s holds %s weight arrays, the model of %s has %s ... please rerun "
+                             "'icvmapper quantize_model'" % (q_file, stored, model_weights, len(weights)))
+        quantized = [(arrays['w%s' % i], arrays['scale%s' % i] if 'scale%s' % i in arrays.files else None)
+                     for i in range(len(weights))]
+
+    if any(q.shape != w.shape for (q, _), w in zip(quantized, weights)):
+        raise ValueError("%s does not match the architecture of %s ... please rerun 'icvmapper quantize_model'"
+                         % (q_file, model_weights))
+
+    return dequantize(quantized)
+
+
+def load_tensor(seq_files):
+    """
+    Network input tensor (1, channels, x, y, z) from comma separated pre-processed sequences
+    :return: (tensor, affine)
+    """
+    imgs = [nib.load(seq_file) for seq_file in seq_files.split(',')]
+    test_data = np.stack([img.get_fdata(dtype=np.float32) for img in imgs])[np.newaxis]
+
+    return test_data, imgs[0].affine
+
+
+def _rel_error(ref, approx):
+    return float(np.linalg.norm(approx - ref) / max(np.linalg.norm(ref), 1e-12))
+
+
+def calibrate(model_json, model_weights, precision, calib_tensors):
+    """
+    Pick the int8 clipping that best preserves the model on the calibration tensors, then save the weights.
+    Error is measured on the output of the deterministic prefix (see predict.split_stochastic), the only part that
+    can be compared without MC noise, or on the weights themselves for models without one.
+    :return: quantized weights file
+    """
+    from icvmapper.deep.predict import get_model, get_split_model
+
+    model = get_model(model_json, model_weights)
+    weights = model.get_weights()
+    split = get_split_model(model_json, model_weights)
+
+    refs = None
+    if split is not None:
+        prefix = split[0]
+        refs = [prefix.predict(test_data, batch_size=1) for test_data, _ in calib_tensors]
+
+    best = None
+    for clip in (CLIP_QUANTILES if precision == 'int8' else (1.0,)):
+        quantized = quantize_weights(weights, precision, clip)
+        approx = dequantize(quantized)
+
+        if refs is None:
+            error = np.mean([_rel_error(w, a) for w, a in zip(weights, approx) if w.ndim >= 2])
+        else:
+            model.set_weights(approx)
+            outputs = [prefix.predict(test_data, batch_size=1) for test_data, _ in calib_tensors]
+            error = np.mean([_rel_error(ref, out) for ref, out in zip(refs, outputs)])
+
+        print("\n %s clip %s: relative %s error %.2e" % (precision, clip, 'weights' if refs is None else 'feature',
+                                                           error))
+        if best is None or error < best[2]:
+            best = (quantized, clip, error)
+
+    model.set_weights(weights)
+
+    out_file = quantized_file(model_weights, precision)
+    save_quantized(out_file, *best)
+    print("\n saved %s (clip %s, %.1f MB, %.1f MB in fp32)"
+          % (os.path.basename(out_file), best[1], os.path.getsize(out_file) / 1024. ** 2,
+             sum(w.nbytes for w in weights) / 1024. ** 2))
+
+    return out_file
+
+
+def dice(mask_a, mask_b):
+    total = mask_a.sum() + mask_b.sum()
+    return 2. * np.logical_and(mask_a, mask_b).sum() / total if total > 0 else 1.
+
+
+def validate(model_json, model_weights, precision, ref_tensors, ref_names, num_mc=20, thresh=0.5, max_vol_diff=0.1):
+    """
+    Dice and ICV volume differences of the reduced precision masks to fp32 on reference tensors. A second fp32 run
+    gives the MC Dropout run to run variability for comparison.
+    :param max_vol_diff: max accepted volume difference, in %
+    :return: (validation csv, True if every subject is within max_vol_diff)
+    """
+    from icvmapper.deep.predict import run_mc_dropout
+
+    rows = []
+    for name, (test_data, affine) in zip(ref_names, ref_tensors):
+        vox_vol = abs(np.linalg.det(affine[:3, :3])) / 1000.
+        masks = {}
+        for run, run_precision in (('fp32', 'fp32'), ('fp32_rerun', 'fp32'), (precision, precision)):
+            print("\n %s: %s MC Dropout run" % (name, run))
+            mc_acc = run_mc_dropout(test_data, model_json, model_weights, num_mc, precision=run_precision)
+            masks[run] = mc_acc.mean > thresh
+
+        vol = masks['fp32'].sum() * vox_vol
+        rows.append(dict(subject=name, fp32_vol=vol,
+                         vol=masks[precision].sum() * vox_vol,
+                         vol_diff=100. * abs(float(masks[precision].sum()) - masks['fp32'].sum()) /
+                         max(masks['fp32'].sum(), 1),
+                         dice=dice(masks['fp32'], masks[precision]),
+                         rerun_vol_diff=100. * abs(float(masks['fp32_rerun'].sum()) - masks['fp32'].sum()) /
+                         max(masks['fp32'].sum(), 1),
+                         rerun_dice=dice(masks['fp32'], masks['fp32_rerun'])))
+
+    out_csv = '%s_%s_validation.csv' % (os.path.splitext(model_weights)[0], precision)
+    with open(out_csv, 'w', newline='') as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(rows[0]))
+        writer.writeheader()
+        writer.writerows(rows)
+
+    passed = all(row['vol_diff'] <= max_vol_diff for row in rows)
+    report = "%s %s vs fp32 on %s subjects: dice %.4f (min %.4f), volume diff %.3f%% (max %.3f%%), " \
+             "fp32 rerun volume diff %.3f%% ... %s" \
+             % (os.path.basename(model_weights), precision, len(rows), np.mean([row['dice'] for row in rows]),
+                min(row['dice'] for row in rows), np.mean([row['vol_diff'] for row in rows]),
+                max(row['vol_diff'] for row in rows), np.mean([row['rerun_vol_diff'] for row in rows]),
+                "within" if passed else "ABOVE the %s%% tolerance" % max_vol_diff)
+    print("\n %s\n report saved to %s" % (report, out_csv))
+    logging.getLogger('interface').info(report)
+
+    return out_csv, passed
+
+
+def main(args):
+    parser = parsefn()
+    model_json, model_weights, precision, calib, ref, num_mc, thresh, max_vol_diff = parse_inputs(parser, args)
+
+    start_time = datetime.now()
+
+    print("\n calibrating %s weights of %s on %s tensors" % (precision, os.path.basename(model_weights), len(calib)))
+    calibrate(model_json, model_weights, precision, [load_tensor(seq_files) for seq_files in calib])
+
+    ref_names = [os.path.basename(seq_files.split(',')[0]).split('.')[0] for seq_files in ref]
+    validate(model_json, model_weights, precision, [load_tensor(seq_files) for seq_files in ref], ref_names,
+             num_mc=num_mc, thresh=thresh, max_vol_diff=max_vol_diff)
+
+    endstatement.main('Model quantization', '%s' % (datetime.now() - start_time))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
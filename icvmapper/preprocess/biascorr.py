@@ -42,6 +42,8 @@ def parsefn():
                           help="Threshold for convergence (default: %(default)s)")
     optional.add_argument('-o', '--out_img', type=str, metavar='', default=None,
                           help="output image (default: %(default)s)")
+    optional.add_argument('-nt', '--num_threads', type=int, metavar='', default=None,
+                          help="N4 threads (default: 90%% of the cores)")
 
     # optional.add_argument("-h", "--help", action="help", help="Show this help message and exit")
 
@@ -61,13 +63,14 @@ def parse_inputs(parser, args):
     iters = args.iters
     thresh = args.thresh
     out_img = args.out_img.strip() if args.out_img is not None else None
+    num_threads = args.num_threads
 
-    return in_img, mask_img, shrink, bspline, iters, thresh, out_img
+    return in_img, mask_img, shrink, bspline, iters, thresh, out_img, num_threads
 
 
 def main(args):
     parser = parsefn()
-    [in_img, mask_img, shrink, bspline, iters, thresh, out_img] = parse_inputs(parser, args)
+    [in_img, mask_img, shrink, bspline, iters, thresh, out_img, num_threads] = parse_inputs(parser, args)
 
     if out_img is not None and os.path.exists(out_img):
         print("\n %s already exists" % out_img)
@@ -86,7 +89,7 @@ def main(args):
 
         cpu_load = 0.9
         cpus = multiprocessing.cpu_count()
-        ncpus = int(cpu_load * cpus)
+        ncpus = num_threads if num_threads else max(1, int(cpu_load * cpus))
 
         n4.inputs.num_threads = ncpus
 
@@ -0,0 +1,179 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from icvmapper.preprocess import resampling
+
+# c3d (ITK) orientation codes name the side each axis starts from, nibabel axis codes the side it points to
+_OPPOSITE = {'R': 'L', 'L': 'R', 'A': 'P', 'P': 'A', 'S': 'I', 'I': 'S'}
+
+
+def c3d_to_axcodes(orient_tag):
+    """
+    Convert a c3d orientation code (ex: RPI) to nibabel axis codes (ex: ('L', 'A', 'S'))
+    """
+    return tuple(_OPPOSITE[c] for c in orient_tag.upper())
+
+
+def axcodes_to_c3d(axcodes):
+    """
+    Convert nibabel axis codes (ex: ('R', 'A', 'S')) to a c3d orientation code (ex: LPI)
+    """
+    return ''.join(_OPPOSITE[c] for c in axcodes)
+
+
+def _data(img):
+    return np.asanyarray(img.dataobj)
+
+
+def _vox_to_vox(src_affine, tgt_affine):
+    # maps target voxel coordinates to source voxel coordinates
+    return np.linalg.inv(src_affine).dot(tgt_affine)
+
+
+def _inside(matrix, out_shape, in_shape):
+    """
+    Target voxels mapped within half a voxel of the source image edge (ITK IsInsideBuffer)
+    """
+    grid = np.ogrid[:out_shape[0], :out_shape[1], :out_shape[2]]
+    inside = np.ones(tuple(out_shape), dtype=bool)
+    for ax in range(3):
+        coords = matrix[ax, 0] * grid[0] + matrix[ax, 1] * grid[1] + matrix[ax, 2] * grid[2] + matrix[ax, 3]
+        inside &= (coords >= -0.5) & (coords < in_shape[ax] - 0.5)
+
+    return inside
+
+
+def _transform(data, matrix, out_shape, interp):
+    data = data.astype(np.float32, copy=False)
+    linear, offset = matrix[:3, :3], matrix[:3, 3]
+
+    # axis aligned mappings go through the faster separable path
+    if np.allclose(linear, np.diag(np.diag(linear))):
+        linear = np.diag(linear)
+
+    # like c3d, samples between the outer voxel centres and the image edge take the edge value
+    out = ndimage.affine_transform(data, linear, offset=offset, output_shape=tuple(out_shape),
+                                   order=interp, mode='nearest', prefilter=False)
+    out *= _inside(matrix, out_shape, data.shape)
+
+    return out
+
+
+def trim_img(img, voxels=1):
+    """
+    Crop to the bounding box of the non-zero voxels plus a margin (c3d -trim <voxels>vox), padding with
+    zeros where the margin falls outside the image
+    """
+    data = _data(img)
+    nonzero = np.argwhere(data != 0)
+
+    if nonzero.size == 0:
+        return nib.Nifti1Image(data.astype(np.float32), img.affine)
+
+    lo = nonzero.min(axis=0) - voxels
+    hi = nonzero.max(axis=0) + voxels + 1
+
+    out = np.zeros(hi - lo, dtype=np.float32)
+    src_lo = np.maximum(lo, 0)
+    src_hi = np.minimum(hi, data.shape[:3])
+    dst_lo = src_lo - lo
+    dst_hi = dst_lo + (src_hi - src_lo)
+    out[dst_lo[0]:dst_hi[0], dst_lo[1]:dst_hi[1], dst_lo[2]:dst_hi[2]] = \
+        data[src_lo[0]:src_hi[0], src_lo[1]:src_hi[1], src_lo[2]:src_hi[2]]
+
+    affine = img.affine.copy()
+    affine[:3, 3] = img.affine[:3, :3].dot(lo) + img.affine[:3, 3]
+
+    return nib.Nifti1Image(out, affine)
+
+
+def reslice_like(img, ref_img, interp=0):
+    """
+    Resample an image onto the grid of a reference using the physical space of both (c3d -reslice-identity)
+    """
+    out = resampling.resample_grid(_data(img), img.affine, ref_img.shape[:3], ref_img.affine, interp, edge='clamp')
+    if out is None:
+        out = _transform(_data(img), _vox_to_vox(img.affine, ref_img.affine), ref_img.shape[:3], interp)
+
+    return nib.Nifti1Image(out, ref_img.affine)
+
+
+def resample_affine(affine, in_shape, out_shape):
+    """
+    Affine of an image resampled to a new matrix size covering the same physical extent (c3d -resample)
+    """
+    factors = np.asarray(in_shape[:3], dtype=float) / np.asarray(out_shape[:3], dtype=float)
+
+    scaling = np.eye(4)
+    scaling[:3, :3] = np.diag(factors)
+    # keep the outer corner of the image in place
+    scaling[:3, 3] = 0.5 * (factors - 1)
+
+    return affine.dot(scaling)
+
+
+def resample_shape(img, out_shape, interp=0):
+    """
+    Resample an image to a new matrix size (c3d -resample XxYxZ)
+    """
+    affine = resample_affine(img.affine, img.shape, out_shape)
+    out = resampling.resample_grid(_data(img), img.affine, out_shape, affine, interp, edge='clamp')
+    if out is None:
+        out = _transform(_data(img), _vox_to_vox(img.affine, affine), out_shape, interp)
+
+    return nib.Nifti1Image(out, affine)
+
+
+def orient(img, orient_tag):
+    """
+    Re-orient an image to a c3d orientation code (c3d -orient RPI). The voxels are a permuted/flipped
+    view of the input data, no copy is made
+    """
+    target = nib.orientations.axcodes2ornt(c3d_to_axcodes(orient_tag))
+    transform = nib.orientations.ornt_transform(nib.io_orientation(img.affine), target)
+
+    data = nib.orientations.apply_orientation(_data(img), transform)
+    affine = img.affine.dot(nib.orientations.inv_ornt_aff(transform, img.shape))
+
+    return nib.Nifti1Image(data, affine)
+
+
+def clip_standardize(img, cutoff_percents=5.0, clipped_file=None):
+    """
+    Clip intensities to the [cutoff, 100 - cutoff] percentiles and standardize to zero mean and unit
+    variance in one float32 working copy (fuses the former percentile clipping and standardization passes)
+    :param img: input image
+    :param cutoff_percents: lower percentile to clip (the upper one is 100 - cutoff_percents)
+    :param clipped_file: optionally save the clipped image before standardization (debugging)
+    :return: standardized image
+    """
+    data = np.asanyarray(img.dataobj)
+
+    # both percentiles from a single partition of the data
+    cutoff_low, cutoff_high = np.percentile(data, [cutoff_percents, 100 - cutoff_percents])
+    if np.issubdtype(data.dtype, np.integer):
+        # cutoffs assigned into an integer array are truncated
+        cutoff_low, cutoff_high = data.dtype.type(cutoff_low), data.dtype.type(cutoff_high)
+
+    out = data.astype(np.float32)
+    np.clip(out, cutoff_low, cutoff_high, out=out)
+
+    if clipped_file is not None:
+        nib.save(nib.Nifti1Image(out.astype(data.dtype), img.affine), clipped_file)
+
+    # single pass moments with float64 accumulators, one slab at a time
+    total, total_sq = 0., 0.
+    for slab in out:
+        slab = slab.astype(np.float64).ravel()
+        total += slab.sum()
+        total_sq += slab.dot(slab)
+    mean = total / out.size
+    std = np.sqrt(max(total_sq / out.size - mean ** 2, 0.))
+
+    out -= mean
+    out /= std
+
+    return nib.Nifti1Image(out, img.affine)
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# interpolation tables kept in memory, least recently used first
+_TABLES = OrderedDict()
+_LOCK = threading.Lock()
+MAX_TABLES = 32
+
+# on-disk copy of the tables shared across runs, None to keep them in memory only
+_CACHE_DIR = None
+MAX_DISK_TABLES = 256
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'icvmapper', 'resampling')
+
+
+def set_cache_dir(cache_dir):
+    """
+    Keep a copy of the interpolation tables on disk
+    :param cache_dir: tables dir, None to keep them in memory only
+    """
+    global _CACHE_DIR
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+    _CACHE_DIR = cache_dir
+
+
+def geometry_key(src_shape, src_affine, tgt_shape, tgt_affine, order, edge='constant'):
+    """
+    sha1 of a (source grid, target grid, interpolation order, edge mode)
+    """
+    sha = hashlib.sha1()
+    for shape, affine in ((src_shape, src_affine), (tgt_shape, tgt_affine)):
+        sha.update(np.asarray(shape[:3], dtype=np.int64).tobytes())
+        # + 0. turns -0. into 0.
+        sha.update((np.round(np.asarray(affine, dtype=np.float64), 6) + 0.).tobytes())
+    sha.update(('%s %s' % (order, edge)).encode())
+
+    return sha.hexdigest()
+
+
+def axis_tables(src_shape, src_affine, tgt_shape, tgt_affine, order=1, edge='constant'):
+    """
+    Separable interpolation tables mapping the voxels of a target grid onto a source grid
+    :param order: 0 (nearest) or 1 (linear)
+    :param edge: constant to match scipy.ndimage / nilearn (mode='constant', cval=0): target voxels falling
+                 outside the source voxel centres are zero; clamp to match c3d (ITK): target voxels within half
+                 a voxel of the source edge take the edge value, the ones further out are zero
+    :return: per axis (lower index, upper index, upper weight, valid) tuples, None if the grids are not axis aligned
+    """
+    matrix = np.linalg.inv(src_affine).dot(tgt_affine)
+    linear = matrix[:3, :3]
+    if not np.allclose(linear, np.diag(np.diag(linear))):
+        return None
+
+    tables = []
+    for ax in range(3):
+        size = src_shape[ax]
+        coords = linear[ax, ax] * np.arange(tgt_shape[ax]) + matrix[ax, 3]
+        if edge == 'clamp':
+            valid = ((coords >= -0.5) & (coords < size - 0.5)).astype(np.float32)
+        else:
+            valid = ((coords >= 0) & (coords <= size - 1)).astype(np.float32)
+
+        if order == 0:
+            lower = np.clip(np.floor(coords + 0.5), 0, size - 1).astype(np.intp)
+            tables.append((lower, lower, None, valid))
+        else:
+            lower = np.clip(np.floor(coords), 0, max(size - 2, 0)).astype(np.intp)
+            upper = np.minimum(lower + 1, size - 1)
+            weight = np.clip(coords - lower, 0, 1).astype(np.float32)
+            tables.append((lower, upper, weight, valid))
+
+    return tables
+
+
+def _table_file(key):
+    return os.path.join(_CACHE_DIR, '%s.npz' % key)
+
+
+def _load(key):
+    if _CACHE_DIR is None or not os.path.exists(_table_file(key)):
+        return None
+
+    try:
+        with np.load(_table_file(key)) as tables:
+            loaded = [(tables['lower%s' % ax], tables['upper%s' % ax],
+                       tables['weight%s' % ax] if 'weight%s' % ax in tables.files else None,
+                       tables['valid%s' % ax]) for ax in range(3)]
+    except (OSError, ValueError, KeyError):
+        return None
+    # mark as recently used
+    os.utime(_table_file(key), None)
+
+    return loaded
+
+
+def _save(key, tables):
+    if _CACHE_DIR is None:
+        return
+
+    arrays = {}
+    for ax, (lower, upper, weight, valid) in enumerate(tables):
+        arrays.update({'lower%s' % ax: lower, 'upper%s' % ax: upper, 'valid%s' % ax: valid})
+        if weight is not None:
+            arrays['weight%s' % ax] = weight
+
+    tmp_file = "%s.tmp-%s-%s.npz" % (_table_file(key)[:-4], os.getpid(), threading.get_ident())
+    np.savez(tmp_file, **arrays)
+    os.replace(tmp_file, _table_file(key))
+
+    table_files = [os.path.join(_CACHE_DIR, name) for name in os.listdir(_CACHE_DIR) if '.tmp-' not in name]
+    for table_file in sorted(table_files, key=os.path.getmtime)[:-MAX_DISK_TABLES]:
+        try:
+            os.remove(table_file)
+        except OSError:
+            pass
+
+
+def get_tables(src_shape, src_affine, tgt_shape, tgt_affine, order=1, edge='constant'):
+    """
+    Interpolation tables of a pair of grids, from the in-memory cache, the on-disk cache or computed
+    """
+    key = geometry_key(src_shape, src_affine, tgt_shape, tgt_affine, order, edge)
+
+    with _LOCK:
+        if key in _TABLES:
+            _TABLES.move_to_end(key)
+            return _TABLES[key]
+
+    tables = _load(key)
+    if tables is None:
+        tables = axis_tables(src_shape, src_affine, tgt_shape, tgt_affine, order, edge)
+        if tables is not None:
+            _save(key, tables)
+
+    with _LOCK:
+        _TABLES[key] = tables
+        while len(_TABLES) > MAX_TABLES:
+            _TABLES.popitem(last=False)
+
+    return tables
+
+
+def apply_tables(data, tables):
+    """
+    Resample a volume with separable interpolation tables, one gather and blend per axis
+    :return: float32 volume
+    """
+    out = np.asarray(data, dtype=np.float32)
+
+    # shrinking axes first keeps the intermediate volumes small
+    for ax in sorted(range(3), key=lambda ax: len(tables[ax][0]) / float(out.shape[ax])):
+        lower, upper, weight, valid = tables[ax]
+        shape = [1, 1, 1]
+        shape[ax] = -1
+
+        low = out.take(lower, axis=ax)
+        if weight is not None:
+            high = out.take(upper, axis=ax)
+            high -= low
+            high *= weight.reshape(shape)
+            low += high
+        low *= valid.reshape(shape)
+        out = low
+
+    return out
+
+
+def resample_grid(data, src_affine, tgt_shape, tgt_affine, order=1, edge='constant'):
+    """
+    Resample a volume onto a target grid with cached tables
+    :param edge: constant (scipy.ndimage) or clamp (c3d / ITK), see axis_tables
+    :return: float32 volume, or None if the grids are not axis aligned or the order is above 1
+    """
+    if order not in (0, 1):
+        return None
+
+    tables = get_tables(data.shape, src_affine, tgt_shape, tgt_affine, order, edge)
+    if tables is None:
+        return None
+
+    return apply_tables(data, tables)
+
+
+def cached_tables():
+    """
+    Geometry keys of the tables held in memory
+    """
+    with _LOCK:
+        return list(_TABLES)
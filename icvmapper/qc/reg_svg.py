@@ -7,7 +7,6 @@ import sys
 import numpy as np
 import nibabel as nib
 import svgwrite
-from nilearn.image import new_img_like
 from PIL import Image
 from PIL import ImageFont
 from PIL import ImageDraw 
@@ -146,6 +145,8 @@ def generate_pngs(fixed_file, reg_file, prefix, seg_file, color_scale, minimum,
 
     # generate blank image
     if not(seg_file):
+        # nilearn is only needed here, importing it with the module slowed down the cli
+        from nilearn.image import new_img_like
         seg_file = new_img_like(fixed_img, np.zeros(fixed_img.shape))
 
     # create output dir for intermediate images
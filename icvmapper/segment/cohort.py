@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import glob
+import time
+import queue
+import logging
+import argparse
+import traceback
+import multiprocessing
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import numpy as np
+import pandas as pd
+from termcolor import colored
+from icvmapper.utils.dag import ResourceGraph
+from icvmapper.utils.memory import memory_usage, system_memory
+
+# resources held by each stage of a subject: (cores, memory in GB), and whether it can use more cores
+STAGE_NEEDS = OrderedDict([
+    ('bias', (1, 1.5, True)),
+    ('preprocess', (1, 2., True)),
+    ('predict', (None, None, False)),
+    ('postprocess', (2, 2., False)),
+    ('qc', (1, 0.5, False)),
+])
+
+# batch state inherited by the forked workers of run_pool
+_POOL = {}
+
+
+def read_subjects(subjects):
+    """
+    Read the subjects of a batch run
+    :param subjects: text file with one subject dir per line (optionally followed by a session),
+                     or a glob matching subject dirs
+    :return: list of (subject dir, session) tuples
+    """
+    entries = []
+
+    if os.path.isfile(subjects):
+        with open(subjects, 'r') as subj_file:
+            for line in subj_file:
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                entries.append((fields[0], fields[1] if len(fields) > 1 else None))
+    else:
+        entries = [(subj_dir, None) for subj_dir in sorted(glob.glob(subjects)) if os.path.isdir(subj_dir)]
+
+    return entries
+
+
+def subject_args(args, subj_dir, session=None):
+    """
+    Copy of the batch arguments pointing at a single subject
+    """
+    subj_args = argparse.Namespace(**vars(args))
+    subj_args.subjects = None
+    subj_args.subj = subj_dir
+    subj_args.session = session
+    subj_args.t1w = None
+    subj_args.flair = None
+    subj_args.t2w = None
+    subj_args.out = None
+
+    return subj_args
+
+
+def summary_row(subj_dir, session, status, runtime, error='', **stage_times):
+    row = dict(Subject=os.path.basename(os.path.abspath(subj_dir)), Session=session, Status=status,
+               Runtime_sec=round(runtime, 1))
+    row.update((name, round(sec, 1)) for name, sec in stage_times.items())
+    row['Error'] = error
+
+    return row
+
+
+def write_summary(rows, summary):
+    df = pd.DataFrame(rows)
+    df.to_csv(summary, index=False)
+    print("\n batch summary saved to %s" % summary)
+
+    failed = int((df['Status'] == 'failed').sum())
+    print("\n %s subjects processed, %s failed" % (len(df), failed))
+
+
+def run_batch(args, run_subject):
+    """
+    Segment a list of subjects one after another in the same process, so models are built once and
+    a failing subject does not stop the batch
+    :param args: seg_icv arguments with args.subjects set
+    :param run_subject: function segmenting one subject given its arguments
+    """
+    entries = read_subjects(args.subjects)
+    if not entries:
+        print("\n no subjects found in %s" % args.subjects)
+        return
+
+    rows = []
+    for s, (subj_dir, session) in enumerate(entries):
+        print(colored("\n subject %s/%s: %s" % (s + 1, len(entries), subj_dir), 'green'))
+        start_time = datetime.now()
+
+        try:
+            run_subject(subject_args(args, subj_dir, session))
+            status, error = 'done', ''
+        except (Exception, SystemExit) as err:
+            traceback.print_exc()
+            status, error = 'failed', str(err)
+            print(colored("\n %s failed: %s" % (subj_dir, error), 'red'))
+
+        runtime = (datetime.now() - start_time).total_seconds()
+        rows.append(summary_row(subj_dir, session, status, runtime, error))
+
+    write_summary(rows, args.batch_summary)
+
+
+def run_pipeline(args, setup, preprocess, predict, postprocess):
+    """
+    Segment a list of subjects as a producer/consumer pipeline: a pool of pre-processing workers fills a
+    bounded queue of ready input tensors, a single inference stage consumes it and hands the results to a
+    pool of post-processing workers
+    :param args: seg_icv arguments with args.subjects set
+    :param setup: function returning the context of one subject given its arguments (None to skip it)
+    :param preprocess: pre-processing stage, run in the pre-processing pool
+    :param predict: inference stage, run in the calling thread
+    :param postprocess: post-processing stage, run in the post-processing pool
+    """
+    entries = read_subjects(args.subjects)
+    if not entries:
+        print("\n no subjects found in %s" % args.subjects)
+        return
+
+    ready = queue.Queue(maxsize=max(1, args.queue_depth))
+
+    def pre_stage(s, subj_dir, session):
+        start = time.time()
+        try:
+            ctx = setup(subject_args(args, subj_dir, session))
+            if ctx is not None:
+                preprocess(ctx)
+            error = None
+        except (Exception, SystemExit) as err:
+            traceback.print_exc()
+            ctx, error = None, str(err)
+        # blocks while the queue is full, so pre-processing never runs too far ahead of inference
+        ready.put((s, ctx, error, time.time() - start))
+
+    def post_stage(ctx):
+        start = time.time()
+        postprocess(ctx)
+        return time.time() - start
+
+    rows = [None] * len(entries)
+    stage_times = [dict() for _ in entries]
+    post_futures = {}
+    ready_depths, post_backlog = [], []
+    idle = 0.
+
+    with ThreadPoolExecutor(max_workers=max(1, args.pre_workers)) as pre_pool, \
+            ThreadPoolExecutor(max_workers=max(1, args.post_workers)) as post_pool:
+
+        for s, (subj_dir, session) in enumerate(entries):
+            pre_pool.submit(pre_stage, s, subj_dir, session)
+
+        for _ in entries:
+            wait_start = time.time()
+            s, ctx, error, pre_time = ready.get()
+            idle += time.time() - wait_start
+            ready_depths.append(ready.qsize())
+
+            subj_dir, session = entries[s]
+            stage_times[s]['Preprocess_sec'] = pre_time
+
+            if error is not None:
+                rows[s] = summary_row(subj_dir, session, 'failed', pre_time, error, **stage_times[s])
+                continue
+            if ctx is None:
+                rows[s] = summary_row(subj_dir, session, 'skipped', pre_time, **stage_times[s])
+                continue
+
+            print(colored("\n predicting %s" % subj_dir, 'green'))
+            start = time.time()
+            try:
+                predict(ctx)
+            except Exception as err:
+                traceback.print_exc()
+                stage_times[s]['Inference_sec'] = time.time() - start
+                rows[s] = summary_row(subj_dir, session, 'failed', pre_time + stage_times[s]['Inference_sec'],
+                                      str(err), **stage_times[s])
+                continue
+            stage_times[s]['Inference_sec'] = time.time() - start
+
+            post_futures[s] = post_pool.submit(post_stage, ctx)
+            post_backlog.append(sum(1 for future in post_futures.values() if not future.done()))
+
+        for s, future in post_futures.items():
+            subj_dir, session = entries[s]
+            try:
+                stage_times[s]['Postprocess_sec'] = future.result()
+                status, error = 'done', ''
+            except Exception as err:
+                traceback.print_exc()
+                status, error = 'failed', str(err)
+            rows[s] = summary_row(subj_dir, session, status, sum(stage_times[s].values()), error, **stage_times[s])
+
+    report = "pipeline queues: ready tensors mean %.1f / max %s (depth %s), post-processing backlog max %s, " \
+             "inference idle %.1f sec" % (np.mean(ready_depths), max(ready_depths), args.queue_depth,
+                                         max(post_backlog) if post_backlog else 0, idle)
+    print("\n %s" % report)
+    logging.getLogger('interface').info(report)
+
+    write_summary(rows, args.batch_summary)
+
+
+def _pool_subject(s):
+    args, run_subject, entries = _POOL['args'], _POOL['run_subject'], _POOL['entries']
+    subj_dir, session = entries[s]
+    print(colored("\n subject %s/%s: %s (worker %s)" % (s + 1, len(entries), subj_dir, os.getpid()), 'green'))
+    start_time = datetime.now()
+
+    try:
+        run_subject(subject_args(args, subj_dir, session))
+        status, error = 'done', ''
+    except (Exception, SystemExit) as err:
+        traceback.print_exc()
+        status, error = 'failed', str(err)
+        print(colored("\n %s failed: %s" % (subj_dir, error), 'red'))
+
+    runtime = (datetime.now() - start_time).total_seconds()
+
+    return s, os.getpid(), summary_row(subj_dir, session, status, runtime, error), memory_usage()
+
+
+def run_pool(args, run_subject, preload):
+    """
+    Segment a list of subjects with a pool of forked workers. The parent imports the models' dependencies and
+    reads their weights before forking, so the workers share those pages copy-on-write and only build their
+    own sessions. Reports the resident memory of each worker split into shared and private pages.
+    :param args: seg_icv arguments with args.subjects and args.pool set
+    :param run_subject: function segmenting one subject given its arguments
+    :param preload: function loading the model weights in the parent, returning their size in MB
+    """
+    entries = read_subjects(args.subjects)
+    if not entries:
+        print("\n no subjects found in %s" % args.subjects)
+        return
+
+    print("\n preloaded %.0f MB of model weights, forking %s workers" % (preload(), args.pool))
+    parent_mem = memory_usage()
+
+    _POOL.update(args=args, run_subject=run_subject, entries=entries)
+    rows = [None] * len(entries)
+    worker_mem = {}
+
+    # each worker keeps its models across the subjects it segments
+    with multiprocessing.get_context('fork').Pool(args.pool) as pool:
+        for s, pid, row, mem in pool.imap_unordered(_pool_subject, range(len(entries))):
+            if mem is not None:
+                row.update(RSS_MB=round(mem['rss']), Shared_MB=round(mem['shared']),
+                           Private_MB=round(mem['private']))
+                worker_mem[pid] = mem
+            rows[s] = row
+    _POOL.clear()
+
+    if worker_mem:
+        lines = ["worker %-7s RSS %6.0f MB   shared %6.0f MB   private %6.0f MB" %
+                 (pid, mem['rss'], mem['shared'], mem['private']) for pid, mem in sorted(worker_mem.items())]
+        lines.append("workers footprint (sum of PSS) %.0f MB, parent RSS %.0f MB" %
+                     (sum(mem['pss'] for mem in worker_mem.values()),
+                      parent_mem['rss'] if parent_mem is not None else float('nan')))
+        report = "worker pool memory:\n   %s" % "\n   ".join(lines)
+        print("\n %s" % report)
+        logging.getLogger('interface').info(report)
+
+    write_summary(rows, args.batch_summary)
+
+
+def run_scheduled(args, setup, stages, stats=None):
+    """
+    Segment a list of subjects as one graph of stages (bias correction, pre-processing, inference,
+    post-processing, qc) packed onto a node-wide core and memory budget. Stages further down the pipeline
+    start first, bias correction gets an even share of the free cores and inference runs on a fixed thread
+    budget, one subject at a time.
+    :param args: seg_icv arguments with args.subjects set
+    :param setup: function returning the context of one subject given its arguments (None to skip it)
+    :param stages: dict of stage name (STAGE_NEEDS): function of the subject context
+    :param stats: function summarizing the segmented subject dirs, run once they are all done
+    """
+    from icvmapper.deep import predict
+
+    entries = read_subjects(args.subjects)
+    if not entries:
+        print("\n no subjects found in %s" % args.subjects)
+        return
+
+    cores = args.cores if args.cores else (os.cpu_count() or 1)
+    mem = system_memory()
+    mem_gb = args.mem_gb if args.mem_gb else (0.8 * mem['total'] / 1024. if mem is not None else 16.)
+    inference_threads = min(cores, args.inference_threads if args.inference_threads else max(1, cores // 2))
+
+    # every session built from now on uses the inference thread budget
+    predict.configure_worker(threads=inference_threads)
+
+    graph = ResourceGraph({'cores': cores, 'mem_gb': mem_gb, 'inference': 1})
+    rows = [None] * len(entries)
+    subjects = {}
+
+    for s, (subj_dir, session) in enumerate(entries):
+        try:
+            ctx = setup(subject_args(args, subj_dir, session))
+        except (Exception, SystemExit) as err:
+            traceback.print_exc()
+            rows[s] = summary_row(subj_dir, session, 'failed', 0., str(err))
+            continue
+        if ctx is None:
+            rows[s] = summary_row(subj_dir, session, 'skipped', 0.)
+            continue
+        subjects[s] = ctx
+
+        # inference memory scales with the network input size, args.inference_mem is for 224^3
+        voxels = float(np.prod(ctx['pred_shape'])) / 224 ** 3
+        prev = None
+        for priority, (name, (stage_cores, stage_mem, elastic)) in enumerate(STAGE_NEEDS.items()):
+            needs = {'cores': stage_cores, 'mem_gb': stage_mem}
+            if name == 'preprocess':
+                # the sequences are pre-processed concurrently, the flair and t2 chains start with their own N4
+                needs['cores'] = min(len(ctx['test_seqs']), ctx['mod_workers'], cores)
+                elastic = elastic and ctx['bias'] and len(ctx['test_seqs']) > 1
+            elif name == 'predict':
+                needs = {'cores': inference_threads, 'mem_gb': min(mem_gb, args.inference_mem * voxels),
+                         'inference': 1}
+            graph.add('%s:%s' % (s, name), stages[name], ctx, deps=[prev] if prev else [], needs=needs,
+                      max_cores=cores if elastic else None, priority=priority)
+            prev = '%s:%s' % (s, name)
+
+    print("\n scheduling %s subjects on %s cores, %.1f GB, %s inference threads"
+          % (len(subjects), cores, mem_gb, inference_threads))
+    graph.run()
+
+    stage_names = dict(bias='Bias_sec', preprocess='Preprocess_sec', predict='Inference_sec',
+                       postprocess='Postprocess_sec', qc='QC_sec')
+    for s, ctx in subjects.items():
+        subj_dir, session = entries[s]
+        stage_times = dict((stage_names[name], graph.times.get('%s:%s' % (s, name), 0.)) for name in STAGE_NEEDS)
+        errors = [str(graph.errors[task]) for task in ('%s:%s' % (s, name) for name in STAGE_NEEDS)
+                  if task in graph.errors]
+        row = summary_row(subj_dir, session, 'failed' if errors else 'done', sum(stage_times.values()),
+                          errors[0] if errors else '', **stage_times)
+        row['N4_threads'] = graph.grants.get('%s:bias' % s, {}).get('cores')
+        row['Preprocess_threads'] = graph.grants.get('%s:preprocess' % s, {}).get('cores')
+        rows[s] = row
+
+    report = "scheduler: %s subjects in %.1f sec, %.0f%% of %s cores busy" \
+             % (len(subjects), graph.wall, 100 * graph.utilization(), cores)
+    print("\n %s" % report)
+    logging.getLogger('interface').info(report)
+
+    done = [subjects[s]['subj_dir'] for s, row in enumerate(rows) if row['Status'] == 'done' and s in subjects]
+    if stats is not None and done:
+        stats(done)
+
+    write_summary(rows, args.batch_summary)
@@ -8,17 +8,22 @@ import glob
 from datetime import datetime
 from pathlib import Path
 import argcomplete
-import argparse
 import numpy as np
 import nibabel as nib
 from nilearn.image import reorder_img, resample_img, resample_to_img, largest_connected_component_img, smooth_img, \
     math_img
 from nipype.interfaces.c3 import C3d
 from icvmapper.utils import endstatement
-from icvmapper.deep.predict import run_test_case
-from icvmapper.preprocess import biascorr
+from icvmapper.utils.cache import StageCache, default_cache_dir
+from icvmapper.utils.dag import TaskGraph
+from icvmapper.deep.mc_shard import run_mc_sharded
+from icvmapper.preprocess import biascorr, imgops, resampling
 from icvmapper.qc import seg_qc, reg_svg
+from icvmapper.stats import summary_icv_vols
+from icvmapper.segment import cohort, postproc
+from icvmapper.segment.icvmapper_args import parsefn
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 import warnings
 from termcolor import colored
 
@@ -29,29 +34,6 @@ warnings.simplefilter("ignore", UserWarning)
 os.environ['TF_CPP_MIN_LOG_LEVEL'] = "3"
 
 ###########################################       Functions        #####################################################
-def parsefn():
-    parser = argparse.ArgumentParser(usage='%(prog)s -s [ subj ] \n\n'
-                                     "Brain extraction (skull-striping) using a trained CNN")
-
-    optional = parser.add_argument_group('optional arguments')
-
-    optional.add_argument('-s', '--subj', type=str, metavar='', help="input subject")
-    optional.add_argument('-fl', '--flair', type=str, metavar='', help="input Flair")
-    optional.add_argument('-t1', '--t1w', type=str, metavar='', help="input T1-weighted")
-    optional.add_argument('-t2', '--t2w', type=str, metavar='', help="input T2-weighted")
-    optional.add_argument('-o', '--out', type=str, metavar='', help="output prediction")
-    optional.add_argument('-b', '--bias', help="bias field correct image before segmentation",
-                          action='store_true')
-    optional.add_argument("-rc", "--rmcereb", type=int, metavar='', default=0, help="remove cerebellum")
-    optional.add_argument("-ign_ort", "--ign_ort",  action='store_true',
-                          help="ignore orientation if tag is wrong")
-    optional.add_argument('-f', '--force', help="overwrite existing segmentation", action='store_true')
-    optional.add_argument('-n', '--num_mc', type=int, metavar='', help="number of Monte Carlo Dropout samples", default=20)
-    optional.add_argument('-th', '--thresh', type=float, metavar='', help="threshold", default=0.5)
-    optional.add_argument('-ss', '--session', type=str, metavar='', help="input session for longitudinal studies")
-
-    return parser
-
 def parse_inputs(parser, args):
     if isinstance(args, list):
         args = parser.parse_args(args)
@@ -88,7 +70,24 @@ def parse_inputs(parser, args):
 
     bias = True if args.bias else False
 
-    num_mc = args.num_mc
+    if args.num_mc == 'auto':
+        num_mc = None
+    elif args.num_mc.isdigit() and int(args.num_mc) > 0:
+        num_mc = int(args.num_mc)
+    else:
+        sys.exit("num_mc (-n) must be a positive integer or 'auto'")
+
+    mc_tol = args.mc_tol
+
+    mc_max = args.mc_max
+
+    mc_batch = args.mc_batch
+
+    mc_workers = max(1, args.mc_workers)
+
+    seed = args.seed
+
+    uncert = True if args.uncert else False
 
     thresh = args.thresh
 
@@ -96,40 +95,47 @@ def parse_inputs(parser, args):
 
     force = True if args.force else False
 
-    return subj_dir, subj, t1, fl, t2, woc, out, bias, num_mc, thresh, ign_ort, force
+    engine = args.engine
 
-def orient_img(in_img_file, orient_tag, out_img_file):
-    c3 = C3d()
-    c3.inputs.in_file = in_img_file
-    c3.inputs.args = "-orient %s" % orient_tag
-    c3.inputs.out_file = out_img_file
-    c3.run()
+    debug = True if args.debug else False
+
+    use_cache = False if args.no_cache else True
+
+    cache_dir = args.cache_dir
+
+    cache_size = args.cache_size
+
+    resample_mode = args.resample_mode
+
+    mod_workers = args.mod_workers
+
+    backend = args.backend
+
+    xla = True if args.xla else False
+
+    return subj_dir, subj, t1, fl, t2, woc, out, bias, num_mc, mc_tol, mc_max, mc_batch, uncert, thresh, ign_ort, force, engine, debug, \
+        use_cache, cache_dir, cache_size, resample_mode, mod_workers, backend, xla, mc_workers, seed
 
 def check_orient(in_img_file, r_orient, l_orient, out_img_file):
     """
-    Check image orientation and re-orient if not in standard orientation (RPI or LPI)
+    Check image orientation from the nifti header and re-orient if not in standard orientation (RPI or LPI)
     :param in_img_file: input_image
     :param r_orient: right ras orientation
     :param l_orient: left las orientation
     :param out_img_file: output oriented image
     """
-    res = subprocess.run('c3d %s -info' % in_img_file, shell=True, stdout=subprocess.PIPE)
-    out = res.stdout.decode('utf-8')
-    ort_str = out.find('orient =') + 9
-    img_ort = out[ort_str:ort_str + 3]
+    # only the header is read, oblique images get the closest orientation
+    in_img = nib.load(in_img_file)
+    img_ort = imgops.axcodes_to_c3d(nib.aff2axcodes(in_img.affine))
 
     cp_orient = False
     if (img_ort != r_orient) and (img_ort != l_orient):
         print("\n Warning: input image is not in RPI or LPI orientation.. "
               "\n re-orienting image to standard orientation based on orient tags (please make sure they are correct)")
 
-        if img_ort == 'Obl':
-            img_ort = out[-5:-2]
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
-        else:
-            orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
+        orient_tag = 'RPI' if 'R' in img_ort else 'LPI'
         print(orient_tag)
-        orient_img(in_img_file, orient_tag, out_img_file)
+        nib.save(imgops.orient(in_img, orient_tag), out_img_file)
         cp_orient = True
     return cp_orient
 
@@ -144,72 +150,165 @@ def check_orient(in_img_file, r_orient, l_orient, out_img_file):
 #
 #     return resample_img(ras_image, target_affine=new_affine, target_shape=output_shape, interpolation=interpolation)
 
-def cutoff_img(in_file, cutoff_percents, out_file):
-    print("\n thresholding ...")
-    img = nib.load(in_file)
-    data = img.get_data()
-    cutoff_low = np.percentile(data, cutoff_percents)
-    cutoff_high = np.percentile(data, 100-cutoff_percents)
-    new_data = data.copy()
-    new_data[new_data > cutoff_high] = cutoff_high
-    new_data[new_data < cutoff_low] = cutoff_low
-    nib.save(nib.Nifti1Image(new_data, img.affine), out_file)
-
-def normalize_sample_wise_img(in_file, out_file):
-    image = nib.load(in_file)
-    img = image.get_data()
-    # standardize intensity for data
-    print("\n standardizing ...")
-    std_img = (img - img.mean()) / img.std()
-    nib.save(nib.Nifti1Image(std_img, image.affine), out_file)
-
-def resample(img, x, y, z, out, interp=0):
+def resample(img, x, y, z, out, interp=0, engine='c3d'):
     print("\n resmapling ...")
+    if engine == 'numpy':
+        nib.save(imgops.resample_shape(nib.load(img), [x, y, z], interp=interp), out)
+        return
+
     c3 = C3d()
     c3.inputs.in_file = img
     c3.inputs.args = "-int %s -resample %sx%sx%s" % (interp, x, y, z)
     c3.inputs.out_file = out
     c3.run()
 
-def trim(in_img_file, out_img_file, voxels=1):
+def trim(in_img_file, out_img_file, voxels=1, engine='c3d'):
     print("\n cropping ...")
+    if engine == 'numpy':
+        nib.save(imgops.trim_img(nib.load(in_img_file), voxels=voxels), out_img_file)
+        return
+
     c3 = C3d()
     c3.inputs.in_file = in_img_file
     c3.inputs.args = "-trim %svox" % voxels
     c3.inputs.out_file = out_img_file
     c3.run()
 
-def trim_like(in_img_file, ref_img_file, out_img_file, interp = 0):
+def trim_like(in_img_file, ref_img_file, out_img_file, interp=0, engine='c3d'):
     print("\n cropping ...")
+    if engine == 'numpy':
+        nib.save(imgops.reslice_like(nib.load(in_img_file), nib.load(ref_img_file), interp=interp), out_img_file)
+        return
+
     c3 = C3d()
     c3.inputs.in_file = ref_img_file
     c3.inputs.args = "-int %s %s -reslice-identity" % (interp, in_img_file)
     c3.inputs.out_file = out_img_file
     c3.run()
 
-def copy_orient(in_img_file, ref_img_file, out_img_file):
-    print("\n copy orientation ...")
-    c3 = C3d()
-    c3.inputs.in_file = ref_img_file
-    c3.inputs.args = "%s -copy-transform -type uchar" % in_img_file
-    c3.inputs.out_file = out_img_file
-    c3.run()
+def convert(in_img_file, out_img_file):
+    subprocess.run('c3d %s -o %s' % (in_img_file, out_img_file), shell=True, stdout=subprocess.PIPE)
+
+def sequence_bias_file(subj_dir, subj, mod):
+    if mod == 'flair':
+        return os.path.join(subj_dir, "%s_T1acq_nu_FL.nii.gz" % subj)
+    else:
+        return os.path.join(subj_dir, "%s_T1acq_nu_T2.nii.gz" % subj)
+
+
+def n4_threads(ctx, key='n4_threads'):
+    """
+    N4 threads argument of a subject, set by the cohort scheduler
+    :param key: n4_threads for the t1 (bias stage), seq_n4_threads for each of the other sequences (preprocess stage)
+    """
+    return ["-nt", "%s" % ctx[key]] if ctx.get(key) else []
+
+
+def prepare_sequence(ctx, mod, seq):
+    """
+    Bias correct and orient a non-t1 sequence
+    :return: (sequence to crop, sequence name)
+    """
+    subj_dir, subj, bias, ign_ort = ctx['subj_dir'], ctx['subj'], ctx['bias'], ctx['ign_ort']
+
+    # std orientations
+    r_orient = 'RPI'
+    l_orient = 'LPI'
+
+    seq_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(seq).split('.')[0])
+    if mod != 't1':
+        seq_bias = sequence_bias_file(subj_dir, subj, mod)
+
+        if bias is True:
+            biascorr.main(["-i", "%s" % seq, "-o", "%s" % seq_bias] + n4_threads(ctx, 'seq_n4_threads'))
+        seq = seq_bias if os.path.exists(seq_bias) else seq
+        # check orientation
+        if ign_ort is False:
+            cp_orient_seq = check_orient(seq, r_orient, l_orient, seq_ort)
+    in_seq = seq_ort if os.path.exists(seq_ort) else seq
+
+    return in_seq, os.path.basename(seq).split('.')[0]
+
+
+def crop_sequence(ctx, mod, in_seq, pred_dir, crop_file):
+    """
+    Crop the t1 to its bounding box, and the other sequences like the cropped t1
+    """
+    if mod == 't1':
+        trim(in_seq, crop_file, voxels=1, engine=ctx['engine'])
+    else:
+        ref_file = '%s/%s_cropped.nii.gz' % (pred_dir, os.path.basename(ctx['t1']).split('.')[0])
+        trim_like(in_seq, ref_file, crop_file, interp=1, engine=ctx['engine'])
+
+
+def standardize_sequence(ctx, seq_name, pred_dir, crop_file, res_file, cutoff_percents=5.0):
+    """
+    Threshold, standardize and resample a cropped sequence to the network input shape
+    """
+    engine, debug, pred_shape = ctx['engine'], ctx['debug'], ctx['pred_shape']
 
-def fill_holes(in_img_file, out_img_file):
     c3 = C3d()
-    c3.inputs.in_file = in_img_file
-    c3.inputs.args = "-holefill 1 0 -type uchar"
-    c3.inputs.out_file = out_img_file
-    c3.run()
 
-def convert(in_img_file, out_img_file):
-    subprocess.run('c3d %s -o %s' % (in_img_file, out_img_file), shell=True, stdout=subprocess.PIPE)
+    # thresholding, standardize intensity and resampling  for data
+    thresh_file = '%s/%s_cropped_thresholded.nii.gz' % (pred_dir, seq_name)
+    print("\n thresholding and standardizing ...")
+    std_img = imgops.clip_standardize(nib.load(crop_file), cutoff_percents,
+                                      clipped_file=thresh_file if debug else None)
+
+    std_file = '%s/%s_cropped_thresholded_standardized.nii.gz' % (pred_dir, seq_name)
+    if debug or engine == 'c3d':
+        nib.save(std_img, std_file)
+
+    if engine == 'numpy':
+        print("\n resmapling ...")
+        nib.save(imgops.resample_shape(std_img, pred_shape, interp=1), res_file)
+    else:
+        resample(std_file, pred_shape[0], pred_shape[1], pred_shape[2], res_file, interp=1, engine=engine)
+        if not debug:
+            os.remove(std_file)
+
+    if not os.path.exists(res_file):
+        print("\n pre-processing %s" % seq_name)
+        c3.run()
+
+
+def preprocess_sequence(ctx, mod, seq, pred_dir, crop_file, res_file, cutoff_percents=5.0):
+    """
+    Bias correct and orient (non-t1), crop, threshold, standardize and resample one sequence
+    """
+    in_seq, seq_name = prepare_sequence(ctx, mod, seq)
+    crop_sequence(ctx, mod, in_seq, pred_dir, crop_file)
+    standardize_sequence(ctx, seq_name, pred_dir, crop_file, res_file, cutoff_percents)
+
+
+def add_sequence_tasks(graph, ctx, mod, seq, pred_dir, crop_file, res_file, cutoff_percents=5.0):
+    """
+    Add the pre-processing chain of one sequence to a task graph. Only the cropping of the non-t1 sequences
+    waits for the t1 crop, bias correction and orientation run right away
+    """
+    prepared = {}
+
+    def prepare():
+        prepared['in_seq'], prepared['seq_name'] = prepare_sequence(ctx, mod, seq)
+
+    graph.add('%s_prepare' % mod, prepare)
+    graph.add('%s_crop' % mod, lambda: crop_sequence(ctx, mod, prepared['in_seq'], pred_dir, crop_file),
+              deps=['%s_prepare' % mod] + (['t1_crop'] if mod != 't1' and 't1_crop' in graph.tasks else []))
+    graph.add('%s_resample' % mod,
+              lambda: standardize_sequence(ctx, prepared['seq_name'], pred_dir, crop_file, res_file, cutoff_percents),
+              deps=['%s_crop' % mod])
+
 
 ###########################################        Main        #########################################################
-def main(args):
-    parser = parsefn()
-    subj_dir, subj, t1, fl, t2, woc, out, bias, num_mc, thresh, ign_ort, force = parse_inputs(parser, args)
-    cp_orient = False
+def setup_subject(parser, args):
+    """
+    Resolve the inputs, outputs and model of one subject
+    :return: subject context (dict) shared by the pre-processing, prediction and post-processing stages,
+             or None if the segmentation already exists
+    """
+    subj_dir, subj, t1, fl, t2, woc, out, bias, num_mc, mc_tol, mc_max, mc_batch, uncert, thresh, ign_ort, force, engine, debug, \
+        use_cache, cache_dir, cache_size, resample_mode, mod_workers, backend, xla, mc_workers, seed = \
+        parse_inputs(parser, args)
     rc_flag = False
 
     if out is None:
@@ -222,261 +321,514 @@ def main(args):
 
     if os.path.exists(prediction) and force is False:
         print("\n %s already exists" % prediction)
-    else:
-        start_time = datetime.now()
-
-        hfb = os.path.realpath(__file__)
-        hyper_dir = Path(hfb).parents[2]
-
-        pred_shape = [160, 160, 160]
-
-        if fl is None and t2 is None:
-            pred_shape = [224, 224, 224]
-            test_seqs = [t1]
-            training_mods = ["t1"]
-            model_name = 'hfb_t1only_mcdp_224iso_contrast'
-            model_name_woc = 'hfb_t1'
-            print("\n found only t1-w, using the %s model" % model_name)
-
-        elif t2 is None and fl:
-            test_seqs = [t1, fl]
-            training_mods = ["t1", "flair"]
-            model_name = 'hfb_t1fl_mcdp_multi'
-            model_name_woc = 'hfb_t1fl'
-            print("\n found t1 and fl sequences, using the %s model" % model_name)
-
-        elif fl is None and t2:
-            test_seqs = [t1, t2]
-            training_mods = ["t1", "t2"]
-            model_name = 'hfb_t1t2_mcdp_multi'
-            model_name_woc = 'hfb_t1t2'
-            print("\n found t1 and t2 sequences, using the %s model" % model_name)
+        return None
+
+    hfb = os.path.realpath(__file__)
+    hyper_dir = Path(hfb).parents[2]
+
+    pred_shape = [160, 160, 160]
+
+    if fl is None and t2 is None:
+        pred_shape = [224, 224, 224]
+        test_seqs = [t1]
+        training_mods = ["t1"]
+        model_name = 'hfb_t1only_mcdp_224iso_contrast'
+        model_name_woc = 'hfb_t1'
+        print("\n found only t1-w, using the %s model" % model_name)
+
+    elif t2 is None and fl:
+        test_seqs = [t1, fl]
+        training_mods = ["t1", "flair"]
+        model_name = 'hfb_t1fl_mcdp_multi'
+        model_name_woc = 'hfb_t1fl'
+        print("\n found t1 and fl sequences, using the %s model" % model_name)
+
+    elif fl is None and t2:
+        test_seqs = [t1, t2]
+        training_mods = ["t1", "t2"]
+        model_name = 'hfb_t1t2_mcdp_multi'
+        model_name_woc = 'hfb_t1t2'
+        print("\n found t1 and t2 sequences, using the %s model" % model_name)
 
+    else:
+        test_seqs = [t1, fl, t2]
+        training_mods = ["t1", "flair", "t2"]
+        model_name = 'hfb_multi_mcdp_contrast'
+        model_name_woc = 'hfb_t1flt2_mcdp_contrast'
+        rc_flag = True
+        print("\n found all 3 sequences, using the full %s model" % model_name)
+
+    model_json = '%s/models/%s_model.json' % (hyper_dir, model_name)
+    model_weights = '%s/models/%s_model_weights.h5' % (hyper_dir, model_name)
+
+    assert os.path.exists(model_json), "%s does not exist ... please download and rerun script" % model_json
+    assert os.path.exists(model_weights), "%s does not exist ... please download and rerun script" % model_weights
+
+    # tensorflow is only imported once a subject is segmented
+    from icvmapper.deep.predict import frozen_file
+
+    if backend == 'frozen' and not os.path.exists(frozen_file(model_weights)):
+        print("\n %s not found, run 'icvmapper freeze_model' to export it ... using the keras backend"
+              % frozen_file(model_weights))
+        backend = 'keras'
+
+    cache = None
+    if use_cache:
+        # one cache for all the subjects, so re-runs and repeated scans of a cohort hit it
+        try:
+            cache = StageCache(cache_dir if cache_dir else default_cache_dir(), max_size_gb=cache_size, refresh=force)
+        except OSError as err:
+            print("\n stage cache unavailable (%s) ... running without it" % err)
+        # interpolation tables are reused by the cerebellum map and by reruns of the same subject
+        try:
+            resampling.set_cache_dir(resampling.default_cache_dir())
+        except OSError:
+            resampling.set_cache_dir(None)
+
+    return dict(subj_dir=subj_dir, subj=subj, t1=t1, woc=woc, bias=bias, num_mc=num_mc, mc_tol=mc_tol,
+                mc_max=mc_max, mc_batch=mc_batch, uncert=uncert, thresh=thresh, ign_ort=ign_ort, engine=engine,
+                debug=debug, cache=cache, resample_mode=resample_mode, mod_workers=mod_workers, backend=backend,
+                xla=xla, mc_workers=mc_workers, seed=seed,
+                prediction=prediction, prediction_std_orient=prediction_std_orient, hyper_dir=hyper_dir,
+                pred_shape=pred_shape, test_seqs=test_seqs, training_mods=training_mods, rc_flag=rc_flag,
+                model_name=model_name, model_name_woc=model_name_woc, model_json=model_json,
+                model_weights=model_weights, start_time=datetime.now())
+
+
+def correct_subject(ctx, threads=None):
+    """
+    Bias correct (or convert) the t1 (ctx['in_ort'])
+    :param threads: N4 threads (default: 90% of the cores)
+    """
+    subj_dir, subj, t1, bias = ctx['subj_dir'], ctx['subj'], ctx['t1'], ctx['bias']
+    if threads:
+        ctx['n4_threads'] = threads
+
+    if bias is True:
+        # t1_bias = os.path.join(subj_dir, "%s_T1_nu.nii.gz" % os.path.basename(t1).split('.')[0])
+        t1_bias = os.path.join(subj_dir, "%s_T1_nu.nii.gz" % subj)
+        # looked up before N4, keyed on the raw t1
+        cache = ctx['cache']
+        key = cache.key('bias', files=[t1]) if cache is not None else None
+        if cache is not None and cache.fetch(key, {'T1_nu.nii.gz': t1_bias}):
+            print("\n found bias corrected t1 in cache")
         else:
-            test_seqs = [t1, fl, t2]
-            training_mods = ["t1", "flair", "t2"]
-            model_name = 'hfb_multi_mcdp_contrast'
-            model_name_woc = 'hfb_t1flt2_mcdp_contrast'
-            rc_flag = True
-            print("\n found all 3 sequences, using the full %s model" % model_name)
-
-        model_json = '%s/models/%s_model.json' % (hyper_dir, model_name)
-        model_weights = '%s/models/%s_model_weights.h5' % (hyper_dir, model_name)
-
-        assert os.path.exists(model_json), "%s does not exist ... please download and rerun script" % model_json
-        assert os.path.exists(model_weights), "%s does not exist ... please download and rerun script" % model_weights
-
-        # pred preprocess dir
-        print(colored("\n pre-processing %s..." % os.path.abspath(subj_dir), 'green'))
-        pred_dir = "%s/pred_process_hfb" % os.path.abspath(subj_dir)
-        if not os.path.exists(pred_dir):
-            os.mkdir(pred_dir)
-
-        # pred_dir_mcdp = "%s/pred_process_mcdp" % os.path.abspath(subj_dir)
-        # if not os.path.exists(pred_dir_mcdp):
-        #     os.mkdir(pred_dir_mcdp)
-
-        #############
-        if bias is True:
-            # t1_bias = os.path.join(subj_dir, "%s_T1_nu.nii.gz" % os.path.basename(t1).split('.')[0])
-            t1_bias = os.path.join(subj_dir, "%s_T1_nu.nii.gz" % subj)
-            biascorr.main(["-i", "%s" % t1, "-o", "%s" % t1_bias])
-            in_ort = t1_bias
+            biascorr.main(["-i", "%s" % t1, "-o", "%s" % t1_bias] + n4_threads(ctx))
+            if cache is not None:
+                cache.store(key, {'T1_nu.nii.gz': t1_bias})
+        in_ort = t1_bias
+    else:
+        in_ort = os.path.join(subj_dir, "%s.nii.gz" % os.path.basename(t1).split('.')[0])
+        if not os.path.exists(in_ort):
+            convert(t1, in_ort)
+
+    ctx.update(in_ort=in_ort)
+
+    return ctx
+
+
+def preprocess_subject(ctx, threads=None):
+    """
+    Bias correct, orient, crop, threshold, standardize and resample every sequence into the
+    network input tensor (ctx['test_data'])
+    :param threads: cores granted by the cohort scheduler, split between the sequences pre-processed concurrently
+    """
+    subj_dir, subj, t1, bias, ign_ort = ctx['subj_dir'], ctx['subj'], ctx['t1'], ctx['bias'], ctx['ign_ort']
+    engine, debug = ctx['engine'], ctx['debug']
+    test_seqs, training_mods, pred_shape = ctx['test_seqs'], ctx['training_mods'], ctx['pred_shape']
+    cp_orient = False
+
+    if threads:
+        ctx['seq_n4_threads'] = max(1, threads // max(1, min(len(test_seqs), ctx['mod_workers'])))
+
+    # pred preprocess dir
+    print(colored("\n pre-processing %s..." % os.path.abspath(subj_dir), 'green'))
+    pred_dir = "%s/pred_process_hfb" % os.path.abspath(subj_dir)
+    if not os.path.exists(pred_dir):
+        os.mkdir(pred_dir)
+
+    #############
+    # the cohort scheduler runs the bias correction as a stage of its own
+    if 'in_ort' not in ctx:
+        correct_subject(ctx)
+    in_ort = ctx['in_ort']
+
+    # std orientations
+    r_orient = 'RPI'
+    l_orient = 'LPI'
+    # check orientation
+    t1_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(t1).split('.')[0])
+    if ign_ort is False:
+        cp_orient = check_orient(in_ort, r_orient, l_orient, t1_ort)
+
+    # loading t1
+    in_t1 = t1_ort if os.path.exists(t1_ort) else in_ort
+    t1_img = nib.load(in_t1)
+
+    ###########
+    test_data = np.zeros((1, len(training_mods), pred_shape[0], pred_shape[1], pred_shape[2]), dtype=t1_img.get_data_dtype())
+
+    cache = ctx['cache']
+    cutoff_percents = 5.0
+
+    # sequences missing from the cache are pre-processed as a task graph, non-t1 chains run concurrently
+    graph = TaskGraph(max_workers=ctx['mod_workers'])
+    to_store, res_files = [], []
+
+    for s, seq in enumerate(test_seqs):
+        # non-t1 sequences are named after their bias corrected version
+        seq_name = seq
+        if training_mods[s] != 't1':
+            seq_bias = sequence_bias_file(subj_dir, subj, training_mods[s])
+            seq_name = seq_bias if (bias is True or os.path.exists(seq_bias)) else seq
+        seq_name = os.path.basename(seq_name).split('.')[0]
+
+        crop_file = '%s/%s_cropped.nii.gz' % (pred_dir, seq_name)
+        res_file = '%s/%s_resampled.nii.gz' % (pred_dir, seq_name)
+        outputs = {'cropped.nii.gz': crop_file, 'resampled.nii.gz': res_file}
+        res_files.append(res_file)
+
+        # keyed on the raw inputs, non-t1 sequences are cropped like the t1
+        key = cache.key('preprocess', files=[seq] if training_mods[s] == 't1' else [seq, t1],
+                        mod=training_mods[s], bias=bias, ign_ort=ign_ort, shape=pred_shape, engine=engine,
+                        cutoff=cutoff_percents) if cache is not None else None
+
+        if cache is not None and cache.fetch(key, outputs):
+            print("\n found pre-processed %s in cache" % training_mods[s])
         else:
-            in_ort = os.path.join(subj_dir, "%s.nii.gz" % os.path.basename(t1).split('.')[0])
-            in_ort = in_ort if os.path.exists(in_ort) else convert(t1, in_ort)
-            # in_ort = t1
+            print(colored("\n pre-processing %s" % os.path.basename(seq).split('.')[0], 'green'))
+            add_sequence_tasks(graph, ctx, training_mods[s], seq, pred_dir, crop_file, res_file, cutoff_percents)
+            to_store.append((key, outputs))
 
+    start = datetime.now()
+    graph.run()
+    if len(graph.tasks) > 3:
+        print("\n pre-processed %s sequences in %.1f sec (%.1f sec of sequential work)"
+              % (len(to_store), (datetime.now() - start).total_seconds(), sum(graph.times.values())))
 
-        # std orientations
-        r_orient = 'RPI'
-        l_orient = 'LPI'
-        # check orientation
-        t1_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(t1).split('.')[0])
-        if ign_ort is False:
-            cp_orient = check_orient(in_ort, r_orient, l_orient, t1_ort)
+    if cache is not None:
+        for key, outputs in to_store:
+            cache.store(key, outputs)
 
-        # loading t1
-        in_t1 = t1_ort if os.path.exists(t1_ort) else in_ort
-        t1_img = nib.load(in_t1)
+    for s, res_file in enumerate(res_files):
+        test_data[0, s, :, :, :] = nib.load(res_file).get_data()
 
-        ###########
-        c3 = C3d()
+    res_t1_file = '%s/%s_resampled.nii.gz' % (pred_dir, os.path.basename(t1).split('.')[0])
 
-        test_data = np.zeros((1, len(training_mods), pred_shape[0], pred_shape[1], pred_shape[2]), dtype=t1_img.get_data_dtype())
+    ctx.update(pred_dir=pred_dir, in_ort=in_ort, cp_orient=cp_orient, t1_img=t1_img, test_data=test_data,
+               res_affine=nib.load(res_t1_file).affine)
+
+    return ctx
 
-        for s, seq in enumerate(test_seqs):
-            print(colored("\n pre-processing %s" % os.path.basename(seq).split('.')[0], 'green'))
 
+def predict_subject(ctx):
+    """
+    MC Dropout inference of the ICV (and cerebellum) model on the pre-processed tensor
+    """
+    from icvmapper.deep.predict import run_mc_dropout, build_mc_models, submit_test_case, frozen_file
 
-            seq_ort = "%s/%s_std_orient.nii.gz" % (subj_dir, os.path.basename(seq).split('.')[0])
-            if training_mods[s] != 't1':
-                if training_mods[s] == 'flair':
-                    seq_bias = os.path.join(subj_dir, "%s_T1acq_nu_FL.nii.gz" % subj)
-                else:
-                    seq_bias = os.path.join(subj_dir, "%s_T1acq_nu_T2.nii.gz" % subj)
-
-                if bias is True:
-                    biascorr.main(["-i", "%s" % seq, "-o", "%s" % seq_bias])
-                seq = seq_bias if os.path.exists(seq_bias) else seq
-                # check orientation
-                if ign_ort is False:
-                    cp_orient_seq = check_orient(seq, r_orient, l_orient, seq_ort)
-            in_seq = seq_ort if os.path.exists(seq_ort) else seq
-
-            # cropping
-            if training_mods[s] == 't1':
-                crop_file = '%s/%s_cropped.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-                trim(in_seq, crop_file, voxels=1)
-            else:
-                crop_file = '%s/%s_cropped.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-                ref_file = '%s/%s_cropped.nii.gz' % (pred_dir, os.path.basename(t1).split('.')[0])
-                trim_like(in_seq, ref_file, crop_file, interp=1)
-
-            # thresholding, standardize intensity and resampling  for data
-            thresh_file = '%s/%s_cropped_thresholded.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-            cutoff_percents = 5.0
-            cutoff_img(crop_file, cutoff_percents, thresh_file)
-
-            std_file = '%s/%s_cropped_thresholded_standardized.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-            normalize_sample_wise_img(thresh_file, std_file)
-
-            res_file = '%s/%s_resampled.nii.gz' % (pred_dir, os.path.basename(seq).split('.')[0])
-            resample(std_file, pred_shape[0], pred_shape[1], pred_shape[2], res_file, interp=1)
-
-            if not os.path.exists(res_file):
-                print("\n pre-processing %s" % training_mods[s])
-                c3.run()
-            res_data = nib.load(res_file)
-            test_data[0, s, :, :, :] = res_data.get_data()
-
-        print(colored("\n predicting hfb segmentation using MC Dropout with %s samples" % num_mc, 'green'))
-
-        res_t1_file = '%s/%s_resampled.nii.gz' % (pred_dir, os.path.basename(t1).split('.')[0])
-        res = nib.load(res_t1_file)
-
-        pred_s = np.zeros((num_mc, pred_shape[0], pred_shape[1], pred_shape[2]), dtype=res.get_data_dtype())
-
-        for sample_id in range(num_mc):
-            print("MC sample # %s" % sample_id)
-            pred = run_test_case(test_data=test_data, model_json=model_json, model_weights=model_weights,
-                                 affine=res.affine, output_label_map=True, labels=1)
-            pred_s[sample_id, :, :, :] = pred.get_data()
-            #nib.save(pred, os.path.join(pred_dir_mcdp, "hfb_pred_%s.nii.gz" % sample_id))
-
-        # computing mean
-        pred_mean = pred_s.mean(axis=0)
-        pred = nib.Nifti1Image(pred_mean, res.affine)
-
-        pred_prob = os.path.join(pred_dir, "hfb_prob.nii.gz")
+    pred_dir, subj, test_data, res_affine = ctx['pred_dir'], ctx['subj'], ctx['test_data'], ctx['res_affine']
+    num_mc, mc_max, thresh, uncert = ctx['num_mc'], ctx['mc_max'], ctx['thresh'], ctx['uncert']
+
+    print(colored("\n predicting hfb segmentation using MC Dropout with %s samples" %
+                  (num_mc if num_mc else "up to %s" % mc_max), 'green'))
+
+    pred_prob = os.path.join(pred_dir, "hfb_prob.nii.gz")
+    outputs = {'hfb_prob.nii.gz': pred_prob}
+    if uncert:
+        outputs.update((name, os.path.join(pred_dir, name)) for name in ['hfb_var.nii.gz', 'hfb_entropy.nii.gz'])
+
+    cache = ctx['cache']
+
+    # the probability map does not depend on the threshold or post-processing
+    # except for the adaptive number of samples, whose stopping rule thresholds the running mean
+    key = cache.key('predict', files=[ctx['model_json'], ctx['model_weights']], arrays=[test_data], num_mc=num_mc,
+                    mc_tol=ctx['mc_tol'], mc_max=mc_max, uncert=uncert, backend=ctx['backend'], xla=ctx['xla'],
+                    mc_workers=ctx['mc_workers'], seed=ctx['seed'],
+                    thresh=thresh if num_mc is None and ctx['mc_workers'] == 1 else None) \
+        if cache is not None else None
+
+    cached = cache is not None and cache.fetch(key, outputs)
+
+    # the cerebellum model runs in the same TF graph, which is not safe to extend while it predicts: build the
+    # ICV models and their split first (sharded MC Dropout runs in worker processes)
+    if not cached and ctx['mc_workers'] == 1:
+        build_mc_models(ctx['model_json'], ctx['model_weights'], backend=ctx['backend'], xla=ctx['xla'])
+
+    # the cerebellum model runs on the same tensor in a worker thread, while the MC Dropout loop runs here
+    cereb_pred, cereb_future, cereb_key = None, None, None
+    cereb_pool = ThreadPoolExecutor(max_workers=1)
+    if ctx['woc'] == 1 and ctx['rc_flag']:
+        print("\n predicting approximate cerebellar mask")
+
+        model_json_woc = '%s/models/%s_model.json' % (ctx['hyper_dir'], ctx['model_name_woc'])
+        cereb_weights = '%s/models/cereb_model_weights.h5' % ctx['hyper_dir']
+
+        cereb_prob = os.path.join(pred_dir, "hfb_cereb_prob.nii.gz")
+        cereb_key = cache.key('cereb', files=[model_json_woc, cereb_weights], arrays=[test_data]) \
+            if cache is not None else None
+
+        if cache is not None and cache.fetch(cereb_key, {'hfb_cereb_prob.nii.gz': cereb_prob}):
+            print("\n found cerebellar probability map in cache")
+            cereb_pred = nib.load(cereb_prob)
+        else:
+            cereb_backend = ctx['backend'] if os.path.exists(frozen_file(cereb_weights)) else 'keras'
+            cereb_future = submit_test_case(cereb_pool, test_data=test_data, model_json=model_json_woc,
+                                            model_weights=cereb_weights, affine=res_affine, output_label_map=True,
+                                            labels=1, backend=cereb_backend, xla=ctx['xla'])
+
+    if cached:
+        print("\n found MC Dropout probability map in cache")
+        pred = nib.load(pred_prob)
+    else:
+        # running mean (and variance) of the samples
+        if ctx['mc_workers'] > 1:
+            if num_mc is None:
+                print("\n sharded MC Dropout draws a fixed number of samples, drawing %s" % mc_max)
+            mc_acc = run_mc_sharded(test_data, ctx['model_json'], ctx['model_weights'], num_mc if num_mc else mc_max,
+                                    workers=ctx['mc_workers'], seed=ctx['seed'], track_var=uncert,
+                                    mc_batch=ctx['mc_batch'], backend=ctx['backend'], xla=ctx['xla'])
+        else:
+            mc_acc = run_mc_dropout(test_data=test_data, model_json=ctx['model_json'],
+                                    model_weights=ctx['model_weights'], num_mc=num_mc, mc_batch=ctx['mc_batch'],
+                                    track_var=uncert, thresh=thresh, mc_tol=ctx['mc_tol'], mc_max=mc_max,
+                                    backend=ctx['backend'], xla=ctx['xla'])
+
+        pred = nib.Nifti1Image(mc_acc.mean, res_affine)
         nib.save(pred, pred_prob)
 
-        pred_th_name = os.path.join(pred_dir, "hfb_pred.nii.gz")
-        pred_th = math_img('img > %s' % thresh, img=pred)
-        nib.save(pred_th, pred_th_name)
+        if uncert:
+            nib.save(nib.Nifti1Image(mc_acc.variance(), res_affine), outputs['hfb_var.nii.gz'])
+            nib.save(nib.Nifti1Image(mc_acc.entropy(), res_affine), outputs['hfb_entropy.nii.gz'])
+
+        if cache is not None:
+            cache.store(key, outputs)
 
-        # resample back
-        pred_res = resample_to_img(pred_prob, t1_img, interpolation="linear")
-        pred_prob_name = os.path.join(pred_dir, "%s_%s_pred_prob.nii.gz" % (subj, model_name))
-        nib.save(pred_res, pred_prob_name)
+    pred_th_name = os.path.join(pred_dir, "hfb_pred.nii.gz")
+    pred_th = math_img('img > %s' % thresh, img=pred)
+    nib.save(pred_th, pred_th_name)
 
-        # sm
-        pred_sm = smooth_img(pred_res, fwhm=3)
-        pred_res_th = math_img('img > %s' % thresh, img=pred_sm)
-        # conn comp
-        pred_comp = largest_connected_component_img(pred_res_th)
-        pred_name = os.path.join(pred_dir, "%s_%s_pred.nii.gz" % (subj, model_name))
-        nib.save(pred_comp, pred_name)
+    if cereb_future is not None:
+        cereb_pred = cereb_future.result()
+        nib.save(cereb_pred, cereb_prob)
+        if cache is not None:
+            cache.store(cereb_key, {'hfb_cereb_prob.nii.gz': cereb_prob})
+    cereb_pool.shutdown()
 
-        # copy original orientation to final prediction
-        print(cp_orient)
-        if ign_ort is False and cp_orient:
-            nib.save(pred_comp, prediction_std_orient)
-            fill_holes(prediction_std_orient, prediction_std_orient)
+    ctx.update(pred_prob=pred_prob, cereb_pred=cereb_pred)
+    # the input tensor is no longer needed
+    ctx.pop('test_data')
+
+    return ctx
+
+
+def resample_prob(prob_img, t1_img, resample_mode='band', debug=False, interpolation="linear"):
+    """
+    Resample a probability map back to the native t1 grid
+    :param resample_mode: band (linear, only near the boundary, the rest filled from the coarse labels) or full
+    :param debug: compare the band resampling to the full one
+    :param interpolation: interpolation of the full resampling, the band resampling being linear only
+    """
+    if isinstance(prob_img, str):
+        prob_img = nib.load(prob_img)
 
-            copy_orient(pred_name, in_ort, prediction)
-            fill_holes(prediction, prediction)
+    res_img = None
+    if resample_mode == 'band' and interpolation == "linear":
+        res_img = postproc.resample_band(prob_img, t1_img)
+    elif interpolation == "linear":
+        # full resampling with the cached interpolation tables of this pair of geometries
+        res_data = resampling.resample_grid(np.asanyarray(prob_img.dataobj), prob_img.affine, t1_img.shape[:3],
+                                            t1_img.affine)
+        if res_data is not None:
+            return nib.Nifti1Image(res_data, t1_img.affine)
 
+    if res_img is None:
+        return resample_to_img(prob_img, t1_img, interpolation=interpolation)
+
+    if debug:
+        full_img = resample_to_img(prob_img, t1_img, interpolation="linear")
+        print("\n band resampling max abs difference to full resampling: %.2e"
+              % np.abs(full_img.get_fdata(dtype=np.float32) - res_img.get_fdata(dtype=np.float32)).max())
+
+    return res_img
+
+
+def save_mask(mask, t1_img, in_ort_img, reoriented, out_file, out_std_file, masked_file, masked_std_file):
+    """
+    Save a native space mask and the masked t1, once per output
+    :param mask: uint8 mask in the space of the (standard oriented) t1
+    :param t1_img: standard oriented t1
+    :param in_ort_img: t1 in its input orientation
+    :param reoriented: whether the t1 was re-oriented to a standard orientation
+    """
+    if reoriented:
+        nib.save(nib.Nifti1Image(mask, t1_img.affine), out_std_file)
+        nib.save(nib.Nifti1Image(np.asanyarray(t1_img.dataobj) * mask, t1_img.affine), masked_std_file)
+
+    # copy original orientation to final prediction
+    out_affine = in_ort_img.affine if reoriented else t1_img.affine
+    nib.save(nib.Nifti1Image(mask, out_affine), out_file)
+    nib.save(nib.Nifti1Image(np.asanyarray(in_ort_img.dataobj) * mask, in_ort_img.affine), masked_file)
+
+
+def cereb_native(ctx, t1_img, cereb_prediction):
+    """
+    Resample the cerebellar probability map to native space, smooth and threshold it
+    :return: uint8 cerebellar mask
+    """
+    cereb_pred_res = resample_prob(ctx['cereb_pred'], t1_img, ctx['resample_mode'], ctx['debug'],
+                                   interpolation="continuous")
+    cereb_pred_name = os.path.join("%s/%s_hfb_cereb_pred_prob.nii.gz" % (ctx['pred_dir'], ctx['subj']))
+    nib.save(cereb_pred_res, cereb_pred_name)
+
+    cereb_th, cereb_slices = postproc.smooth_threshold(cereb_pred_res.get_fdata(dtype=np.float32),
+                                                       t1_img.affine, fwhm=2, thresh=0.25)
+    cereb_th = postproc.paste(cereb_th, cereb_slices, t1_img.shape)
+    nib.save(nib.Nifti1Image(cereb_th, t1_img.affine), cereb_prediction)
+
+    return cereb_th
+
+
+def postprocess_subject(ctx, qc=True):
+    """
+    Bring the probability map back to native space, threshold, clean and mask, then generate the qc mosaic
+    :param qc: generate the qc mosaic (the cohort scheduler runs it as a stage of its own)
+    """
+    subj_dir, subj, t1, bias, ign_ort, thresh = \
+        ctx['subj_dir'], ctx['subj'], ctx['t1'], ctx['bias'], ctx['ign_ort'], ctx['thresh']
+    pred_dir, in_ort, cp_orient, t1_img, model_name = \
+        ctx['pred_dir'], ctx['in_ort'], ctx['cp_orient'], ctx['t1_img'], ctx['model_name']
+    prediction, prediction_std_orient = ctx['prediction'], ctx['prediction_std_orient']
+    in_ort_img = nib.load(in_ort)
+    reoriented = ign_ort is False and cp_orient
+    remove_cereb = ctx['woc'] == 1 and ctx['rc_flag']
+
+    # the cerebellar map is brought back to native space in a worker thread, alongside the icv map
+    cereb_pool = ThreadPoolExecutor(max_workers=1)
+    if remove_cereb:
+        cereb_prediction = '%s/%s_T1acq_nu_cerebellum_pred.nii.gz' % (subj_dir, subj) \
+            if bias is True else '%s/%s_T1acq_cerebellum_pred.nii.gz' % (subj_dir, subj)
+        cereb_future = cereb_pool.submit(cereb_native, ctx, t1_img, cereb_prediction)
+
+    # resample back
+    pred_res = resample_prob(ctx['pred_prob'], t1_img, ctx['resample_mode'], ctx['debug'])
+    pred_prob_name = os.path.join(pred_dir, "%s_%s_pred_prob.nii.gz" % (subj, model_name))
+    nib.save(pred_res, pred_prob_name)
+
+    # sm, threshold, conn comp and hole filling in one pass over the segmentation bounding box
+    pred_mask = postproc.segment_prob(pred_res.get_fdata(dtype=np.float32), t1_img.affine, thresh, fwhm=3)
+    pred_name = os.path.join(pred_dir, "%s_%s_pred.nii.gz" % (subj, model_name))
+    nib.save(nib.Nifti1Image(pred_mask, t1_img.affine), pred_name)
+
+    print(cp_orient)
+    # mask
+    t1_masked_name = '%s/%s_T1_nu_masked.nii.gz' % (subj_dir, subj) \
+        if bias is True else '%s/%s_masked.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
+    t1_masked_name_std = '%s/%s_T1_nu_masked_std_orient.nii.gz' % (subj_dir, subj) \
+        if bias is True else '%s/%s_masked_std_orient.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
+    save_mask(pred_mask, t1_img, in_ort_img, reoriented, prediction, prediction_std_orient,
+              t1_masked_name, t1_masked_name_std)
+
+    # remove cerebellum
+    if ctx['woc'] == 1:
+        if remove_cereb:
+            cereb_th = cereb_future.result()
+
+            # remove cerebellum, conn comp and hole filling within the icv bounding box
+            woc_slices = postproc.bbox_slices(pred_mask, 1)
+            woc_mask = postproc.paste(None, None, t1_img.shape)
+            if woc_slices is not None:
+                woc_mask[woc_slices] = postproc.clean_mask((pred_mask[woc_slices] > 0) & (cereb_th[woc_slices] == 0))
+            woc_name = os.path.join(pred_dir, "%s_%s_woc_pred.nii.gz" % (subj, model_name))
+            nib.save(nib.Nifti1Image(woc_mask, t1_img.affine), woc_name)
+
+            woc_pred = '%s/%s_T1acq_nu_HfB_woc_pred.nii.gz' % (subj_dir, subj) \
+                if bias is True else '%s/%s_T1acq_HfB_woc_pred.nii.gz' % (subj_dir, subj)
+            woc_pred_std_orient = '%s/%s_T1acq_nu_HfB_woc_pred_std_orient.nii.gz' % (subj_dir, subj)
+
+            # mask
+            t1_woc_name = '%s/%s_T1_nu_masked_woc.nii.gz' % (subj_dir, subj) \
+                if bias is True else '%s/%s_masked_woc.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
+            t1_woc_name_std = '%s/%s_T1_nu_masked_woc_std_orient.nii.gz' % (subj_dir, subj) \
+                if bias is True else '%s/%s_masked_woc_std_orient.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
+            save_mask(woc_mask, t1_img, in_ort_img, reoriented, woc_pred, woc_pred_std_orient,
+                      t1_woc_name, t1_woc_name_std)
         else:
-            nib.save(pred_comp, prediction)
-            fill_holes(prediction, prediction)
-
-        # mask
-        t1_masked_name = '%s/%s_T1_nu_masked.nii.gz' % (subj_dir, subj) \
-            if bias is True else '%s/%s_masked.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
-        masked_t1 = math_img("img1 * img2", img1=nib.load(in_ort), img2=nib.load(prediction))
-        nib.save(masked_t1, t1_masked_name)
-
-        if ign_ort is False and cp_orient:
-            t1_masked_name_std = '%s/%s_T1_nu_masked_std_orient.nii.gz' % (subj_dir, subj) \
-                if bias is True else '%s/%s_masked_std_orient.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
-            masked_t1_std = math_img("img1 * img2", img1=t1_img, img2=nib.load(prediction_std_orient))
-            nib.save(masked_t1_std, t1_masked_name_std)
-
-        # predict cerebellum
-        if woc == 1:
-            if rc_flag:
-                print("\n predicting approximate cerebellar mask")
-
-                cereb_prediction = '%s/%s_T1acq_nu_cerebellum_pred.nii.gz' % (subj_dir, subj) \
-                    if bias is True else '%s/%s_T1acq_cerebellum_pred.nii.gz' % (subj_dir, subj)
-                model_json_woc = '%s/models/%s_model.json' % (hyper_dir, model_name_woc)
-                cereb_weights = '%s/models/cereb_model_weights.h5' % hyper_dir
-
-                cereb_pred = run_test_case(test_data=test_data, model_json=model_json_woc, model_weights=cereb_weights,
-                                       affine=res.affine, output_label_map=True, labels=1)
-
-                # resample back
-                cereb_pred_res = resample_to_img(cereb_pred, t1_img)
-                cereb_pred_name = os.path.join("%s/%s_hfb_cereb_pred_prob.nii.gz" % (pred_dir, subj))
-                nib.save(cereb_pred_res, cereb_pred_name)
-                cereb_sm = smooth_img(cereb_pred_res, fwhm=2)
-                cereb_th = math_img('img > 0.25', img=cereb_sm)
-                nib.save(cereb_th, cereb_prediction)
-
-                # remove cerebellum
-                woc_img = pred_comp.get_data() - cereb_th.get_data()
-                woc_nii = nib.Nifti1Image(woc_img, t1_img.affine)
-                # conn comp
-                woc_th = math_img('img > 0', img=woc_nii)
-                woc_comp = largest_connected_component_img(woc_th)
-                woc_name = os.path.join(pred_dir, "%s_%s_woc_pred.nii.gz" % (subj, model_name))
-                nib.save(woc_comp, woc_name)
-
-                woc_pred = '%s/%s_T1acq_nu_HfB_woc_pred.nii.gz' % (subj_dir, subj) \
-                    if bias is True else '%s/%s_T1acq_HfB_woc_pred.nii.gz' % (subj_dir, subj)
-                woc_pred_std_orient = '%s/%s_T1acq_nu_HfB_woc_pred_std_orient.nii.gz' % (subj_dir, subj)
-
-
-                if ign_ort is False and cp_orient:
-                    nib.save(woc_comp, woc_pred_std_orient)
-                    fill_holes(woc_pred_std_orient, woc_pred_std_orient)
-
-                    copy_orient(woc_name, in_ort, woc_pred)
-                    fill_holes(woc_pred, woc_pred)
-
-                else:
-                    nib.save(woc_comp, woc_pred)
-                    fill_holes(woc_pred, woc_pred)
-
-                # mask
-                t1_woc_name = '%s/%s_T1_nu_masked_woc.nii.gz' % (subj_dir, subj) \
-                    if bias is True else '%s/%s_masked_woc.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
-                woc_t1 = math_img("img1 * img2", img1=nib.load(in_ort), img2=nib.load(woc_pred))
-                nib.save(woc_t1, t1_woc_name)
-
-                if ign_ort is False and cp_orient:
-                    t1_woc_name = '%s/%s_T1_nu_masked_woc_std_orient.nii.gz' % (subj_dir, subj) \
-                        if bias is True else '%s/%s_masked_woc_std_orient.nii.gz' % (subj_dir, os.path.basename(t1).split('.')[0])
-                    woc_t1 = math_img("img1 * img2", img1=t1_img, img2=nib.load(woc_pred_std_orient))
-                    nib.save(woc_t1, t1_woc_name)
-            else:
-                print("\n removing cerebellum feature is functional when all three T1w, Flair and T2w are available.")
-        print("\n generating mosaic image for qc")
-
-        seg_qc.main(["-i", "%s" % t1, "-s", "%s" % prediction, "-g", "5", "-m", "75"])
-
-        endstatement.main('Brain extraction and mosaic generation', '%s' % (datetime.now() - start_time))
+            print("\n removing cerebellum feature is functional when all three T1w, Flair and T2w are available.")
+    cereb_pool.shutdown()
+
+    if qc:
+        qc_subject(ctx)
+
+    endstatement.main('Brain extraction and mosaic generation', '%s' % (datetime.now() - ctx['start_time']))
+
+    return prediction
+
+
+def qc_subject(ctx):
+    print("\n generating mosaic image for qc")
+
+    seg_qc.main(["-i", "%s" % ctx['t1'], "-s", "%s" % ctx['prediction'], "-g", "5", "-m", "75"])
+
+
+def summarize_subjects(subj_dirs):
+    """
+    ICV volumes summary (stats_icv) of segmented subjects sharing a parent dir
+    """
+    parents = set(os.path.dirname(os.path.abspath(subj_dir)) for subj_dir in subj_dirs)
+    if len(parents) > 1:
+        print("\n subjects are in %s dirs, run stats_icv on each" % len(parents))
+        return
+
+    parent = parents.pop()
+    summary_icv_vols.main(['-i', parent, '-o', os.path.join(parent, 'icv_volumes.csv'),
+                           '-m', 'T1acq_nu_HfB_pred.nii.gz'])
+
+
+def segment_subject(parser, args):
+    ctx = setup_subject(parser, args)
+    if ctx is None:
+        return None
+
+    preprocess_subject(ctx)
+    predict_subject(ctx)
+
+    return postprocess_subject(ctx)
+
+
+def main(args):
+    parser = parsefn()
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+
+    if args.server:
+        from icvmapper.segment import server
+        if args.subjects:
+            sys.exit("--server takes a single subject, not --subjects")
+        if not server.submit(args.server, args):
+            sys.exit(1)
+    elif args.subjects and args.pool > 0:
+        # pool workers are daemonic processes, which can't start the MC Dropout worker processes
+        if args.mc_workers > 1:
+            sys.exit("--pool workers can't shard MC Dropout across --mc_workers processes ... "
+                     "please use one or the other")
+        from icvmapper.deep.predict import preload_weights
+        models_dir = os.path.join(Path(os.path.realpath(__file__)).parents[2], 'models')
+        cohort.run_pool(args, lambda subj_args: segment_subject(parser, subj_args),
+                        lambda: preload_weights(models_dir))
+    elif args.subjects and args.scheduler:
+        stages = dict(bias=lambda ctx, threads: correct_subject(ctx, threads), preprocess=preprocess_subject,
+                      predict=predict_subject, postprocess=lambda ctx: postprocess_subject(ctx, qc=False),
+                      qc=qc_subject)
+        cohort.run_scheduled(args, lambda subj_args: setup_subject(parser, subj_args), stages,
+                             stats=summarize_subjects)
+    elif args.subjects and args.pipeline:
+        cohort.run_pipeline(args, lambda subj_args: setup_subject(parser, subj_args),
+                            preprocess_subject, predict_subject, postprocess_subject)
+    elif args.subjects:
+        cohort.run_batch(args, lambda subj_args: segment_subject(parser, subj_args))
+    else:
+        segment_subject(parser, args)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+
+# seg_icv arguments, in a module of their own so building the cli parser does not import the segmentation
+# dependencies (nilearn, nipype, the qc and stats modules)
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage='%(prog)s -s [ subj ] \n\n'
+                                     "Brain extraction (skull-striping) using a trained CNN")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-s', '--subj', type=str, metavar='', help="input subject")
+    optional.add_argument('-fl', '--flair', type=str, metavar='', help="input Flair")
+    optional.add_argument('-t1', '--t1w', type=str, metavar='', help="input T1-weighted")
+    optional.add_argument('-t2', '--t2w', type=str, metavar='', help="input T2-weighted")
+    optional.add_argument('-o', '--out', type=str, metavar='', help="output prediction")
+    optional.add_argument('-b', '--bias', help="bias field correct image before segmentation",
+                          action='store_true')
+    optional.add_argument("-rc", "--rmcereb", type=int, metavar='', default=0, help="remove cerebellum")
+    optional.add_argument("-ign_ort", "--ign_ort",  action='store_true',
+                          help="ignore orientation if tag is wrong")
+    optional.add_argument('-f', '--force', action='store_true',
+                          help="overwrite existing segmentation, recomputing (and re-caching) every stage")
+    optional.add_argument('-n', '--num_mc', type=str, metavar='', default='20',
+                          help="number of Monte Carlo Dropout samples, or 'auto' to stop once the mask converges")
+    optional.add_argument('-mt', '--mc_tol', type=float, metavar='', default=1e-3,
+                          help="convergence tolerance for '-n auto' (default: %(default)s)")
+    optional.add_argument('-mm', '--mc_max', type=int, metavar='', default=30,
+                          help="max number of samples for '-n auto' (default: %(default)s)")
+    optional.add_argument('-mb', '--mc_batch', type=int, metavar='', default=1,
+                          help="number of MC Dropout samples per forward pass (default: %(default)s)")
+    optional.add_argument('-mcw', '--mc_workers', type=int, metavar='', default=1,
+                          help="worker processes the MC Dropout samples are sharded across, each with its own model "
+                               "and an even share of the cores (default: %(default)s)")
+    optional.add_argument('-sd', '--seed', type=int, metavar='', default=None,
+                          help="seed of the --mc_workers dropout masks, the probability map is then reproducible "
+                               "for a given (seed, mc_workers) pair")
+    optional.add_argument('-u', '--uncert', action='store_true',
+                          help="save voxel-wise MC Dropout variance and entropy maps next to the probability map")
+    optional.add_argument('-th', '--thresh', type=float, metavar='', help="threshold", default=0.5)
+    optional.add_argument('-e', '--engine', type=str, metavar='', default='c3d', choices=['c3d', 'numpy'],
+                          help="image operations backend: c3d or numpy (in-process) (default: %(default)s)")
+    optional.add_argument('-dbg', '--debug', action='store_true',
+                          help="keep intermediate pre-processing images (thresholded, standardized)")
+    optional.add_argument('-be', '--backend', type=str, metavar='', default='keras', choices=['keras', 'frozen'],
+                          help="inference backend: keras, or frozen graphs exported with 'icvmapper freeze_model' "
+                               "(default: %(default)s)")
+    optional.add_argument('-x', '--xla', action='store_true', help="XLA JIT compile the frozen graphs")
+    optional.add_argument('-mw', '--mod_workers', type=int, metavar='', default=3,
+                          help="sequences pre-processed concurrently, flair and t2 start once the t1 is cropped "
+                               "(default: %(default)s)")
+    optional.add_argument('-rm', '--resample_mode', type=str, metavar='', default='band', choices=['band', 'full'],
+                          help="resample the probability map back to native space interpolating only near the "
+                               "brain boundary (band) or everywhere (full) (default: %(default)s)")
+    optional.add_argument('-nc', '--no_cache', action='store_true',
+                          help="do not reuse or cache pre-processed inputs and MC Dropout probability maps")
+    optional.add_argument('-cd', '--cache_dir', type=str, metavar='',
+                          help="stage cache dir, shared across subjects (default: ~/.cache/icvmapper/stages)")
+    optional.add_argument('-cs', '--cache_size', type=float, metavar='', default=5.,
+                          help="max stage cache size in GB (default: %(default)s)")
+    optional.add_argument('-sv', '--server', type=str, metavar='',
+                          help="submit the job to an 'icvmapper serve' daemon listening on this socket instead of "
+                               "running it in this process")
+    optional.add_argument('-ss', '--session', type=str, metavar='', help="input session for longitudinal studies")
+    optional.add_argument('-sl', '--subjects', type=str, metavar='',
+                          help="text file listing subject dirs (one per line, optionally followed by a session) "
+                               "or a glob of subject dirs, segmented one after another in the same process")
+    optional.add_argument('-pl', '--pipeline', action='store_true',
+                          help="with --subjects, pre-process upcoming subjects while the current one is predicted")
+    optional.add_argument('-pw', '--pre_workers', type=int, metavar='', default=2,
+                          help="pipeline pre-processing workers (default: %(default)s)")
+    optional.add_argument('-po', '--pool', type=int, metavar='', default=0,
+                          help="with --subjects, segment subjects in this many workers forked after the model "
+                               "weights are loaded, so they share them, not with --mc_workers "
+                               "(default: %(default)s, no pool)")
+    optional.add_argument('-sc', '--scheduler', action='store_true',
+                          help="with --subjects, pack the stages of all subjects onto a node-wide core and memory "
+                               "budget, sizing the N4 and inference threads per stage")
+    optional.add_argument('-co', '--cores', type=int, metavar='', default=None,
+                          help="scheduler core budget (default: all cores)")
+    optional.add_argument('-ram', '--mem_gb', type=float, metavar='', default=None,
+                          help="scheduler memory budget in GB (default: 80%% of the node memory)")
+    optional.add_argument('-ti', '--inference_threads', type=int, metavar='', default=None,
+                          help="scheduler inference threads (default: half the cores)")
+    optional.add_argument('-im', '--inference_mem', type=float, metavar='', default=6.,
+                          help="scheduler memory of the inference stage in GB for the 224^3 model, scaled by the "
+                               "input size for the others (default: %(default)s)")
+    optional.add_argument('-ow', '--post_workers', type=int, metavar='', default=2,
+                          help="pipeline post-processing workers (default: %(default)s)")
+    optional.add_argument('-qd', '--queue_depth', type=int, metavar='', default=2,
+                          help="pipeline pre-processed subjects waiting for inference (default: %(default)s)")
+    optional.add_argument('-bs', '--batch_summary', type=str, metavar='', default='seg_icv_batch_summary.csv',
+                          help="per-subject status and runtime table for --subjects (default: %(default)s)")
+
+    return parser
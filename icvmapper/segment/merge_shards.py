@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import glob
+import os
+import sys
+
+import pandas as pd
+
+from icvmapper.segment.plan import PLAN_CSV, shard_name
+
+TIMING_COLUMNS = ['Shard', 'Exit', 'Start', 'End', 'Host']
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -p [ plan_dir ] \n\n"
+                                           "Merge the logs, timings and ICV volumes of the shards of a plan")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-p', '--plan_dir', type=str, required=True, metavar='', help="plan dir (icvmapper plan)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    plan_dir = os.path.abspath(args.plan_dir)
+    assert os.path.exists(os.path.join(plan_dir, PLAN_CSV)), \
+        "%s does not exist ... please run icvmapper plan first" % os.path.join(plan_dir, PLAN_CSV)
+
+    return plan_dir
+
+
+def read_shard_csvs(plan_dir, suffix, **kwargs):
+    """
+    Concatenate the csv of each shard (logs/shard_###_<suffix>.csv) that exists
+    """
+    dfs = []
+    for shard_csv in sorted(glob.glob(os.path.join(plan_dir, 'logs', 'shard_[0-9][0-9][0-9]_%s.csv' % suffix))):
+        try:
+            dfs.append(pd.read_csv(shard_csv, **kwargs))
+        except pd.errors.EmptyDataError:
+            print("\n %s is empty, skipping" % shard_csv)
+
+    return pd.concat(dfs) if dfs else None
+
+
+def merge_logs(plan_dir, shards, merged_log):
+    """
+    Concatenate the console log and the icvmapper logs of each shard
+    """
+    with open(merged_log, 'w') as out_file:
+        for shard in shards:
+            name = shard_name(shard)
+            logs = [os.path.join(plan_dir, 'logs', '%s.log' % name)] + \
+                sorted(glob.glob(os.path.join(plan_dir, 'work', name, 'logs', '*.log')))
+            for log in logs:
+                if os.path.exists(log):
+                    out_file.write("\n===== %s: %s =====\n" % (name, os.path.relpath(log, plan_dir)))
+                    with open(log, 'r', errors='replace') as in_file:
+                        out_file.write(in_file.read())
+
+
+def main(args):
+    parser = parsefn()
+    plan_dir = parse_inputs(parser, args)
+
+    plan = pd.read_csv(os.path.join(plan_dir, PLAN_CSV))
+    shards = sorted(plan['Shard'].unique())
+
+    # per-subject status and runtime
+    summary = read_shard_csvs(plan_dir, 'summary')
+    if summary is None:
+        summary = pd.DataFrame(columns=['Subject', 'Session', 'Status', 'Runtime_sec'])
+    keys = ['Subject', 'Session']
+    for df in (plan, summary):
+        df['Session'] = df['Session'].fillna('').astype(str)
+    summary = plan[keys + ['Shard', 'Est_cost']].merge(summary, on=keys, how='left')
+    summary['Status'] = summary['Status'].fillna('not run')
+    summary.to_csv(os.path.join(plan_dir, 'cohort_summary.csv'), index=False)
+
+    # per-shard wall time, next to the estimated cost
+    timings = read_shard_csvs(plan_dir, 'timing', header=None, names=TIMING_COLUMNS)
+    shard_rows = plan.groupby('Shard').agg(Subjects=('Subject', 'size'), Est_cost=('Est_cost', 'sum'))
+    shard_rows['Failed'] = summary[summary['Status'] == 'failed'].groupby('Shard').size()
+    shard_rows['Failed'] = shard_rows['Failed'].fillna(0).astype(int)
+    shard_rows['Runtime_sec'] = summary.groupby('Shard')['Runtime_sec'].sum().round(1)
+    if timings is not None:
+        timings = timings.set_index('Shard')
+        timings['Wall_sec'] = timings['End'] - timings['Start']
+        shard_rows = shard_rows.join(timings[['Exit', 'Wall_sec', 'Host']])
+    shard_rows.to_csv(os.path.join(plan_dir, 'shard_timings.csv'))
+
+    # icv volumes
+    volumes = read_shard_csvs(plan_dir, 'icv_volumes', index_col='Subjects')
+    if volumes is not None:
+        volumes = volumes[~volumes.index.duplicated(keep='last')].sort_index()
+        volumes.to_csv(os.path.join(plan_dir, 'cohort_icv_volumes.csv'))
+
+    merge_logs(plan_dir, shards, os.path.join(plan_dir, 'cohort.log'))
+
+    counts = summary['Status'].value_counts()
+    print("\n %s subjects: %s" % (len(summary), ', '.join('%s %s' % item for item in counts.items())))
+    if 'Wall_sec' in shard_rows and shard_rows['Wall_sec'].notna().any():
+        wall = shard_rows['Wall_sec'].dropna()
+        print("\n shard wall time %.0f - %.0f sec (imbalance %.2f), %.2f sec per estimated cost unit"
+              % (wall.min(), wall.max(), wall.max() / wall.mean(),
+                 wall.sum() / shard_rows.loc[wall.index, 'Est_cost'].sum()))
+    missing = summary[summary['Status'] == 'not run']
+    if len(missing):
+        print("\n %s subjects not run, in shards %s" % (len(missing), ', '.join(str(shard) for shard in
+                                                                                  sorted(missing['Shard'].unique()))))
+    print("\n merged outputs saved to %s (cohort_summary.csv, shard_timings.csv, cohort_icv_volumes.csv, cohort.log)"
+          % plan_dir)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import glob
+import heapq
+import math
+import os
+import shlex
+import sys
+
+import nibabel as nib
+import numpy as np
+import pandas as pd
+
+# input sequences of a subject dir, as named by seg_icv (-s)
+MODALITIES = (('T1', '%s_T1_nu.nii.gz'), ('FL', '%s_T1acq_nu_FL.nii.gz'), ('T2', '%s_T1acq_nu_T2.nii.gz'))
+
+# segmentation mask summarized by stats_icv, as named by seg_icv
+PRED_NAME = 'T1acq_nu_HfB_pred.nii.gz'
+
+# cost model (~ sec): inference runs on a fixed shape, pre-processing (N4, resampling) scales with the
+# voxels of each sequence
+INFERENCE_COST = 60.
+MVOX_COST = 4.
+
+PLAN_CSV = 'plan.csv'
+ARRAY_SCRIPT = 'array_job.sh'
+
+ARRAY_TEMPLATE = """#!/bin/bash
+# icvmapper array job: one task per shard of {plan_dir}
+# SLURM, PBS Pro and SGE directives are below, the other schedulers ignore them.
+# Run a shard without a scheduler with: bash {script} <shard>
+#SBATCH --job-name=icvmapper
+#SBATCH --array=0-{last}
+#SBATCH --cpus-per-task={cpus}
+#SBATCH --mem={mem_gb}G
+#SBATCH --time={walltime}
+#SBATCH --output={plan_dir}/logs/slurm_%A_%a.out
+#PBS -N icvmapper
+#PBS -J 0-{last}
+#PBS -l select=1:ncpus={cpus}:mem={mem_gb}gb
+#PBS -l walltime={walltime}
+#$ -N icvmapper
+#$ -t 1-{shards}
+#$ -pe smp {cpus}
+#$ -l h_vmem={mem_gb}G,h_rt={walltime}
+#$ -o {plan_dir}/logs
+
+# shards are numbered from 0, SGE task ids from 1
+if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    SHARD=$SLURM_ARRAY_TASK_ID
+elif [ -n "$PBS_ARRAY_INDEX" ]; then
+    SHARD=$PBS_ARRAY_INDEX
+elif [ -n "$SGE_TASK_ID" ] && [ "$SGE_TASK_ID" != "undefined" ]; then
+    SHARD=$((SGE_TASK_ID - 1))
+else
+    SHARD=$1
+fi
+if [ -z "$SHARD" ]; then
+    echo "usage: bash $0 <shard>" >&2
+    exit 2
+fi
+
+PLAN={plan_dir}
+NAME=$(printf "shard_%03d" "$SHARD")
+MANIFEST=$PLAN/$NAME.txt
+LOG=$PLAN/logs/$NAME.log
+
+# each shard works in its own dir, so the icvmapper logs of concurrent shards stay apart
+mkdir -p "$PLAN/logs" "$PLAN/work/$NAME"
+cd "$PLAN/work/$NAME" || exit 1
+
+START=$(date +%s)
+icvmapper seg_icv -sl "$MANIFEST" -bs "$PLAN/logs/${{NAME}}_summary.csv" {seg_args} > "$LOG" 2>&1
+STATUS=$?
+icvmapper stats_icv -i {in_dir} -sl "$MANIFEST" -m {pred_name} -o "$PLAN/logs/${{NAME}}_icv_volumes.csv" >> "$LOG" 2>&1
+echo "$SHARD,$STATUS,$START,$(date +%s),$(hostname)" > "$PLAN/logs/${{NAME}}_timing.csv"
+
+exit $STATUS
+"""
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -i [ in_dir ] -n [ shards ] \n\n"
+                                           "Split a cohort into cost-balanced shards and write their array job "
+                                           "manifests")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-i', '--in_dir', type=str, required=True, metavar='',
+                          help="cohort dir, one dir per subject (with session dirs for longitudinal studies)")
+    required.add_argument('-n', '--shards', type=int, required=True, metavar='',
+                          help="number of shards (array job tasks)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-o', '--out_dir', type=str, metavar='', default=None,
+                          help="plan dir (default: in_dir/icvmapper_plan)")
+    optional.add_argument('-a', '--seg_args', type=str, metavar='', default='',
+                          help="extra seg_icv arguments of every shard, e.g. \"-b -sc\"")
+    optional.add_argument('-sk', '--skip_done', action='store_true',
+                          help="leave out the subjects that already have a segmentation")
+    optional.add_argument('-c', '--cpus', type=int, metavar='', default=4,
+                          help="cores requested per array task (default: %(default)s)")
+    optional.add_argument('-m', '--mem_gb', type=int, metavar='', default=16,
+                          help="memory requested per array task in GB (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    in_dir = os.path.abspath(args.in_dir)
+    assert os.path.isdir(in_dir), "%s does not exist ... please check path and rerun script" % in_dir
+    if args.shards < 1:
+        parser.error("shards (-n) must be a positive integer")
+    out_dir = os.path.abspath(args.out_dir) if args.out_dir else os.path.join(in_dir, 'icvmapper_plan')
+
+    return in_dir, args.shards, out_dir, args.seg_args, args.skip_done, max(1, args.cpus), max(1, args.mem_gb)
+
+
+def shard_name(shard):
+    return 'shard_%03d' % shard
+
+
+def discover_subjects(in_dir):
+    """
+    Subjects of a cohort dir following the seg_icv -s / --session conventions: a subject dir holding
+    <subj>_T1_nu.nii.gz, or one session dir per visit holding <session>_T1_nu.nii.gz
+    :return: list of (subject dir, session dir, session) tuples, session None for cross-sectional subjects
+    """
+    entries = []
+    for name in sorted(os.listdir(in_dir)):
+        subj_dir = os.path.join(in_dir, name)
+        if not os.path.isdir(subj_dir):
+            continue
+        if os.path.exists(os.path.join(subj_dir, MODALITIES[0][1] % name)):
+            entries.append((subj_dir, subj_dir, None))
+            continue
+        # seg_icv finds the session dir with glob(subj/*session), so the full dir name is a unique session
+        for session in sorted(os.listdir(subj_dir)):
+            sess_dir = os.path.join(subj_dir, session)
+            if os.path.isdir(sess_dir) and os.path.exists(os.path.join(sess_dir, MODALITIES[0][1] % session)):
+                entries.append((subj_dir, sess_dir, session))
+
+    return entries
+
+
+def estimate_cost(sess_dir):
+    """
+    Estimated cost of segmenting a subject, from the header dimensions of its sequences
+    :return: (cost, T1 shape, modalities found)
+    """
+    name = os.path.basename(sess_dir)
+    cost = INFERENCE_COST
+    t1_shape, modalities = None, []
+
+    for modality, pattern in MODALITIES:
+        img = os.path.join(sess_dir, pattern % name)
+        if not os.path.exists(img):
+            continue
+        try:
+            shape = nib.load(img).header.get_data_shape()[:3]
+        except (OSError, nib.filebasedimages.ImageFileError):
+            print("\n could not read the header of %s, using the cost of a 256^3 volume" % img)
+            shape = (256, 256, 256)
+        cost += MVOX_COST * np.prod(shape) / 1e6
+        modalities.append(modality)
+        if modality == 'T1':
+            t1_shape = shape
+
+    return cost, t1_shape, modalities
+
+
+def balance_shards(costs, shards):
+    """
+    Longest processing time first: the costliest subjects go first, each to the least loaded shard
+    :return: shard of each subject
+    """
+    loads = [(0., shard) for shard in range(shards)]
+    assigned = [None] * len(costs)
+
+    for s in sorted(range(len(costs)), key=lambda s: -costs[s]):
+        load, shard = heapq.heappop(loads)
+        assigned[s] = shard
+        heapq.heappush(loads, (load + costs[s], shard))
+
+    return assigned
+
+
+def walltime(cost):
+    """
+    Walltime request of a shard: twice its estimated cost, rounded up to the hour
+    """
+    return '%02d:00:00' % max(1, math.ceil(2 * cost / 3600.))
+
+
+def write_manifests(df, out_dir, shards):
+    """
+    One manifest per shard, in the seg_icv --subjects format (subject dir, optional session)
+    """
+    for shard in range(shards):
+        rows = df[df['Shard'] == shard]
+        with open(os.path.join(out_dir, '%s.txt' % shard_name(shard)), 'w') as manifest:
+            manifest.write("# %s: %s subjects, estimated cost %.0f\n"
+                           % (shard_name(shard), len(rows), rows['Est_cost'].sum()))
+            for _, row in rows.iterrows():
+                manifest.write("%s %s\n" % (row['Subject_dir'], row['Session'])
+                               if isinstance(row['Session'], str) else "%s\n" % row['Subject_dir'])
+
+
+def write_array_script(out_dir, in_dir, shards, seg_args, cpus, mem_gb, max_cost):
+    script = os.path.join(out_dir, ARRAY_SCRIPT)
+    with open(script, 'w') as script_file:
+        script_file.write(ARRAY_TEMPLATE.format(plan_dir=shlex.quote(out_dir), script=shlex.quote(script),
+                                                in_dir=shlex.quote(in_dir), last=shards - 1, shards=shards,
+                                                cpus=cpus, mem_gb=mem_gb, walltime=walltime(max_cost),
+                                                seg_args=seg_args, pred_name=PRED_NAME))
+    os.chmod(script, 0o755)
+
+    return script
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, shards, out_dir, seg_args, skip_done, cpus, mem_gb = parse_inputs(parser, args)
+
+    entries = discover_subjects(in_dir)
+    if skip_done:
+        done = [entry for entry in entries if glob.glob(os.path.join(entry[1], '*%s' % PRED_NAME))]
+        print("\n leaving out %s subjects already segmented" % len(done))
+        entries = [entry for entry in entries if entry not in done]
+    if not entries:
+        sys.exit("no subjects found in %s" % in_dir)
+
+    rows = []
+    for subj_dir, sess_dir, session in entries:
+        cost, t1_shape, modalities = estimate_cost(sess_dir)
+        rows.append(dict(Subject=os.path.basename(subj_dir), Session=session, Subject_dir=subj_dir,
+                         T1_shape='x'.join(str(dim) for dim in t1_shape) if t1_shape else '',
+                         Modalities='+'.join(modalities), Est_cost=round(cost, 1)))
+    df = pd.DataFrame(rows)
+
+    if shards > len(df):
+        print("\n %s shards for %s subjects, using %s shards" % (shards, len(df), len(df)))
+        shards = len(df)
+    df['Shard'] = balance_shards(df['Est_cost'].tolist(), shards)
+
+    os.makedirs(os.path.join(out_dir, 'logs'), exist_ok=True)
+    df.to_csv(os.path.join(out_dir, PLAN_CSV), index=False)
+    write_manifests(df, out_dir, shards)
+
+    loads = df.groupby('Shard')['Est_cost'].sum()
+    script = write_array_script(out_dir, in_dir, shards, seg_args, cpus, mem_gb, loads.max())
+
+    print("\n %s subjects (%s sessions) in %s shards, estimated cost per shard %.0f - %.0f (imbalance %.2f)"
+          % (df['Subject'].nunique(), len(df), shards, loads.min(), loads.max(), loads.max() / loads.mean()))
+    print("\n plan saved to %s\n submit with: sbatch %s (or qsub), run locally with: icvmapper run_shards -p %s"
+          % (out_dir, script, out_dir))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import numpy as np
+import nibabel as nib
+from scipy import ndimage
+from icvmapper.preprocess import resampling
+
+# gaussian kernels are truncated at this many standard deviations
+TRUNCATE = 4.0
+
+
+def voxel_sizes(affine):
+    return np.sqrt(np.sum(affine[:3, :3] ** 2, axis=0))
+
+
+def fwhm_to_sigma(fwhm, affine):
+    """
+    Gaussian standard deviation in voxels for a fwhm in mm
+    """
+    return fwhm / np.sqrt(8 * np.log(2)) / voxel_sizes(affine)
+
+
+def bbox_slices(mask, margin):
+    """
+    Bounding box of a mask grown by a margin (voxels, per axis) and clipped to the volume
+    :return: tuple of slices, or None for an empty mask
+    """
+    # extent along each axis from the projection of the mask, rather than the coordinates of every voxel
+    extents = []
+    for ax in range(3):
+        nonzero = np.flatnonzero(np.any(mask, axis=tuple(other for other in range(3) if other != ax)))
+        if nonzero.size == 0:
+            return None
+        extents.append((nonzero[0], nonzero[-1]))
+
+    margin = np.broadcast_to(np.asarray(margin, dtype=int), (3,))
+    lo = np.maximum(np.array([extent[0] for extent in extents]) - margin, 0)
+    hi = np.minimum(np.array([extent[1] for extent in extents]) + margin + 1, mask.shape[:3])
+
+    return tuple(slice(l, h) for l, h in zip(lo, hi))
+
+
+def smooth_threshold(prob, affine, fwhm, thresh):
+    """
+    Gaussian smoothing (float32, separable) then thresholding, restricted to the bounding box of the voxels
+    above the threshold. Voxels further than the kernel radius from them can not cross the threshold after
+    smoothing, so the result matches smoothing the full volume.
+    :return: (boolean mask of the cropped region, slices of the region in the volume), slices None if empty
+    """
+    sigma = fwhm_to_sigma(fwhm, affine)
+    radius = np.ceil(TRUNCATE * sigma).astype(int)
+
+    slices = bbox_slices(prob > thresh, 2 * radius + 1)
+    if slices is None:
+        return None, None
+
+    crop = np.asarray(prob[slices], dtype=np.float32)
+    smoothed = ndimage.gaussian_filter(crop, sigma, truncate=TRUNCATE)
+
+    return smoothed > thresh, slices
+
+
+def largest_component(mask):
+    labels, n_labels = ndimage.label(mask)
+    if n_labels < 2:
+        return mask.astype(bool)
+
+    sizes = np.bincount(labels.ravel())
+    sizes[0] = 0
+
+    return labels == np.argmax(sizes)
+
+
+def clean_mask(mask):
+    """
+    Keep the largest connected component and fill its holes
+    """
+    return ndimage.binary_fill_holes(largest_component(mask))
+
+
+def paste(crop, slices, shape, dtype=np.uint8):
+    """
+    Put a cropped array back into a zero volume
+    """
+    out = np.zeros(shape[:3], dtype=dtype)
+    if slices is not None:
+        out[slices] = crop
+
+    return out
+
+
+def segment_prob(prob, affine, thresh, fwhm=3):
+    """
+    Binary segmentation from a native space probability map: smooth, threshold, largest component and hole
+    filling in a single pass over the bounding box of the segmentation
+    :return: uint8 mask
+    """
+    mask, slices = smooth_threshold(prob, affine, fwhm, thresh)
+    if slices is None:
+        return paste(None, None, prob.shape)
+
+    return paste(clean_mask(mask), slices, prob.shape)
+
+
+def _cells_class(labels):
+    """
+    Saturated class (0 or 1) shared by the 8 corners of each interpolation cell, -1 where they differ
+    """
+    lo, hi = labels[:-1, :-1, :-1].copy(), labels[:-1, :-1, :-1].copy()
+    for i in (0, 1):
+        for j in (0, 1):
+            for k in (0, 1):
+                corner = labels[i:labels.shape[0] - 1 + i, j:labels.shape[1] - 1 + j, k:labels.shape[2] - 1 + k]
+                np.minimum(lo, corner, out=lo)
+                np.maximum(hi, corner, out=hi)
+
+    return np.where(lo == hi, lo, -1).astype(np.int8)
+
+
+def _grow(mask):
+    """
+    Dilate a mask by one voxel along each axis (box neighbourhood), with shifted views
+    """
+    for ax in range(3):
+        grown = mask.copy()
+        lo = [slice(None)] * 3
+        hi = [slice(None)] * 3
+        lo[ax], hi[ax] = slice(None, -1), slice(1, None)
+        grown[tuple(lo)] |= mask[tuple(hi)]
+        grown[tuple(hi)] |= mask[tuple(lo)]
+        mask = grown
+
+    return mask
+
+
+def resample_band(prob_img, ref_img, eps=0.01, margin=0):
+    """
+    Linear resampling of a probability map onto a finer reference grid, interpolating only within a narrow band
+    around the boundary. Native voxels whose interpolation cell is saturated (all corners within eps of 0, or of 1)
+    are filled from the coarse label map, so they differ from a full linear resampling by at most eps
+    :param prob_img: probability map
+    :param ref_img: reference (native) image
+    :param eps: tolerance for a voxel to count as saturated
+    :param margin: coarse cells added around the band
+    :return: resampled probability map (float32), or None if the grids are not axis aligned
+    """
+    prob = np.asarray(prob_img.dataobj, dtype=np.float32)
+
+    tables = resampling.get_tables(prob.shape, prob_img.affine, ref_img.shape[:3], ref_img.affine, order=1)
+    if tables is None:
+        return None
+
+    labels = np.full(prob.shape[:3], -1, dtype=np.int8)
+    labels[prob <= eps] = 0
+    labels[prob >= 1 - eps] = 1
+
+    cells = _cells_class(labels)
+    band = cells < 0
+    for _ in range(margin):
+        band = _grow(band)
+    # fill values of the cells, nan where interpolation is needed, and a last zero cell for voxels outside the map
+    fill = np.pad(np.where(band, np.nan, cells).astype(np.float32), ((0, 1),) * 3, mode='constant')
+
+    out = np.zeros(ref_img.shape[:3], dtype=np.float32)
+    cell_box = bbox_slices(fill != 0, 0)
+    if cell_box is None:
+        return nib.Nifti1Image(out, ref_img.affine)
+
+    cell_idx, weights, native_box = [], [], []
+    for ax, (lower, _, weight, valid) in enumerate(tables):
+        ax_idx = np.where(valid > 0, lower, fill.shape[ax] - 1)
+
+        # native voxels falling in non-zero cells, the rest is saturated exterior
+        inside = np.flatnonzero((ax_idx >= cell_box[ax].start) & (ax_idx < cell_box[ax].stop))
+        if inside.size == 0:
+            return nib.Nifti1Image(out, ref_img.affine)
+        native_box.append(slice(inside[0], inside[-1] + 1))
+        cell_idx.append(ax_idx[native_box[ax]])
+        weights.append(weight[native_box[ax]])
+
+    # separable gather, one axis at a time
+    box = fill.take(cell_idx[0], axis=0).take(cell_idx[1], axis=1).take(cell_idx[2], axis=2)
+
+    # trilinear interpolation of the band voxels from their 8 corners
+    band_vox = np.unravel_index(np.flatnonzero(np.isnan(box)), box.shape)
+    corner = [cell_idx[ax][band_vox[ax]] for ax in range(3)]
+    frac = [weights[ax][band_vox[ax]] for ax in range(3)]
+    flat = prob.ravel()
+    base = (corner[0] * prob.shape[1] + corner[1]) * prob.shape[2] + corner[2]
+
+    def corner_value(i, j, k):
+        return flat[base + (i * prob.shape[1] + j) * prob.shape[2] + k]
+
+    def lerp(low, high, weight):
+        high -= low
+        high *= weight
+        high += low
+        return high
+
+    values = lerp(lerp(lerp(corner_value(0, 0, 0), corner_value(0, 0, 1), frac[2]),
+                       lerp(corner_value(0, 1, 0), corner_value(0, 1, 1), frac[2]), frac[1]),
+                  lerp(lerp(corner_value(1, 0, 0), corner_value(1, 0, 1), frac[2]),
+                       lerp(corner_value(1, 1, 0), corner_value(1, 1, 1), frac[2]), frac[1]), frac[0])
+    box[band_vox] = values
+    out[tuple(native_box)] = box
+
+    return nib.Nifti1Image(out, ref_img.affine)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import glob
+import logging
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from icvmapper.segment.plan import ARRAY_SCRIPT, shard_name
+
+# array task ids set by the schedulers, cleared so the array script takes the shard from its argument
+TASK_ID_VARS = ('SLURM_ARRAY_TASK_ID', 'PBS_ARRAY_INDEX', 'SGE_TASK_ID')
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s -p [ plan_dir ] \n\n"
+                                           "Run the shards of a plan as local processes, without a scheduler")
+
+    required = parser.add_argument_group('required arguments')
+
+    required.add_argument('-p', '--plan_dir', type=str, required=True, metavar='', help="plan dir (icvmapper plan)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-j', '--jobs', type=int, metavar='', default=1,
+                          help="shards run concurrently (default: %(default)s)")
+    optional.add_argument('-s', '--shards', type=int, metavar='', nargs='+', default=None,
+                          help="shards to run (default: all)")
+    optional.add_argument('-nm', '--no_merge', action='store_true',
+                          help="do not merge the shard outputs once they are done")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    plan_dir = os.path.abspath(args.plan_dir)
+    script = os.path.join(plan_dir, ARRAY_SCRIPT)
+    assert os.path.exists(script), "%s does not exist ... please run icvmapper plan first" % script
+
+    return plan_dir, script, max(1, args.jobs), args.shards, args.no_merge
+
+
+def plan_shards(plan_dir):
+    """
+    Shards of a plan, from its manifests
+    """
+    manifests = sorted(glob.glob(os.path.join(plan_dir, 'shard_[0-9][0-9][0-9].txt')))
+
+    return [int(os.path.basename(manifest)[len('shard_'):-len('.txt')]) for manifest in manifests]
+
+
+def run_shard(script, shard):
+    """
+    Run the array script of a plan for one shard, as a scheduler would run its array task
+    :return: (shard, exit code, sec)
+    """
+    env = dict((name, value) for name, value in os.environ.items() if name not in TASK_ID_VARS)
+    start = time.time()
+    print("\n %s started" % shard_name(shard))
+    result = subprocess.run(['bash', script, str(shard)], env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.STDOUT)
+
+    return shard, result.returncode, time.time() - start
+
+
+def main(args):
+    parser = parsefn()
+    plan_dir, script, jobs, shards, no_merge = parse_inputs(parser, args)
+
+    shards = shards if shards is not None else plan_shards(plan_dir)
+    print("\n running %s shards of %s, %s at a time" % (len(shards), plan_dir, jobs))
+
+    failed = []
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        for shard, returncode, sec in pool.map(lambda shard: run_shard(script, shard), shards):
+            msg = "%s %s in %.1f sec" % (shard_name(shard), "done" if returncode == 0 else
+                                         "failed (exit %s)" % returncode, sec)
+            print("\n %s, log: %s" % (msg, os.path.join(plan_dir, 'logs', '%s.log' % shard_name(shard))))
+            logging.getLogger('interface').info(msg)
+            if returncode != 0:
+                failed.append(shard)
+
+    print("\n %s shards in %.1f sec, %s failed" % (len(shards), time.time() - start, len(failed)))
+
+    if not no_merge:
+        from icvmapper.segment import merge_shards
+        merge_shards.main(['-p', plan_dir])
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
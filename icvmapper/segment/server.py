@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import itertools
+import json
+import logging
+import os
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from pathlib import Path
+
+from icvmapper.utils.memory import memory_usage, system_memory
+
+# seg_icv arguments holding paths, made absolute by the client since the server runs elsewhere
+PATH_ARGS = ('subj', 't1w', 'flair', 't2w', 'out', 'cache_dir')
+
+
+def default_socket():
+    return os.path.join(os.environ.get('XDG_RUNTIME_DIR', tempfile.gettempdir()), 'icvmapper.sock')
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s [ -so socket ] \n\n"
+                                           "Serve seg_icv jobs from a local daemon keeping the models warm")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-so', '--socket', type=str, metavar='', default=default_socket(),
+                          help="unix socket to listen on (default: %(default)s)")
+    optional.add_argument('-m', '--models_dir', type=str, metavar='', default=None,
+                          help="dir of the models kept warm (default: icvmapper models dir)")
+    optional.add_argument('-mb', '--mem_budget', type=float, metavar='', default=None,
+                          help="memory budget of the running jobs in GB (default: 80%% of the node memory)")
+    optional.add_argument('-jm', '--job_mem', type=float, metavar='', default=4.,
+                          help="memory reserved per job in GB (default: %(default)s)")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    models_dir = args.models_dir if args.models_dir else os.path.join(Path(os.path.realpath(__file__)).parents[2],
+                                                                      'models')
+    mem_budget = args.mem_budget
+    if mem_budget is None:
+        mem = system_memory()
+        mem_budget = 0.8 * mem['total'] / 1024. if mem is not None else 16.
+
+    if args.job_mem > mem_budget:
+        parser.error("job memory (-jm) is above the memory budget (-mb)")
+
+    return args.socket, models_dir, mem_budget, args.job_mem
+
+
+class MemoryBudget(object):
+    """
+    Admission control: a job starts once its memory reservation fits in the budget and in the memory still
+    available on the node
+    """
+    def __init__(self, budget_gb):
+        self.budget = budget_gb
+        self.reserved = 0.
+        self.running = 0
+        self.waiting = 0
+        self.cond = threading.Condition()
+
+    def fits(self, job_gb):
+        if self.reserved + job_gb > self.budget:
+            return False
+        mem = system_memory()
+        # the first job is always admitted, other processes may hold the rest of the node
+        return self.running == 0 or mem is None or mem['available'] / 1024. >= job_gb
+
+    def acquire(self, job_gb, on_wait=None):
+        """
+        Block until a job fits
+        :param on_wait: called with the number of jobs waiting ahead if the job has to wait
+        """
+        with self.cond:
+            if self.fits(job_gb):
+                self.reserved += job_gb
+                self.running += 1
+                return
+            ahead = self.waiting
+            self.waiting += 1
+
+        # on_wait talks to the client, outside the lock so a slow client does not hold up the other jobs
+        if on_wait is not None:
+            try:
+                on_wait(ahead)
+            except Exception:
+                with self.cond:
+                    self.waiting -= 1
+                raise
+
+        with self.cond:
+            # available memory changes outside the server, so check it again from time to time
+            while not self.fits(job_gb):
+                self.cond.wait(timeout=5)
+            self.waiting -= 1
+            self.reserved += job_gb
+            self.running += 1
+
+    def release(self, job_gb):
+        with self.cond:
+            self.reserved -= job_gb
+            self.running -= 1
+            self.cond.notify_all()
+
+
+def warm_models(models_dir):
+    """
+    Build every model of a dir and its predict functions, so jobs start on warm models
+    """
+    from icvmapper.deep import predict
+    from icvmapper.deep.freeze import model_pairs
+
+    for model_json, model_weights in model_pairs(models_dir):
+        print("\n warming up %s" % os.path.basename(model_weights))
+        model = predict.get_model(model_json, model_weights)
+        model._make_predict_function()
+        split = predict.get_split_model(model_json, model_weights)
+        if split is not None:
+            split[0]._make_predict_function()
+            split[1]._make_predict_function()
+
+
+class JobHandler(socketserver.StreamRequestHandler):
+    """
+    One connection, one job: a json line with the seg_icv arguments in, json status lines out
+    """
+    def send(self, **msg):
+        self.wfile.write((json.dumps(msg) + '\n').encode())
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            job = json.loads(self.rfile.readline().decode())
+        except ValueError:
+            self.send(status='failed', error='malformed job')
+            return
+
+        try:
+            self.server.run_job(job, self.send)
+        except (BrokenPipeError, ConnectionResetError):
+            print("\n client of job %s disconnected" % job.get('args', {}).get('subj'))
+
+
+class SegServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    seg_icv jobs run in their own threads on the warm models of the process: pre- and post-processing
+    run concurrently, inference one job at a time
+    """
+    daemon_threads = True
+
+    def __init__(self, socket_path, mem_budget, job_mem):
+        self.budget = MemoryBudget(mem_budget)
+        self.job_mem = job_mem
+        self.inference_lock = threading.Lock()
+        self.job_ids = itertools.count(1)
+        self.jobs = 0
+        socketserver.UnixStreamServer.__init__(self, socket_path, JobHandler)
+
+    def run_job(self, job, send):
+        job_id = next(self.job_ids)
+        self.jobs = max(self.jobs, job_id)
+        start = time.time()
+
+        self.budget.acquire(self.job_mem, on_wait=lambda ahead: send(status='queued', job=job_id, ahead=ahead,
+                                                                   reserved_gb=self.budget.reserved,
+                                                                   budget_gb=self.budget.budget))
+        try:
+            send(status='admitted', job=job_id, wait_sec=round(time.time() - start, 1))
+            run_segmentation(argparse.Namespace(**job['args']), self.inference_lock, send, job_id=job_id,
+                             times=dict(wait=time.time() - start))
+        finally:
+            self.budget.release(self.job_mem)
+
+
+def run_segmentation(args, inference_lock, send, job_id=None, times=None):
+    """
+    Segment one subject stage by stage, the inference stage under a lock shared by the jobs of the process
+    :param args: seg_icv arguments
+    :param send: called with the status messages of the job (keyword arguments)
+    :param times: timings so far (sec), e.g. time spent waiting for admission
+    :return: final status: done, skipped or failed
+    """
+    from icvmapper.segment import icvmapper
+
+    times = dict(times) if times else {}
+    start = time.time() - times.get('wait', 0.)
+    try:
+        ctx = icvmapper.setup_subject(icvmapper.parsefn(), args)
+        if ctx is None:
+            send(status='skipped', job=job_id, error="segmentation already exists, use -f to overwrite")
+            return 'skipped'
+
+        for name, stage in (('preprocess', icvmapper.preprocess_subject),
+                            ('predict', icvmapper.predict_subject),
+                            ('postprocess', icvmapper.postprocess_subject)):
+            stage_start = time.time()
+            if name == 'predict':
+                with inference_lock:
+                    times['inference_wait'] = time.time() - stage_start
+                    stage_start = time.time()
+                    stage(ctx)
+            else:
+                stage(ctx)
+            times[name] = time.time() - stage_start
+            send(status='stage', job=job_id, stage=name, sec=round(times[name], 1))
+
+        times['total'] = time.time() - start
+        send(status='done', job=job_id, prediction=ctx['prediction'],
+             times=dict((name, round(sec, 1)) for name, sec in times.items()))
+        logging.getLogger('interface').info("job %s %s done in %.1f sec" % (job_id, ctx['subj'], times['total']))
+
+        return 'done'
+
+    except (Exception, SystemExit) as err:
+        traceback.print_exc()
+        send(status='failed', job=job_id, error=str(err))
+        logging.getLogger('interface').info("job %s failed: %s" % (job_id, err))
+
+        return 'failed'
+
+
+def print_status(msg):
+    """
+    Print a job status message
+    """
+    status = msg['status']
+    if status == 'queued':
+        print("\n job %s queued behind %s jobs (%.1f / %.1f GB reserved)"
+              % (msg['job'], msg['ahead'], msg['reserved_gb'], msg['budget_gb']))
+    elif status == 'admitted':
+        print("\n job %s admitted after %.1f sec" % (msg['job'], msg['wait_sec']))
+    elif status == 'stage':
+        print("\n %s done in %.1f sec" % (msg['stage'], msg['sec']))
+    elif status == 'done':
+        print("\n segmentation saved to %s\n timings (sec): %s"
+              % (msg['prediction'], ', '.join('%s %s' % item for item in msg['times'].items())))
+    else:
+        print("\n job %s: %s" % (status, msg.get('error', '')))
+
+
+def submit(socket_path, args):
+    """
+    Send a seg_icv job to a server and print its status as it streams back
+    :param args: seg_icv arguments
+    :return: True if the job succeeded (or was skipped)
+    """
+    job_args = dict((name, value) for name, value in vars(args).items() if name not in ('server', 'func'))
+    for name in PATH_ARGS:
+        if job_args.get(name):
+            job_args[name] = os.path.abspath(job_args[name])
+
+    status = None
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        with sock.makefile('rwb') as stream:
+            stream.write((json.dumps({'args': job_args}) + '\n').encode())
+            stream.flush()
+
+            for line in stream:
+                msg = json.loads(line.decode())
+                status = msg['status']
+                print_status(msg)
+
+    return status in ('done', 'skipped')
+
+
+def main(args):
+    parser = parsefn()
+    socket_path, models_dir, mem_budget, job_mem = parse_inputs(parser, args)
+
+    if os.path.exists(socket_path):
+        # a socket left by a server that did not shut down cleanly
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            if sock.connect_ex(socket_path) == 0:
+                sys.exit("a server is already listening on %s" % socket_path)
+        os.remove(socket_path)
+
+    warm_models(models_dir)
+    mem = memory_usage()
+
+    server = SegServer(socket_path, mem_budget, job_mem)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    msg = "serving on %s: %.1f GB budget, %.1f GB per job (up to %s concurrent jobs)%s" \
+          % (socket_path, mem_budget, job_mem, int(mem_budget // job_mem),
+             ", warm models RSS %.0f MB" % mem['rss'] if mem is not None else "")
+    print("\n %s" % msg)
+    logging.getLogger('interface').info(msg)
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        print("\n server stopped after %s jobs" % server.jobs)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+# PYTHON_ARGCOMPLETE_OK
+# coding: utf-8
+
+import argparse
+import argcomplete
+import hashlib
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+NIFTI_EXTS = ('.nii.gz', '.nii')
+ANALYZE_EXT = '.img'
+
+# segmentation mask summarized by stats_icv, as named by seg_icv
+PRED_NAME = 'T1acq_nu_HfB_pred.nii.gz'
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s [ in_dir ] -o [ out_dir ] \n\n"
+                                           "Watch a dir and segment the scans dropped into it")
+
+    parser.add_argument('in_dir', type=str, help="incoming dir (NIfTI or Analyze files)")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-o', '--out_dir', type=str, metavar='', default=None,
+                          help="subjects dir, one subject per scan (default: in_dir/subjects)")
+    optional.add_argument('-c', '--concurrency', type=int, metavar='', default=2,
+                          help="scans processed concurrently, inference runs one at a time (default: %(default)s)")
+    optional.add_argument('-st', '--stable', type=float, metavar='', default=10.,
+                          help="seconds a file must keep the same size before it is processed (default: %(default)s)")
+    optional.add_argument('-p', '--poll', type=float, metavar='', default=5.,
+                          help="seconds between scans of the incoming dir (default: %(default)s)")
+    optional.add_argument('-a', '--seg_args', type=str, metavar='', default='',
+                          help="extra seg_icv arguments, e.g. \"-b -n 20\"")
+    optional.add_argument('-sv', '--server', type=str, metavar='',
+                          help="submit the scans to an 'icvmapper serve' daemon instead of segmenting them here")
+    optional.add_argument('-rf', '--retry_failed', action='store_true',
+                          help="segment again the scans that failed in an earlier run (default: skip them)")
+    optional.add_argument('-1', '--once', action='store_true',
+                          help="process the files already in the dir and exit")
+
+    return parser
+
+
+def parse_inputs(parser, args):
+    if isinstance(args, list):
+        args = parser.parse_args(args)
+    argcomplete.autocomplete(parser)
+
+    in_dir = os.path.abspath(args.in_dir)
+    assert os.path.isdir(in_dir), "%s does not exist ... please check path and rerun script" % in_dir
+    out_dir = os.path.abspath(args.out_dir) if args.out_dir else os.path.join(in_dir, 'subjects')
+
+    return in_dir, out_dir, max(1, args.concurrency), args.stable, args.poll, shlex.split(args.seg_args), \
+        args.server, args.retry_failed, args.once
+
+
+def scan_stem(path):
+    name = os.path.basename(path)
+    for ext in NIFTI_EXTS + (ANALYZE_EXT,):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return None
+
+
+def scan_files(path):
+    """
+    Files making up a scan: the image, and its header for Analyze
+    """
+    return [path, path[:-len(ANALYZE_EXT)] + '.hdr'] if path.endswith(ANALYZE_EXT) else [path]
+
+
+def list_scans(in_dir):
+    """
+    Complete-looking scans of the incoming dir (Analyze images need their header)
+    """
+    scans = []
+    for name in sorted(os.listdir(in_dir)):
+        path = os.path.join(in_dir, name)
+        if os.path.isfile(path) and scan_stem(path) and all(os.path.exists(f) for f in scan_files(path)):
+            scans.append(path)
+
+    return scans
+
+
+def scan_signature(path):
+    try:
+        return tuple((os.path.getsize(f), os.path.getmtime(f)) for f in scan_files(path))
+    except OSError:
+        return None
+
+
+def content_hash(path):
+    sha = hashlib.sha1()
+    for scan_file in scan_files(path):
+        with open(scan_file, 'rb') as in_file:
+            for block in iter(lambda: in_file.read(1 << 20), b''):
+                sha.update(block)
+
+    return sha.hexdigest()
+
+
+def _inotify():
+    """
+    inotify watcher waking the loop up when a file is written or moved in, None where inotify_simple is missing
+    """
+    try:
+        import inotify_simple
+    except ImportError:
+        return None
+
+    return inotify_simple
+
+
+class Watcher(object):
+    """
+    Detect new scans in a dir once their size is stable, skip the ones whose content was already segmented
+    (or is being segmented), and segment the rest with a bounded number of concurrent jobs
+    """
+    def __init__(self, in_dir, out_dir, concurrency=2, stable=10., seg_args=(), server=None, retry_failed=False):
+        self.in_dir, self.out_dir = in_dir, out_dir
+        self.stable, self.seg_args, self.server = stable, list(seg_args), server
+        self.retry_failed = retry_failed
+
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+        self.inference_lock = threading.Lock()
+        self.stats_lock = threading.Lock()
+        self.state_lock = threading.Lock()
+
+        # files seen with a given signature, candidates waiting for their size to settle
+        self.seen, self.settling = {}, {}
+        self.futures = []
+
+        os.makedirs(out_dir, exist_ok=True)
+        self.state_file = os.path.join(out_dir, '.watch_state.json')
+        self.state = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, 'r') as state_file:
+                self.state = json.load(state_file)
+
+        # scans queued or running when an earlier watcher stopped are segmented again once they are seen
+        for entry in self.state.values():
+            if entry['status'] in ('queued', 'running'):
+                print("\n %s was %s when the watcher stopped, requeueing it" % (entry['scan'], entry['status']))
+                entry['status'] = 'interrupted'
+
+    def save_state(self):
+        tmp_file = '%s.tmp' % self.state_file
+        with open(tmp_file, 'w') as state_file:
+            json.dump(self.state, state_file, indent=1)
+        os.replace(tmp_file, self.state_file)
+
+    def poll(self):
+        """
+        Check the incoming dir once and submit the scans that settled
+        :return: number of scans submitted
+        """
+        now = time.time()
+        submitted = 0
+
+        for path in list_scans(self.in_dir):
+            signature = scan_signature(path)
+            if signature is None or self.seen.get(path) == signature:
+                continue
+
+            # debounce: the file must keep the same size and mtime for self.stable seconds
+            if path not in self.settling or self.settling[path][0] != signature:
+                self.settling[path] = (signature, now)
+                continue
+            if now - self.settling[path][1] < self.stable:
+                continue
+
+            del self.settling[path]
+            self.seen[path] = signature
+
+            digest = content_hash(path)
+            with self.state_lock:
+                if digest in self.state and not self.resubmit(self.state[digest]):
+                    print("\n %s has the content of %s (%s), skipping"
+                          % (os.path.basename(path), self.state[digest]['scan'], self.state[digest]['status']))
+                    continue
+                self.state.setdefault(digest, {}).update(scan=os.path.basename(path), status='queued',
+                                                         time=datetime.now().isoformat())
+                self.save_state()
+
+            self.futures.append(self.pool.submit(self.ingest, path, digest))
+            submitted += 1
+
+        self.futures = [future for future in self.futures if not future.done()]
+
+        return submitted
+
+    def resubmit(self, entry):
+        """
+        Whether a scan whose content is already in the state is segmented again: interrupted scans are, failed
+        ones with --retry_failed
+        """
+        return entry['status'] == 'interrupted' or (entry['status'] == 'failed' and self.retry_failed)
+
+    def subject_dir(self, path, digest):
+        # a scan segmented again goes back to its own subject dir
+        if self.state[digest].get('subj_dir'):
+            return self.state[digest]['subj_dir']
+
+        stem = scan_stem(path)
+        subj_dir = os.path.join(self.out_dir, stem)
+        # a different scan exported under the same name
+        if os.path.exists(subj_dir) and any(entry.get('subj_dir') == subj_dir for entry in self.state.values()):
+            subj_dir = os.path.join(self.out_dir, '%s_%s' % (stem, digest[:8]))
+
+        return subj_dir
+
+    def ingest(self, path, digest):
+        """
+        Convert (Analyze) or copy a scan into its own subject dir, segment it and update the volumes summary
+        """
+        from icvmapper.segment import icvmapper, server
+
+        start = time.time()
+        with self.state_lock:
+            subj_dir = self.subject_dir(path, digest)
+            self.state[digest].update(subj_dir=subj_dir, status='running')
+            self.save_state()
+
+        subj = os.path.basename(subj_dir)
+        os.makedirs(subj_dir, exist_ok=True)
+        print("\n ingesting %s as %s" % (os.path.basename(path), subj))
+
+        try:
+            if path.endswith(ANALYZE_EXT):
+                from icvmapper.convert import filetype
+                t1 = os.path.join(subj_dir, '%s_T1.nii.gz' % subj)
+                filetype.main(['-i', path, '-o', t1])
+            else:
+                ext = next(ext for ext in NIFTI_EXTS if path.endswith(ext))
+                t1 = os.path.join(subj_dir, '%s_T1%s' % (subj, ext))
+                shutil.copy(path, t1)
+
+            seg_args = icvmapper.parsefn().parse_args(['-t1', t1] + self.seg_args)
+            if self.server:
+                ok = server.submit(self.server, seg_args)
+            else:
+                ok = server.run_segmentation(seg_args, self.inference_lock, lambda **msg: server.print_status(msg),
+                                             job_id=subj) != 'failed'
+            status = 'done' if ok else 'failed'
+        except (Exception, SystemExit) as err:
+            print("\n %s failed: %s" % (subj, err))
+            status = 'failed'
+
+        if status == 'done':
+            self.update_stats()
+
+        with self.state_lock:
+            self.state[digest].update(status=status, runtime_sec=round(time.time() - start, 1))
+            self.save_state()
+
+        msg = "%s: %s in %.1f sec" % (os.path.basename(path), status, time.time() - start)
+        print("\n %s" % msg)
+        logging.getLogger('interface').info(msg)
+
+    def update_stats(self):
+        from icvmapper.stats import summary_icv_vols
+
+        with self.stats_lock:
+            summary_icv_vols.main(['-i', self.out_dir, '-o', os.path.join(self.out_dir, 'icv_volumes.csv'),
+                                   '-m', PRED_NAME])
+
+    def wait(self):
+        for future in list(self.futures):
+            future.result()
+        self.pool.shutdown()
+
+
+def main(args):
+    parser = parsefn()
+    in_dir, out_dir, concurrency, stable, poll, seg_args, server, retry_failed, once = parse_inputs(parser, args)
+
+    watcher = Watcher(in_dir, out_dir, concurrency=concurrency, stable=0. if once else stable, seg_args=seg_args,
+                      server=server, retry_failed=retry_failed)
+
+    if once:
+        # two polls: the first records the files, the second submits them
+        watcher.poll()
+        watcher.poll()
+        watcher.wait()
+        return
+
+    inotify_simple = _inotify()
+    inotify = None
+    if inotify_simple is not None:
+        inotify = inotify_simple.INotify()
+        inotify.add_watch(in_dir, inotify_simple.flags.CLOSE_WRITE | inotify_simple.flags.MOVED_TO)
+
+    print("\n watching %s (%s), segmenting into %s with %s concurrent jobs"
+          % (in_dir, "inotify" if inotify else "polling every %s sec" % poll, out_dir, concurrency))
+
+    try:
+        while True:
+            watcher.poll()
+            if inotify is not None:
+                # wakes up on new files, still polls so settling files get their stability check
+                inotify.read(timeout=int(poll * 1000))
+            else:
+                time.sleep(poll)
+    except KeyboardInterrupt:
+        print("\n waiting for the running jobs")
+        watcher.wait()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -24,6 +24,11 @@ def parsefn():
     required.add_argument('-m', '--mask', type = str, metavar = '',
                           help='mask name ex: icv_pred.nii.gz', default='icv_pred.nii.gz')
 
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-sl', '--subjects', type=str, metavar='',
+                          help='only summarize the subjects of a seg_icv --subjects list (e.g. a plan shard manifest)')
+
     return parser
 
 
@@ -35,18 +40,39 @@ def parse_inputs(parser, args):
     input_dir = args.in_dir
     out_csv = args.out_csv
     mask_name = args.mask
+    subjects = args.subjects
+
+    return input_dir, out_csv, mask_name, subjects
+
+
+def listed_dirs(input_dir, subjects):
+    """
+    Subject (or session) dirs of a subjects list, relative to input_dir
+    """
+    from icvmapper.segment.cohort import read_subjects
+
+    subjs_dirs = []
+    for subj_dir, session in read_subjects(subjects):
+        subj_dir = os.path.join(input_dir, subj_dir)
+        if session:
+            matches = glob.glob(os.path.join(subj_dir, '*%s' % session))
+            subj_dir = matches[0] if matches else os.path.join(subj_dir, session)
+        subjs_dirs.append(os.path.relpath(subj_dir, input_dir))
 
-    return input_dir, out_csv, mask_name
+    return subjs_dirs
 
 
 def main(args):
     parser = parsefn()
-    input_dir, out_csv, mask_name = parse_inputs(parser, args)
+    input_dir, out_csv, mask_name, subjects = parse_inputs(parser, args)
 
     icv_label = [1]
     icv_abb = ['ICV']
 
-    subjs_dirs = [subj for subj in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, subj))]
+    if subjects:
+        subjs_dirs = listed_dirs(input_dir, subjects)
+    else:
+        subjs_dirs = [subj for subj in os.listdir(input_dir) if os.path.isdir(os.path.join(input_dir, subj))]
     index = []
     my_index = []
     volume = np.zeros([len(subjs_dirs), len(icv_abb)])
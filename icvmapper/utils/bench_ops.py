@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import sys
+import time
+
+import nibabel as nib
+import numpy as np
+from scipy import ndimage
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s [ -s X Y Z ] \n\n"
+                                           "Time the fused in-memory image operations against the multi-pass "
+                                           "operations they replace, on a synthetic volume")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-s', '--shape', type=int, metavar='', nargs=3, default=[180, 220, 200],
+                          help="volume shape (default: %(default)s)")
+    optional.add_argument('-r', '--runs', type=int, metavar='', default=5,
+                          help="runs per operation, the fastest is kept (default: %(default)s)")
+    optional.add_argument('-c', '--cutoff', type=float, metavar='', default=5.,
+                          help="clipping percentile (default: %(default)s)")
+
+    return parser
+
+
+def synthetic_t1(shape, seed=0):
+    """
+    Integer T1-like volume: a bright ellipsoid with noise on a dark background
+    """
+    rng = np.random.RandomState(seed)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    dist = sum(((g - n / 2.) / (0.4 * n)) ** 2 for g, n in zip(grid, shape))
+    data = np.where(dist < 1, 600., 40.) + rng.normal(0, 30., shape)
+
+    return nib.Nifti1Image(np.clip(data, 0, None).astype(np.int16), np.eye(4))
+
+
+def clip_standardize_multipass(img, cutoff_percents):
+    """
+    Clipping and standardization as done before they were fused (percentile clip on a copy, then standardize)
+    """
+    data = np.asanyarray(img.dataobj)
+    cutoff_low = np.percentile(data, cutoff_percents)
+    cutoff_high = np.percentile(data, 100 - cutoff_percents)
+    new_data = data.copy()
+    new_data[new_data > cutoff_high] = cutoff_high
+    new_data[new_data < cutoff_low] = cutoff_low
+
+    return (new_data - new_data.mean()) / new_data.std()
+
+
+def smooth_threshold_full(prob, sigma, thresh):
+    """
+    Gaussian smoothing of the full volume (float64, like nilearn smooth_img) then thresholding, as done before
+    the cropped post-processing
+    """
+    from icvmapper.segment.postproc import TRUNCATE
+
+    return ndimage.gaussian_filter(prob.astype(np.float64), sigma, truncate=TRUNCATE) > thresh
+
+
+def best_time(fn, runs):
+    times = []
+    for _ in range(max(1, runs)):
+        start = time.perf_counter()
+        out = fn()
+        times.append(time.perf_counter() - start)
+
+    return min(times), out
+
+
+def main(args):
+    from icvmapper.preprocess import imgops
+    from icvmapper.segment import postproc
+
+    parser = parsefn()
+    args = parser.parse_args(args)
+    shape = tuple(args.shape)
+
+    img = synthetic_t1(shape)
+    print("\n %s volume, best of %s runs" % ('x'.join(str(n) for n in shape), args.runs))
+
+    old_sec, old = best_time(lambda: clip_standardize_multipass(img, args.cutoff), args.runs)
+    new_sec, new = best_time(lambda: np.asanyarray(imgops.clip_standardize(img, args.cutoff).dataobj), args.runs)
+    print("\n clip + standardize: %.3f s multi-pass, %.3f s fused (%.1fx), max abs difference %.1e"
+          % (old_sec, new_sec, old_sec / new_sec, np.abs(old - new).max()))
+
+    # probability map of the ellipsoid, the brain covering a fraction of the volume as in a head scan
+    prob = ndimage.gaussian_filter((np.asanyarray(img.dataobj) > 300).astype(np.float32), 2.)
+    fwhm, thresh = 2., 0.5
+    sigma = postproc.fwhm_to_sigma(fwhm, img.affine)
+
+    old_sec, old = best_time(lambda: smooth_threshold_full(prob, sigma, thresh), args.runs)
+    new_sec, (crop, slices) = best_time(lambda: postproc.smooth_threshold(prob, img.affine, fwhm, thresh),
+                                        args.runs)
+    new = postproc.paste(crop, slices, prob.shape, dtype=bool)
+    print("\n smooth + threshold: %.3f s full volume, %.3f s cropped (%.1fx), %s voxels differ"
+          % (old_sec, new_sec, old_sec / new_sec, np.count_nonzero(old != new)))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
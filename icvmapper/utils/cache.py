@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+import json
+import shutil
+import hashlib
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# content hashes of files already read by this process, keyed by (path, size, mtime)
+_FILE_HASHES = {}
+_LOCK = threading.Lock()
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """
+    sha1 of a file's content, computed once per process for an unchanged file
+    """
+    stat = os.stat(path)
+    memo_key = (os.path.abspath(path), stat.st_size, stat.st_mtime)
+
+    if memo_key not in _FILE_HASHES:
+        sha = hashlib.sha1()
+        with open(path, 'rb') as in_file:
+            for chunk in iter(lambda: in_file.read(chunk_size), b''):
+                sha.update(chunk)
+        _FILE_HASHES[memo_key] = sha.hexdigest()
+
+    return _FILE_HASHES[memo_key]
+
+
+def array_hash(array):
+    """
+    sha1 of an array's shape, type and values
+    """
+    array = np.ascontiguousarray(array)
+    sha = hashlib.sha1()
+    sha.update(str((array.shape, array.dtype.str)).encode())
+    sha.update(array.data)
+
+    return sha.hexdigest()
+
+
+def default_cache_dir():
+    return os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'icvmapper', 'stages')
+
+
+class StageCache(object):
+    """
+    Content-addressed cache of pipeline stage outputs. A stage is looked up by a key built from the hashes of its
+    inputs and its parameters, and its output files are stored under that key. Entries are evicted least recently
+    used first once the cache grows past max_size_gb. The cache dir can be shared by the threads and processes of
+    concurrent runs: entries are written under a temporary name and renamed into place under a lock file.
+    """
+    def __init__(self, cache_dir, max_size_gb=5., refresh=False):
+        """
+        :param refresh: never fetch, only store (e.g. forced reruns, which must draw new MC Dropout samples)
+        """
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        self.refresh = refresh
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self.lock_file = os.path.join(self.cache_dir, '.lock')
+
+    @contextmanager
+    def _lock(self):
+        """
+        Exclusive access to the cache dir, across the threads of this process and across processes (where fcntl
+        is available)
+        """
+        with _LOCK:
+            if fcntl is None:
+                yield
+                return
+            with open(self.lock_file, 'a') as lock:
+                fcntl.lockf(lock, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.lockf(lock, fcntl.LOCK_UN)
+
+    @staticmethod
+    def key(stage, files=(), arrays=(), **params):
+        """
+        Key of a stage
+        :param stage: stage name
+        :param files: input files (hashed by content)
+        :param arrays: input arrays (hashed by value)
+        :param params: stage parameters (must be json serializable)
+        """
+        sha = hashlib.sha1(stage.encode())
+        for path in files:
+            sha.update(file_hash(path).encode())
+        for array in arrays:
+            sha.update(array_hash(array).encode())
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode())
+
+        return '%s-%s' % (stage, sha.hexdigest())
+
+    def _entry(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def fetch(self, key, outputs):
+        """
+        Copy the cached outputs of a stage into place
+        :param key: stage key
+        :param outputs: dict of output name: destination file
+        :return: True on a cache hit
+        """
+        if self.refresh:
+            return False
+
+        entry = self._entry(key)
+        if not all(os.path.exists(os.path.join(entry, name)) for name in outputs):
+            return False
+
+        try:
+            for name, out_file in outputs.items():
+                shutil.copyfile(os.path.join(entry, name), out_file)
+            # mark as recently used
+            os.utime(entry, None)
+        except OSError:
+            # replaced or evicted by another run meanwhile
+            return False
+
+        return True
+
+    def store(self, key, outputs):
+        """
+        Add the outputs of a stage to the cache
+        :param key: stage key
+        :param outputs: dict of output name: produced file
+        """
+        entry = self._entry(key)
+        tmp_entry = "%s.tmp-%s-%s" % (entry, os.getpid(), threading.get_ident())
+        os.makedirs(tmp_entry, exist_ok=True)
+
+        for name, in_file in outputs.items():
+            shutil.copyfile(in_file, os.path.join(tmp_entry, name))
+
+        with self._lock():
+            if os.path.exists(entry):
+                # moved aside first, so the entry is never seen half removed
+                old_entry = "%s.old" % tmp_entry
+                os.rename(entry, old_entry)
+                shutil.rmtree(old_entry, ignore_errors=True)
+            os.rename(tmp_entry, entry)
+            self.evict()
+
+    def size(self):
+        return sum(os.path.getsize(os.path.join(root, name))
+                   for root, _, names in os.walk(self.cache_dir) for name in names)
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits its size budget, call with the lock held
+        """
+        entries = []
+        for key in os.listdir(self.cache_dir):
+            entry = self._entry(key)
+            if '.tmp-' in key or not os.path.isdir(entry):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(entry, name)) for name in os.listdir(entry))
+                entries.append((os.path.getmtime(entry), size, entry))
+            except OSError:
+                # removed meanwhile by a run that does not share the lock (e.g. fcntl missing)
+                continue
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
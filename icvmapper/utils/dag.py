@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+class TaskGraph(object):
+    """
+    Small dependency-aware executor: every task is submitted to a thread pool as soon as the tasks it depends on
+    are done. The first failure stops new submissions and is re-raised once the running tasks finish.
+    """
+    def __init__(self, max_workers=2):
+        self.max_workers = max(1, max_workers)
+        self.tasks = OrderedDict()
+        self.times = {}
+
+    def add(self, name, fn, *args, deps=(), **kwargs):
+        """
+        Add a task
+        :param name: task name
+        :param fn: function run by the task
+        :param deps: names of the tasks that must be done first
+        """
+        missing = [dep for dep in deps if dep not in self.tasks]
+        if missing:
+            raise ValueError("task %s depends on unknown tasks %s" % (name, missing))
+        self.tasks[name] = (fn, args, kwargs, tuple(deps))
+
+    def run(self):
+        """
+        Run every task
+        :return: dict of task name: result
+        """
+        results, running = {}, {}
+        pending = OrderedDict(self.tasks)
+        error = None
+
+        def timed(name, fn, args, kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.times[name] = time.time() - start
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if error is None:
+                    for name, (fn, args, kwargs, deps) in list(pending.items()):
+                        if all(dep in results for dep in deps):
+                            running[pool.submit(timed, name, fn, args, kwargs)] = name
+                            del pending[name]
+                elif not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        results[name] = future.result()
+                    except Exception as err:
+                        error = error or err
+
+        if error is not None:
+            raise error
+
+        return results
+
+
+class ResourceGraph(TaskGraph):
+    """
+    Task graph packed onto a resource budget (e.g. cores, memory in GB, inference sessions): a ready task starts
+    once the resources it declares are free, the tasks furthest down the pipeline first. Tasks that can use more
+    cores are given the free cores (up to their max) as a threads argument. A failing task only skips the tasks
+    depending on it.
+    """
+    def __init__(self, budget):
+        TaskGraph.__init__(self, max_workers=int(budget.get('cores', 1)))
+        self.budget = dict(budget)
+        self.needs = {}
+        self.errors = {}
+        self.grants = {}
+        self.busy = 0.
+
+    def add(self, name, fn, *args, deps=(), needs=None, max_cores=None, priority=0, **kwargs):
+        """
+        Add a task
+        :param needs: resources held while the task runs, e.g. {'cores': 1, 'mem_gb': 2.}
+        :param max_cores: the task takes a threads argument and can use up to this many cores
+        :param priority: tasks with a higher priority start first
+        """
+        needs = dict(needs) if needs else {}
+        needs.setdefault('cores', 1)
+        over = [res for res, amount in needs.items() if amount > self.budget.get(res, 0)]
+        if over:
+            raise ValueError("task %s needs more %s than the budget" % (name, ', '.join(over)))
+
+        TaskGraph.add(self, name, fn, *args, deps=deps, **kwargs)
+        self.needs[name] = (needs, max_cores, priority, len(self.needs))
+
+    def run(self):
+        """
+        Run every task
+        :return: dict of task name: result, failures in self.errors
+        """
+        results, running = {}, {}
+        pending = OrderedDict(self.tasks)
+        free = dict(self.budget)
+
+        def timed(name, fn, args, kwargs):
+            start = time.time()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                self.times[name] = time.time() - start
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                # tasks downstream of a failure are skipped
+                for name, (_, _, _, deps) in list(pending.items()):
+                    failed = [dep for dep in deps if dep in self.errors]
+                    if failed:
+                        self.errors[name] = RuntimeError("skipped, %s failed" % failed[0])
+                        del pending[name]
+
+                ready = [name for name, (_, _, _, deps) in pending.items() if all(dep in results for dep in deps)]
+                # free cores are shared evenly between the ready tasks that can use more than their minimum
+                elastic = sum(1 for name in ready if self.needs[name][1])
+                for name in sorted(ready, key=lambda name: (-self.needs[name][2], self.needs[name][3])):
+                    needs, max_cores, _, _ = self.needs[name]
+                    if any(free.get(res, 0) < amount for res, amount in needs.items()):
+                        continue
+
+                    grant = dict(needs)
+                    if max_cores:
+                        grant['cores'] = max(needs['cores'], min(max_cores, int(free['cores'] // elastic)))
+                        elastic -= 1
+                    for res, amount in grant.items():
+                        free[res] -= amount
+                    self.grants[name] = grant
+
+                    fn, args, kwargs, _ = pending.pop(name)
+                    if max_cores:
+                        kwargs = dict(kwargs, threads=grant['cores'])
+                    running[pool.submit(timed, name, fn, args, kwargs)] = name
+
+                if not running:
+                    break
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    for res, amount in self.grants[name].items():
+                        free[res] += amount
+                    self.busy += self.times.get(name, 0.) * self.grants[name]['cores']
+                    try:
+                        results[name] = future.result()
+                    except Exception as err:
+                        self.errors[name] = err
+
+        self.wall = time.time() - start
+
+        return results
+
+    def utilization(self):
+        """
+        Fraction of the core budget busy over the run
+        """
+        return self.busy / max(self.wall * self.budget.get('cores', 1), 1e-9)
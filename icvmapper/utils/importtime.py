@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import argparse
+import os
+import subprocess
+import sys
+
+# import time budgets (sec) of the cli for each subcommand, 'cli' is the bare cli (-v, -h, gui launcher, completion)
+BUDGETS = {
+    'cli': 0.5,
+    'filetype': 1.5,
+    'trim_like': 1.5,
+    'stats_icv': 2.5,
+    'bias_corr': 2.5,
+    'seg_qc': 2.5,
+    'reg_svg': 2.5,
+    'freeze_model': 1.5,
+    'quantize_model': 1.5,
+    'plan': 2.5,
+    'run_shards': 2.5,
+    'merge_shards': 2.5,
+    'seg_icv': 0.5,
+    'serve': 0.5,
+    'watch': 0.5,
+}
+
+
+def parsefn():
+    parser = argparse.ArgumentParser(usage="%(prog)s [ -s subcommand ] \n\n"
+                                           "Time the imports of the icvmapper cli for each subcommand and check "
+                                           "them against their budget")
+
+    optional = parser.add_argument_group('optional arguments')
+
+    optional.add_argument('-s', '--subcommands', type=str, metavar='', nargs='+', default=None,
+                          help="subcommands to time, 'cli' for the bare cli (default: all)")
+    optional.add_argument('-r', '--runs', type=int, metavar='', default=3,
+                          help="runs per subcommand, the fastest is kept (default: %(default)s)")
+    optional.add_argument('-k', '--top', type=int, metavar='', default=5,
+                          help="slowest top-level imports listed per subcommand (default: %(default)s)")
+    optional.add_argument('-f', '--factor', type=float, metavar='', default=1.,
+                          help="scale the budgets, e.g. for slower file systems (default: %(default)s)")
+
+    return parser
+
+
+def parse_importtime(stderr):
+    """
+    Top-level imports of a 'python -X importtime' run
+    :return: list of (module, cumulative sec), the slowest first
+    """
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, module = line[len('import time:'):].split('|')
+        # nested imports are indented under their parent
+        if not module[1:].startswith(' '):
+            imports.append((module.strip(), int(cumulative) / 1e6))
+
+    return sorted(imports, key=lambda item: -item[1])
+
+
+def time_subcommand(subcommand):
+    """
+    Import time of the cli when building the parser of a subcommand, in a fresh interpreter
+    :return: (total sec, top-level imports)
+    """
+    args = [] if subcommand == 'cli' else [subcommand]
+    code = "from icvmapper import cli; cli.get_parser(%r)" % args
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stderr=subprocess.PIPE,
+                            stdout=subprocess.DEVNULL, universal_newlines=True, env=env)
+    if result.returncode != 0:
+        raise RuntimeError("importing the %s parser failed:\n%s" % (subcommand, result.stderr.strip()))
+
+    imports = parse_importtime(result.stderr)
+
+    return sum(sec for _, sec in imports), imports
+
+
+def main(args):
+    parser = parsefn()
+    args = parser.parse_args(args)
+
+    subcommands = args.subcommands if args.subcommands else list(BUDGETS)
+    over = []
+
+    for subcommand in subcommands:
+        try:
+            runs = [time_subcommand(subcommand) for _ in range(max(1, args.runs))]
+        except RuntimeError as err:
+            print("\n %-15s failed: %s" % (subcommand, str(err).splitlines()[-1]))
+            over.append(subcommand)
+            continue
+        total, imports = min(runs, key=lambda run: run[0])
+        budget = BUDGETS.get(subcommand, BUDGETS['cli']) * args.factor
+
+        status = 'ok' if total <= budget else 'OVER BUDGET'
+        print("\n %-15s %6.2f s (budget %.2f s) %s" % (subcommand, total, budget, status))
+        for module, sec in imports[:args.top]:
+            print("     %-40s %6.2f s" % (module, sec))
+
+        if total > budget:
+            over.append(subcommand)
+
+    if over:
+        print("\n import time over budget or failed: %s" % ', '.join(over))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# coding: utf-8
+
+import os
+
+SMAPS_FIELDS = ('Rss', 'Pss', 'Shared_Clean', 'Shared_Dirty', 'Private_Clean', 'Private_Dirty')
+
+
+def _read_smaps(pid):
+    # smaps_rollup (linux >= 4.14) already sums the mappings, smaps lists them one by one
+    for name in ('smaps_rollup', 'smaps'):
+        smaps = '/proc/%s/%s' % (pid, name)
+        if os.path.exists(smaps):
+            totals = dict.fromkeys(SMAPS_FIELDS, 0)
+            with open(smaps, 'r') as smaps_file:
+                for line in smaps_file:
+                    fields = line.split()
+                    if len(fields) >= 2 and fields[0].rstrip(':') in totals:
+                        totals[fields[0].rstrip(':')] += int(fields[1])
+            return totals
+
+    return None
+
+
+def memory_usage(pid='self'):
+    """
+    Resident memory of a process split into the pages it shares with other processes (e.g. copy-on-write
+    pages of a forking parent) and its private pages
+    :param pid: process id
+    :return: dict of rss, pss (shared pages divided among their users), shared and private sizes in MB,
+             None where /proc is not available
+    """
+    totals = _read_smaps(pid)
+    if totals is None:
+        return None
+
+    return dict(rss=totals['Rss'] / 1024., pss=totals['Pss'] / 1024.,
+                shared=(totals['Shared_Clean'] + totals['Shared_Dirty']) / 1024.,
+                private=(totals['Private_Clean'] + totals['Private_Dirty']) / 1024.)
+
+
+def system_memory():
+    """
+    Total and available memory of the node, from /proc/meminfo
+    :return: dict of total and available sizes in MB, None where /proc is not available
+    """
+    if not os.path.exists('/proc/meminfo'):
+        return None
+
+    fields = {}
+    with open('/proc/meminfo', 'r') as meminfo:
+        for line in meminfo:
+            name, value = line.split(':', 1)
+            fields[name] = int(value.split()[0])
+
+    return dict(total=fields['MemTotal'] / 1024., available=fields.get('MemAvailable', fields['MemFree']) / 1024.)
@@ -0,0 +1,81 @@
+import multiprocessing
+import os
+
+import pytest
+
+from icvmapper.utils.cache import StageCache
+
+
+def write(path, text):
+    with open(path, 'w') as out_file:
+        out_file.write(text)
+
+
+def store_many(cache_dir, worker, work_dir):
+    cache = StageCache(cache_dir, max_size_gb=2e-6)
+    for i in range(20):
+        produced = os.path.join(work_dir, 'out-%s-%s.txt' % (worker, i))
+        write(produced, '%s' % i * 200)
+        # the same keys from every worker, with a budget of a few entries so they keep evicting each other
+        cache.store(StageCache.key('stage', step=i % 5), {'out.txt': produced})
+
+
+def test_fetch_store_refresh(tmp_path):
+    cache = StageCache(str(tmp_path / 'cache'))
+    produced, fetched = str(tmp_path / 'produced.txt'), str(tmp_path / 'fetched.txt')
+    write(produced, 'samples')
+    key = StageCache.key('predict', num_mc=20)
+
+    assert not cache.fetch(key, {'out.txt': fetched})
+    cache.store(key, {'out.txt': produced})
+    assert cache.fetch(key, {'out.txt': fetched})
+    assert open(fetched).read() == 'samples'
+
+    # forced reruns recompute the stage and replace the entry
+    refresh = StageCache(str(tmp_path / 'cache'), refresh=True)
+    assert not refresh.fetch(key, {'out.txt': fetched})
+    write(produced, 'new samples')
+    refresh.store(key, {'out.txt': produced})
+    assert cache.fetch(key, {'out.txt': fetched})
+    assert open(fetched).read() == 'new samples'
+
+
+def test_concurrent_processes_share_a_cache_dir(tmp_path):
+    cache_dir = str(tmp_path / 'cache')
+    StageCache(cache_dir)
+
+    workers = [multiprocessing.Process(target=store_many, args=(cache_dir, w, str(tmp_path))) for w in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    assert all(worker.exitcode == 0 for worker in workers)
+    entries = [name for name in os.listdir(cache_dir) if name != '.lock']
+    assert not [name for name in entries if '.tmp-' in name]
+    assert StageCache(cache_dir).size() <= 2e-6 * 1024 ** 3
+
+
+def test_bias_correction_skipped_on_cache_hit(tmp_path, monkeypatch):
+    icvmapper = pytest.importorskip('icvmapper.segment.icvmapper')
+
+    calls = []
+
+    def fake_n4(argv):
+        calls.append(argv)
+        write(argv[argv.index('-o') + 1], 'corrected')
+
+    monkeypatch.setattr(icvmapper.biascorr, 'main', fake_n4)
+    t1 = str(tmp_path / 't1.nii.gz')
+    write(t1, 'raw')
+    cache = StageCache(str(tmp_path / 'cache'))
+
+    for run in ('first', 'rerun'):
+        subj_dir = tmp_path / run
+        subj_dir.mkdir()
+        ctx = icvmapper.correct_subject(dict(subj_dir=str(subj_dir), subj='subj', t1=t1, bias=True, cache=cache,
+                                             n4_threads=1))
+        assert open(ctx['in_ort']).read() == 'corrected'
+
+    # the second subject dir gets the corrected t1 from the cache without running N4
+    assert len(calls) == 1
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('argcomplete')
+
+HEAVY = ('tensorflow', 'keras', 'nilearn', 'nipype', 'pandas')
+
+
+@pytest.mark.parametrize('args', [[], ['seg_icv'], ['seg_icv', '-s', 'subj', '-n', 'auto']])
+def test_seg_icv_parser_is_light(args):
+    # a fresh interpreter, modules imported by earlier tests would hide the ones the parser pulls in
+    code = "import sys; from icvmapper import cli; cli.get_parser(%r); " \
+           "print(' '.join(m for m in %r if m in sys.modules))" % (args, HEAVY)
+    out = subprocess.check_output([sys.executable, '-c', code], universal_newlines=True)
+
+    assert out.split() == []
+
+
+def test_every_subcommand_has_an_import_budget():
+    from icvmapper import cli
+    from icvmapper.utils.importtime import BUDGETS
+
+    assert set(cli.SUBCOMMANDS) == set(BUDGETS) - {'cli'}
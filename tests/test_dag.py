@@ -0,0 +1,146 @@
+import threading
+import time
+
+import pytest
+
+from icvmapper.utils.dag import ResourceGraph, TaskGraph
+
+
+class Recorder(object):
+    """
+    Stages logging when they start and end
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.events = []
+
+    def log(self, event):
+        with self.lock:
+            self.events.append(event)
+
+    def stage(self, name, duration=0.01, fail=False):
+        def run(*args, **kwargs):
+            self.log(('start', name))
+            time.sleep(duration)
+            if fail:
+                raise RuntimeError("%s failed" % name)
+            self.log(('end', name))
+            return name
+        return run
+
+    def index(self, event, name):
+        return self.events.index((event, name))
+
+    def started(self):
+        return set(name for event, name in self.events if event == 'start')
+
+
+def diamond(graph, rec, fail=()):
+    """
+    a -> (b, c) -> d, plus an independent e
+    """
+    graph.add('a', rec.stage('a', fail='a' in fail))
+    graph.add('b', rec.stage('b', fail='b' in fail), deps=['a'])
+    graph.add('c', rec.stage('c', fail='c' in fail), deps=['a'])
+    graph.add('d', rec.stage('d'), deps=['b', 'c'])
+    graph.add('e', rec.stage('e', duration=0.1))
+
+    return graph
+
+
+@pytest.mark.parametrize('make_graph', [lambda: TaskGraph(max_workers=3), lambda: ResourceGraph({'cores': 3})])
+def test_dependencies_run_first(make_graph):
+    rec = Recorder()
+    results = diamond(make_graph(), rec).run()
+
+    assert results == dict((name, name) for name in 'abcde')
+    for dep, name in (('a', 'b'), ('a', 'c'), ('b', 'd'), ('c', 'd')):
+        assert rec.index('end', dep) < rec.index('start', name)
+    # b and c only wait for a, and run side by side
+    assert max(rec.index('start', 'b'), rec.index('start', 'c')) < min(rec.index('end', 'b'), rec.index('end', 'c'))
+
+
+def test_unknown_dependency():
+    with pytest.raises(ValueError):
+        TaskGraph().add('b', lambda: None, deps=['a'])
+
+
+def test_task_graph_stops_after_failure():
+    rec = Recorder()
+    with pytest.raises(RuntimeError, match='b failed'):
+        diamond(TaskGraph(max_workers=3), rec, fail='b').run()
+
+    # the failure is raised once the running tasks are done, nothing depending on it starts
+    assert 'd' not in rec.started()
+    assert ('end', 'e') in rec.events
+
+
+def test_resource_graph_skips_dependents():
+    rec = Recorder()
+    graph = diamond(ResourceGraph({'cores': 3}), rec, fail='a')
+    results = graph.run()
+
+    # only the tasks downstream of the failure are skipped
+    assert results == {'e': 'e'}
+    assert rec.started() == {'a', 'e'}
+    assert str(graph.errors['a']) == 'a failed'
+    assert set(graph.errors) == {'a', 'b', 'c', 'd'}
+    assert 'skipped' in str(graph.errors['d'])
+
+
+def test_resource_graph_elastic_grants():
+    granted = {}
+
+    def stage(name):
+        def run(threads=None):
+            granted[name] = threads
+        return run
+
+    graph = ResourceGraph({'cores': 8, 'mem_gb': 4.})
+    graph.add('n4', stage('n4'), needs={'cores': 1, 'mem_gb': 1.}, max_cores=6)
+    graph.add('fixed', stage('fixed'), needs={'cores': 2})
+    graph.add('after', stage('after'), deps=['n4', 'fixed'], needs={'cores': 1}, max_cores=16)
+    graph.run()
+
+    # the elastic task takes the free cores up to its max, within the budget
+    assert granted['n4'] == 6 and granted['fixed'] is None
+    assert granted['after'] == 8
+    with pytest.raises(ValueError):
+        graph.add('big', stage('big'), needs={'mem_gb': 8.})
+
+
+def test_sequences_preprocess_in_parallel(monkeypatch, tmp_path):
+    icvmapper = pytest.importorskip('icvmapper.segment.icvmapper')
+
+    rec = Recorder()
+    mods = ['t1', 'fl', 't2']
+    # every sequence is prepared (bias corrected, oriented) at the same time
+    prepared = threading.Barrier(len(mods), timeout=10)
+
+    def prepare_sequence(ctx, mod, seq):
+        rec.log(('start', '%s_prepare' % mod))
+        prepared.wait()
+        return seq, mod
+
+    def crop_sequence(ctx, mod, in_seq, pred_dir, crop_file):
+        rec.stage('%s_crop' % mod)()
+
+    def standardize_sequence(ctx, seq_name, pred_dir, crop_file, res_file, cutoff_percents=5.0):
+        rec.stage('%s_resample' % seq_name)()
+
+    monkeypatch.setattr(icvmapper, 'prepare_sequence', prepare_sequence)
+    monkeypatch.setattr(icvmapper, 'crop_sequence', crop_sequence)
+    monkeypatch.setattr(icvmapper, 'standardize_sequence', standardize_sequence)
+
+    graph = TaskGraph(max_workers=len(mods))
+    for mod in mods:
+        icvmapper.add_sequence_tasks(graph, {}, mod, '%s.nii.gz' % mod, str(tmp_path), '%s_crop' % mod,
+                                     '%s_res' % mod)
+    graph.run()
+
+    assert len(graph.tasks) == 3 * len(mods)
+    for mod in mods:
+        assert rec.index('end', '%s_crop' % mod) < rec.index('start', '%s_resample' % mod)
+    # the other sequences are cropped like the t1, so only their crop waits for it
+    for mod in mods[1:]:
+        assert rec.index('end', 't1_crop') < rec.index('start', '%s_crop' % mod)
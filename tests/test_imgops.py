@@ -0,0 +1,159 @@
+import os
+import shutil
+import subprocess
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+from icvmapper.preprocess import imgops, resampling
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'pred_process_hfb')
+# c3d outputs of the pre-processing of the test subject
+C3D_CROPPED = os.path.join(DATA_DIR, 'C6-01-029_200124_T1_cropped_thresholded_standardized.nii.gz')
+C3D_RESAMPLED = os.path.join(DATA_DIR, 'C6-01-029_200124_T1_resampled.nii.gz')
+C3D_PRED = os.path.join(DATA_DIR, 'hfb_pred.nii.gz')
+
+requires_c3d = pytest.mark.skipif(shutil.which('c3d') is None, reason="c3d is not installed")
+
+
+def synthetic_img(shape=(20, 24, 18), background=-0.8):
+    """
+    Standardized-like image: a bright blob on a non-zero background reaching the image edges
+    """
+    rng = np.random.RandomState(0)
+    data = np.full(shape, background, dtype=np.float32)
+    data[4:-4, 5:-5, 3:-3] = 1. + rng.rand(shape[0] - 8, shape[1] - 10, shape[2] - 6)
+    affine = np.diag([-0.9, 1.1, 1.3, 1.])
+    affine[:3, 3] = [12., -8., 3.]
+
+    return nib.Nifti1Image(data, affine)
+
+
+def test_resample_geometry_matches_c3d():
+    cropped, resampled = nib.load(C3D_CROPPED), nib.load(C3D_RESAMPLED)
+
+    # the stored intensities are not finite, only the grid is compared
+    cropped = nib.Nifti1Image(np.zeros(cropped.shape, dtype=np.float32), cropped.affine)
+    out = imgops.resample_shape(cropped, resampled.shape, interp=1)
+
+    assert out.shape == resampled.shape
+    np.testing.assert_allclose(out.affine, resampled.affine, atol=1e-5)
+
+
+def test_orient_matches_c3d_orientation():
+    pred = nib.load(C3D_PRED)
+
+    # c3d pre-processing output is in the RPI standard orientation
+    same = imgops.orient(pred, 'RPI')
+    np.testing.assert_array_equal(np.asanyarray(same.dataobj), np.asanyarray(pred.dataobj))
+    np.testing.assert_allclose(same.affine, pred.affine)
+
+    flipped = imgops.orient(pred, 'LPI')
+    assert nib.aff2axcodes(flipped.affine) == imgops.c3d_to_axcodes('LPI')
+    back = imgops.orient(flipped, 'RPI')
+    np.testing.assert_array_equal(np.asanyarray(back.dataobj), np.asanyarray(pred.dataobj))
+    np.testing.assert_allclose(back.affine, pred.affine)
+
+
+def test_resample_clamps_edges_like_itk():
+    img = nib.Nifti1Image(np.full((10, 12, 8), 3., dtype=np.float32), np.eye(4))
+
+    # upsampling puts the outer samples between the last voxel centres and the image edge
+    up = np.asanyarray(imgops.resample_shape(img, (14, 17, 11), interp=1).dataobj)
+    np.testing.assert_allclose(up, 3.)
+
+    # samples more than half a voxel outside the image are zero
+    shifted = np.eye(4)
+    shifted[:3, 3] = -1.
+    ref = nib.Nifti1Image(np.zeros((10, 12, 8), dtype=np.float32), shifted)
+    out = np.asanyarray(imgops.reslice_like(img, ref, interp=1).dataobj)
+    assert np.all(out[0] == 0) and np.all(out[:, 0] == 0) and np.all(out[:, :, 0] == 0)
+    np.testing.assert_allclose(out[1:, 1:, 1:], 3.)
+
+
+def test_separable_tables_match_affine_transform():
+    # linear only: nearest neighbour ties round half up in the tables (like ITK) but not in scipy
+    interp = 1
+    img = synthetic_img()
+    out_shape = (27, 19, 24)
+    affine = imgops.resample_affine(img.affine, img.shape, out_shape)
+    matrix = np.linalg.inv(img.affine).dot(affine)
+
+    tables = resampling.resample_grid(np.asanyarray(img.dataobj), img.affine, out_shape, affine, interp,
+                                      edge='clamp')
+    general = imgops._transform(np.asanyarray(img.dataobj), matrix, out_shape, interp)
+
+    np.testing.assert_allclose(tables, general, atol=1e-5)
+
+
+@pytest.mark.parametrize('dtype', [np.float32, np.int16])
+def test_clip_standardize_matches_multipass(dtype):
+    rng = np.random.RandomState(1)
+    data = (rng.gamma(2., 150., (30, 26, 22))).astype(dtype)
+    img = nib.Nifti1Image(data, np.eye(4))
+
+    # percentile clip on a copy, then standardize in float64, as done before the fused pass
+    cutoff_low, cutoff_high = np.percentile(data, 5.), np.percentile(data, 95.)
+    clipped = data.copy()
+    clipped[clipped > cutoff_high] = cutoff_high
+    clipped[clipped < cutoff_low] = cutoff_low
+    clipped = clipped.astype(np.float64)
+    expected = (clipped - clipped.mean()) / clipped.std()
+
+    out = imgops.clip_standardize(img, 5.)
+    assert out.get_data_dtype() == np.float32
+    np.testing.assert_allclose(np.asanyarray(out.dataobj), expected, rtol=1e-5, atol=1e-5)
+
+
+def run_c3d(tmp_path, img, *args, ref_file=None):
+    """
+    c3d on an image, pushed after a reference image if given (c3d ref in ... -reslice-identity)
+    """
+    in_file, out_file = str(tmp_path / 'in.nii.gz'), str(tmp_path / 'out.nii.gz')
+    nib.save(img, in_file)
+    subprocess.check_call(['c3d'] + ([ref_file] if ref_file else []) + [in_file] + list(args) + ['-o', out_file])
+
+    return nib.load(out_file)
+
+
+def assert_same_img(out, c3d_out, atol=1e-4):
+    assert out.shape == c3d_out.shape
+    np.testing.assert_allclose(out.affine, c3d_out.affine, atol=1e-4)
+    np.testing.assert_allclose(np.asanyarray(out.dataobj), c3d_out.get_fdata(), atol=atol)
+
+
+@requires_c3d
+def test_trim_matches_c3d(tmp_path):
+    img = synthetic_img(background=0.)
+    assert_same_img(imgops.trim_img(img, voxels=1), run_c3d(tmp_path, img, '-trim', '1vox'))
+
+
+@requires_c3d
+@pytest.mark.parametrize('interp,c3d_interp', [(0, 'NearestNeighbor'), (1, 'Linear')])
+def test_resample_matches_c3d(tmp_path, interp, c3d_interp):
+    img = synthetic_img()
+    c3d_out = run_c3d(tmp_path, img, '-interpolation', c3d_interp, '-resample', '27x19x24')
+    assert_same_img(imgops.resample_shape(img, (27, 19, 24), interp=interp), c3d_out)
+
+
+@requires_c3d
+def test_reslice_matches_c3d(tmp_path):
+    img = synthetic_img()
+    ref_affine = img.affine.copy()
+    ref_affine[:3, 3] += [0.4, -0.7, 1.1]
+    ref = nib.Nifti1Image(np.zeros((22, 20, 17), dtype=np.float32), ref_affine)
+    ref_file = str(tmp_path / 'ref.nii.gz')
+    nib.save(ref, ref_file)
+
+    # like trim_like: the reference first, the image resliced into its grid second
+    c3d_out = run_c3d(tmp_path, img, '-interpolation', 'Linear', '-reslice-identity', ref_file=ref_file)
+    assert c3d_out.shape == ref.shape
+    assert_same_img(imgops.reslice_like(img, ref, interp=1), c3d_out)
+
+
+@requires_c3d
+@pytest.mark.parametrize('orient_tag', ['RPI', 'LPI', 'RAS', 'ASL'])
+def test_orient_matches_c3d(tmp_path, orient_tag):
+    img = synthetic_img()
+    assert_same_img(imgops.orient(img, orient_tag), run_c3d(tmp_path, img, '-orient', orient_tag))
@@ -0,0 +1,84 @@
+import numpy as np
+import pytest
+
+from icvmapper.deep.mc_shard import MCAccumulator, shard_sizes
+
+SHAPE = (6, 5, 4)
+
+
+def draw(seed, n):
+    """
+    MC Dropout-like samples: probabilities scattered around a fixed map
+    """
+    rng = np.random.RandomState(seed)
+    base = np.random.RandomState(0).rand(*SHAPE)
+
+    return np.clip(base + rng.normal(0, 0.2, (n,) + SHAPE), 0, 1).astype(np.float32)
+
+
+def sharded(num_mc, workers, seed, track_var=True):
+    """
+    Accumulate the samples of each worker apart (worker i seeded with seed + i) and merge them in worker order,
+    as run_mc_sharded does
+    :return: merged accumulator, all the samples
+    """
+    merged = MCAccumulator(SHAPE, track_var=track_var)
+    samples = []
+    for i, n in enumerate(shard_sizes(num_mc, workers)):
+        shard = draw(seed + i, n)
+        samples.append(shard)
+
+        acc = MCAccumulator(SHAPE, track_var=track_var)
+        acc.update_batch(shard)
+        merged.merge(acc.count, acc.mean, acc.m2)
+
+    return merged, np.concatenate(samples)
+
+
+@pytest.mark.parametrize('num_mc,workers', [(20, 1), (20, 3), (7, 4), (3, 8)])
+def test_merge_matches_numpy(num_mc, workers):
+    merged, samples = sharded(num_mc, workers, seed=5)
+
+    assert merged.count == num_mc == len(samples)
+    np.testing.assert_allclose(merged.mean, samples.astype(np.float64).mean(axis=0), rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(merged.variance(), samples.astype(np.float64).var(axis=0), rtol=1e-4, atol=1e-6)
+
+
+def test_merge_matches_single_accumulator():
+    merged, samples = sharded(30, 4, seed=1)
+    single = MCAccumulator(SHAPE, track_var=True)
+    single.update_batch(samples)
+
+    assert single.count == merged.count
+    np.testing.assert_allclose(merged.mean, single.mean, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(merged.variance(), single.variance(), rtol=1e-4, atol=1e-6)
+
+
+def test_merge_of_empty_shard():
+    acc = MCAccumulator(SHAPE, track_var=True)
+    acc.update_batch(draw(2, 4))
+    mean, m2 = acc.mean.copy(), acc.m2.copy()
+
+    acc.merge(0, np.zeros(SHAPE, dtype=np.float32), np.zeros(SHAPE, dtype=np.float32))
+    assert acc.count == 4
+    np.testing.assert_array_equal(acc.mean, mean)
+    np.testing.assert_array_equal(acc.m2, m2)
+
+
+def test_mean_only():
+    merged, samples = sharded(10, 3, seed=3, track_var=False)
+
+    np.testing.assert_allclose(merged.mean, samples.astype(np.float64).mean(axis=0), rtol=1e-5, atol=1e-6)
+    with pytest.raises(RuntimeError):
+        merged.variance()
+
+
+def test_seeded_shards_are_reproducible():
+    first, _ = sharded(20, 3, seed=11)
+    again, _ = sharded(20, 3, seed=11)
+    other, _ = sharded(20, 3, seed=12)
+
+    # the result only depends on (seed, workers)
+    np.testing.assert_array_equal(first.mean, again.mean)
+    np.testing.assert_array_equal(first.m2, again.m2)
+    assert not np.array_equal(first.mean, other.mean)
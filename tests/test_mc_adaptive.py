@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+
+predict = pytest.importorskip('icvmapper.deep.predict')
+
+SHAPE = (4, 5, 6)
+
+
+def stub_samples(monkeypatch, sample):
+    """
+    Replace the model with a function of the sample index, drawn in chunks like predict_mc_samples
+    """
+    drawn = []
+
+    def predict_mc_samples(test_data, model_json, model_weights, num_mc, mc_batch=1, **kwargs):
+        while len(drawn) < num_mc:
+            n = min(mc_batch, num_mc - len(drawn))
+            chunk = np.stack([sample(len(drawn) + i) for i in range(n)]).astype(np.float32)
+            drawn.extend(range(n))
+            yield chunk
+
+    monkeypatch.setattr(predict, 'predict_mc_samples', predict_mc_samples)
+    monkeypatch.setattr(predict, 'get_mc_models', lambda *args, **kwargs: (None, None, 0.))
+
+    return drawn
+
+
+def growing_mask(i):
+    # each sample covers more voxels, so the thresholded running mean keeps growing
+    sample = np.zeros(int(np.prod(SHAPE)), dtype=np.float32)
+    sample[:4 * (i + 1)] = 1.
+    return sample.reshape(SHAPE)
+
+
+def run(num_mc, mc_batch=1, mc_min=5, mc_max=20):
+    test_data = np.zeros((1, 1) + SHAPE, dtype=np.float32)
+    return predict.run_mc_dropout(test_data, 'model.json', 'model.h5', num_mc, mc_batch=mc_batch, mc_min=mc_min,
+                                  mc_max=mc_max, mc_tol=1e-3)
+
+
+@pytest.mark.parametrize('mc_batch', [1, 3])
+def test_adaptive_stops_after_two_stable_checks(monkeypatch, mc_batch):
+    rng = np.random.RandomState(0)
+    prob = rng.rand(*SHAPE).astype(np.float32)
+    stub_samples(monkeypatch, lambda i: prob)
+
+    mc_acc = run(None, mc_batch=mc_batch)
+
+    # the first check from mc_min sets the reference mask, the next two are stable
+    checks = [count for count in range(mc_batch, 21, mc_batch) if count >= 5]
+    assert mc_acc.count == checks[2]
+    np.testing.assert_allclose(mc_acc.mean, prob, atol=1e-6)
+
+
+def test_adaptive_runs_to_mc_max_while_the_mask_changes(monkeypatch):
+    drawn = stub_samples(monkeypatch, growing_mask)
+
+    mc_acc = run(None, mc_max=20)
+
+    assert mc_acc.count == len(drawn) == 20
+
+
+def test_fixed_num_mc_ignores_convergence(monkeypatch):
+    stub_samples(monkeypatch, lambda i: np.full(SHAPE, 0.9, dtype=np.float32))
+
+    assert run(12).count == 12
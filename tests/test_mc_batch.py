@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+pytest.importorskip('keras_contrib')
+
+from keras.layers import Conv3D, Dropout, Input
+from keras.models import Model
+
+from icvmapper.deep import predict
+
+NUM_MC = 200
+
+
+@pytest.fixture
+def toy_model(tmp_path):
+    """
+    Two 1x1x1 convolutions around an MC Dropout layer, saved as json and h5 weights like the icvmapper models
+    """
+    predict.configure_worker(seed=1)
+    inputs = Input(shape=(1, 6, 6, 6))
+    x = Conv3D(8, (1, 1, 1), activation='relu', data_format='channels_first')(inputs)
+    x = Dropout(0.5)(x, training=True)
+    outputs = Conv3D(1, (1, 1, 1), activation='sigmoid', data_format='channels_first')(x)
+    model = Model(inputs, outputs)
+
+    model_json = str(tmp_path / 'toy.json')
+    model_weights = str(tmp_path / 'toy.h5')
+    with open(model_json, 'w') as json_file:
+        json_file.write(model.to_json())
+    model.save_weights(model_weights)
+    predict.clear_model_cache()
+
+    return model_json, model_weights
+
+
+def mc_moments(test_data, model_json, model_weights, mc_batch, split):
+    predict.configure_worker(seed=1)
+    mc_acc = predict.run_mc_dropout(test_data, model_json, model_weights, NUM_MC, mc_batch=mc_batch,
+                                    track_var=True, split=split)
+
+    return mc_acc.count, mc_acc.mean, mc_acc.variance()
+
+
+@pytest.mark.parametrize('mc_batch,split', [(8, False), (8, True), (NUM_MC, True)])
+def test_batched_mc_matches_sequential(toy_model, mc_batch, split):
+    test_data = np.random.RandomState(0).rand(1, 1, 6, 6, 6).astype(np.float32)
+
+    count, mean_seq, var_seq = mc_moments(test_data, *toy_model, mc_batch=1, split=False)
+    count_batch, mean_batch, var_batch = mc_moments(test_data, *toy_model, mc_batch=mc_batch, split=split)
+
+    assert count == count_batch == NUM_MC
+    assert mean_batch.shape == mean_seq.shape == test_data.shape[2:]
+    # independent dropout masks: the two means differ by sampling noise only, within 5 standard errors
+    stderr = np.sqrt((var_seq + var_batch) / NUM_MC)
+    assert np.all(np.abs(mean_batch - mean_seq) <= 5 * stderr + 1e-5)
+    # every sample of a batch gets its own mask
+    assert var_batch.max() > 0
+
+
+def test_test_case_runs_alongside_mc_dropout(toy_model):
+    from concurrent.futures import ThreadPoolExecutor
+
+    test_data = np.random.RandomState(0).rand(1, 1, 6, 6, 6).astype(np.float32)
+    model_json, model_weights = toy_model
+
+    # the MC Dropout models are built before the worker thread predicts in the same graph
+    predict.build_mc_models(model_json, model_weights)
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        future = predict.submit_test_case(pool, test_data, model_json, model_weights, np.eye(4))
+        mc_acc = predict.run_mc_dropout(test_data, model_json, model_weights, NUM_MC, mc_batch=8)
+        img = future.result()
+
+    assert mc_acc.count == NUM_MC
+    assert img.shape == test_data.shape[2:]
+    assert np.all((img.get_fdata() >= 0) & (img.get_fdata() <= 1))
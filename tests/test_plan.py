@@ -0,0 +1,117 @@
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+pd = pytest.importorskip('pandas')
+plan = pytest.importorskip('icvmapper.segment.plan')
+merge_shards = pytest.importorskip('icvmapper.segment.merge_shards')
+
+
+def loads(costs, assigned, shards):
+    return [sum(cost for cost, shard in zip(costs, assigned) if shard == s) for s in range(shards)]
+
+
+def test_lpt_balance_on_known_costs():
+    # costliest first, each to the least loaded shard (the lowest index on ties)
+    costs = [4, 7, 1, 6, 2, 5, 3]
+    assigned = plan.balance_shards(costs, 3)
+    assert assigned == [2, 0, 0, 1, 0, 2, 1]
+    assert loads(costs, assigned, 3) == [10, 9, 9]
+
+    # the textbook case where LPT is 11/9 of the optimum
+    costs = [5, 5, 4, 4, 3, 3, 3]
+    assert sorted(loads(costs, plan.balance_shards(costs, 3), 3)) == [8, 8, 11]
+
+
+@pytest.mark.parametrize('subjects,shards', [(50, 7), (5, 5), (3, 1)])
+def test_every_subject_assigned_once(subjects, shards):
+    costs = list(np.random.RandomState(subjects).uniform(60, 400, subjects))
+    assigned = plan.balance_shards(costs, shards)
+
+    assert len(assigned) == subjects
+    assert set(assigned) == set(range(shards))
+    shard_loads = loads(costs, assigned, shards)
+    # LPT bound: no shard exceeds the mean load by more than the costliest subject
+    assert max(shard_loads) <= np.mean(shard_loads) + max(costs)
+
+
+def save_t1(path, shape):
+    nib.save(nib.Nifti1Image(np.zeros(shape, dtype=np.uint8), np.eye(4)), path)
+
+
+def test_plan_manifests_cover_the_cohort(tmp_path):
+    in_dir = tmp_path / 'cohort'
+    names = []
+    for s in range(6):
+        subj_dir = in_dir / ('subj%s' % s)
+        subj_dir.mkdir(parents=True)
+        save_t1(str(subj_dir / ('subj%s_T1_nu.nii.gz' % s)), (10 + s, 12, 8))
+        names.append(('subj%s' % s, None))
+    # a longitudinal subject, one dir per session
+    for session in ('subj6_v1', 'subj6_v2'):
+        (in_dir / 'subj6' / session).mkdir(parents=True)
+        save_t1(str(in_dir / 'subj6' / session / ('%s_T1_nu.nii.gz' % session)), (14, 12, 8))
+        names.append(('subj6', session))
+
+    out_dir = tmp_path / 'plan'
+    plan.main(['-i', str(in_dir), '-n', '3', '-o', str(out_dir)])
+
+    df = pd.read_csv(str(out_dir / plan.PLAN_CSV))
+    assert len(df) == len(names) and set(df['Shard']) == {0, 1, 2}
+
+    listed = []
+    for shard in range(3):
+        with open(str(out_dir / ('%s.txt' % plan.shard_name(shard)))) as manifest:
+            for line in manifest:
+                if not line.startswith('#'):
+                    fields = line.split()
+                    listed.append((os.path.basename(fields[0]), fields[1] if len(fields) > 1 else None))
+    assert sorted(listed, key=str) == sorted(names, key=str)
+
+
+def write_csv(path, text):
+    with open(str(path), 'w') as out_file:
+        out_file.write(text)
+
+
+def test_merge_shards(tmp_path):
+    plan_dir = tmp_path / 'plan'
+    (plan_dir / 'logs').mkdir(parents=True)
+    write_csv(plan_dir / plan.PLAN_CSV,
+              "Subject,Session,Subject_dir,T1_shape,Modalities,Est_cost,Shard\n"
+              "subj0,,/cohort/subj0,10x12x8,T1,100.0,0\n"
+              "subj1,,/cohort/subj1,10x12x8,T1,90.0,1\n"
+              "subj2,subj2_v1,/cohort/subj2,10x12x8,T1,80.0,1\n"
+              "subj3,,/cohort/subj3,10x12x8,T1,70.0,0\n")
+
+    logs = plan_dir / 'logs'
+    write_csv(logs / 'shard_000_summary.csv', "Subject,Session,Status,Runtime_sec\nsubj0,,done,95.5\n")
+    write_csv(logs / 'shard_001_summary.csv',
+              "Subject,Session,Status,Runtime_sec\nsubj1,,done,80.0\nsubj2,subj2_v1,failed,12.0\n")
+    write_csv(logs / 'shard_000_icv_volumes.csv', "Subjects,ICV_Volume\nsubj0,1450.5\n")
+    write_csv(logs / 'shard_001_icv_volumes.csv', "Subjects,ICV_Volume\nsubj1,1320.0\n")
+    write_csv(logs / 'shard_000_timing.csv', "0,0,1000,1100,node1\n")
+    write_csv(logs / 'shard_001_timing.csv', "1,1,1000,1150,node2\n")
+    write_csv(logs / 'shard_001.log', "shard 1 console\n")
+
+    merge_shards.main(['-p', str(plan_dir)])
+
+    summary = pd.read_csv(str(plan_dir / 'cohort_summary.csv')).set_index('Subject')
+    assert list(summary.index) == ['subj0', 'subj1', 'subj2', 'subj3']
+    assert list(summary['Status']) == ['done', 'done', 'failed', 'not run']
+    assert list(summary['Shard']) == [0, 1, 1, 0]
+    assert summary.loc['subj1', 'Runtime_sec'] == 80.0
+
+    volumes = pd.read_csv(str(plan_dir / 'cohort_icv_volumes.csv'), index_col='Subjects')
+    assert volumes['ICV_Volume'].to_dict() == {'subj0': 1450.5, 'subj1': 1320.0}
+
+    timings = pd.read_csv(str(plan_dir / 'shard_timings.csv'), index_col='Shard')
+    assert list(timings['Subjects']) == [2, 2]
+    assert list(timings['Failed']) == [0, 1]
+    assert list(timings['Wall_sec']) == [100, 150]
+    assert list(timings['Exit']) == [0, 1]
+
+    with open(str(plan_dir / 'cohort.log')) as log:
+        assert 'shard 1 console' in log.read()
@@ -0,0 +1,79 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from icvmapper.segment import postproc
+
+pytest.importorskip('nilearn')
+
+from nilearn.image import largest_connected_component_img, math_img, smooth_img
+
+
+def prob_img(shape=(64, 56, 40), isolated=False):
+    """
+    Native space probability map on anisotropic voxels: a brain-like ball cut by the volume edge, with a cavity,
+    a smaller blob (second component) and optionally isolated voxels just above the threshold, which stretch the
+    crop over the whole volume
+    """
+    rng = np.random.RandomState(2)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    centre = (26., 25., 32.)
+    dist = np.sqrt(sum(((g - c) / r) ** 2 for g, c, r in zip(grid, centre, (13., 12., 10.))))
+    prob = ndimage.gaussian_filter((dist < 1).astype(np.float32), 1.2)
+    prob[24:28, 23:27, 30:33] = 0.
+    prob[44:48, 30:34, 20:24] = 0.9
+    if isolated:
+        prob[tuple(rng.randint(0, n, 6) for n in shape)] = 0.55
+
+    affine = np.diag([0.9, 1.1, 1.4, 1.])
+    affine[:3, 3] = [-20., -22., -25.]
+
+    return nib.Nifti1Image(prob.astype(np.float32), affine)
+
+
+def nilearn_segment(img, thresh, fwhm):
+    """
+    Smoothing, thresholding and largest component with nilearn, then hole filling (c3d -holefill 1 0), as done
+    before the cropped post-processing
+    """
+    smoothed = smooth_img(img, fwhm=fwhm)
+    mask = math_img('img > %s' % thresh, img=smoothed)
+    comp = largest_connected_component_img(mask)
+
+    return ndimage.binary_fill_holes(comp.get_fdata() > 0).astype(np.uint8)
+
+
+@pytest.mark.parametrize('fwhm,thresh', [(3, 0.5), (2, 0.25)])
+@pytest.mark.parametrize('isolated', [False, True])
+def test_smooth_threshold_matches_smooth_img(fwhm, thresh, isolated):
+    img = prob_img(isolated=isolated)
+    prob = img.get_fdata(dtype=np.float32)
+    expected = math_img('img > %s' % thresh, img=smooth_img(img, fwhm=fwhm)).get_fdata() > 0
+
+    mask, slices = postproc.smooth_threshold(prob, img.affine, fwhm, thresh)
+    # the crop is clipped by the volume edge the ball runs into, and spans twice the kernel radius elsewhere
+    assert slices[2].stop == prob.shape[2]
+    if not isolated:
+        assert slices[0].start > 0 and slices[1].stop < prob.shape[1]
+    np.testing.assert_array_equal(postproc.paste(mask, slices, prob.shape, dtype=bool), expected)
+
+
+@pytest.mark.parametrize('thresh', [0.3, 0.5, 0.7])
+@pytest.mark.parametrize('isolated', [False, True])
+def test_segment_prob_matches_nilearn(thresh, isolated):
+    img = prob_img(isolated=isolated)
+    expected = nilearn_segment(img, thresh, fwhm=3)
+
+    out = postproc.segment_prob(img.get_fdata(dtype=np.float32), img.affine, thresh, fwhm=3)
+    assert out.dtype == np.uint8
+    # the cavity is filled and the smaller blob dropped
+    assert out[26, 25, 31] == 1 and out[46, 32, 22] == 0
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_segment_prob_empty():
+    img = prob_img()
+    img = nib.Nifti1Image(img.get_fdata(dtype=np.float32) * 0.4, img.affine)
+    out = postproc.segment_prob(img.get_fdata(dtype=np.float32), img.affine, 0.5, fwhm=3)
+    assert out.shape == img.shape and not out.any()
@@ -0,0 +1,49 @@
+import numpy as np
+import pytest
+
+quantize = pytest.importorskip('icvmapper.deep.quantize')
+
+
+class WeightsHolder(object):
+    """
+    Stands in for a keras model: load_quantized only reads its fp32 weights
+    """
+    def __init__(self, weights):
+        self.weights = weights
+
+    def get_weights(self):
+        return self.weights
+
+
+def model_weights(tmp_path):
+    rng = np.random.RandomState(0)
+    weights = [rng.randn(3, 3, 3, 4, 8).astype(np.float32), rng.randn(8).astype(np.float32)]
+
+    return WeightsHolder(weights), str(tmp_path / 'model_weights.h5')
+
+
+@pytest.mark.parametrize('precision', ['fp16', 'int8'])
+def test_load_quantized_round_trip(tmp_path, precision):
+    model, weights_file = model_weights(tmp_path)
+    save = quantize.quantize_weights(model.get_weights(), precision)
+    quantize.save_quantized(quantize.quantized_file(weights_file, precision), save, 1.0, 0.)
+
+    loaded = quantize.load_quantized(model, weights_file, precision)
+    for w, q in zip(model.get_weights(), loaded):
+        assert q.dtype == np.float32 and q.shape == w.shape
+        np.testing.assert_allclose(q, w, atol=np.abs(w).max() / 127.)
+
+
+def test_load_quantized_rejects_other_architecture(tmp_path):
+    model, weights_file = model_weights(tmp_path)
+    quantize.save_quantized(quantize.quantized_file(weights_file, 'int8'),
+                            quantize.quantize_weights(model.get_weights()[:1], 'int8'), 1.0, 0.)
+
+    with pytest.raises(ValueError, match='holds 1 weight arrays'):
+        quantize.load_quantized(model, weights_file, 'int8')
+
+    model.weights = model.weights[:1] + [np.zeros((4,), dtype=np.float32)]
+    quantize.save_quantized(quantize.quantized_file(weights_file, 'int8'),
+                            quantize.quantize_weights([model.weights[0], np.zeros(8, np.float32)], 'int8'), 1.0, 0.)
+    with pytest.raises(ValueError, match='does not match'):
+        quantize.load_quantized(model, weights_file, 'int8')
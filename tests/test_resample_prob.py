@@ -0,0 +1,58 @@
+import nibabel as nib
+import numpy as np
+import pytest
+from scipy import ndimage
+
+pytest.importorskip('nilearn')
+icvmapper = pytest.importorskip('icvmapper.segment.icvmapper')
+
+from nilearn.image import resample_to_img
+
+
+@pytest.fixture
+def prob_t1(tmp_path):
+    """
+    Saturated probability map of a ball on the coarse network grid, and a finer, shifted native t1 grid
+    """
+    shape = (24, 28, 22)
+    grid = np.ogrid[tuple(slice(0, n) for n in shape)]
+    dist = np.sqrt(sum(((g - n / 2.) / (0.35 * n)) ** 2 for g, n in zip(grid, shape)))
+    prob = ndimage.gaussian_filter((dist < 1).astype(np.float32), 1.)
+    prob_affine = np.diag([1.6, 1.5, 1.7, 1.])
+    prob_affine[:3, 3] = [-18., -20., -17.]
+    prob_img = nib.Nifti1Image(prob, prob_affine)
+
+    t1_affine = np.diag([0.9, 1.1, 1.2, 1.])
+    t1_affine[:3, 3] = [-17.3, -19.6, -16.1]
+    t1_img = nib.Nifti1Image(np.zeros((40, 36, 30), dtype=np.float32), t1_affine)
+
+    prob_file = str(tmp_path / 'prob.nii.gz')
+    nib.save(prob_img, prob_file)
+
+    return prob_img, prob_file, t1_img
+
+
+def resampled(img):
+    return img.get_fdata(dtype=np.float32)
+
+
+@pytest.mark.parametrize('resample_mode,atol', [('full', 1e-5), ('band', 0.01)])
+def test_linear_matches_resample_to_img(prob_t1, resample_mode, atol):
+    prob_img, prob_file, t1_img = prob_t1
+    expected = resampled(resample_to_img(prob_img, t1_img, interpolation="linear"))
+
+    for prob in (prob_img, prob_file):
+        out = icvmapper.resample_prob(prob, t1_img, resample_mode)
+        np.testing.assert_allclose(out.affine, t1_img.affine)
+        # band mode fills the saturated voxels from the coarse labels, within eps of the interpolated values
+        np.testing.assert_allclose(resampled(out), expected, atol=atol)
+
+
+@pytest.mark.parametrize('resample_mode', ['full', 'band'])
+def test_cubic_is_not_replaced_by_linear(prob_t1, resample_mode):
+    prob_img, prob_file, t1_img = prob_t1
+    expected = resampled(resample_to_img(prob_img, t1_img, interpolation="continuous"))
+
+    out = icvmapper.resample_prob(prob_file, t1_img, resample_mode, interpolation="continuous")
+    np.testing.assert_allclose(resampled(out), expected, atol=1e-5)
+    assert np.abs(expected - resampled(resample_to_img(prob_img, t1_img, interpolation="linear"))).max() > 1e-3
@@ -0,0 +1,52 @@
+import argparse
+import threading
+
+import pytest
+
+pytest.importorskip('icvmapper.deep.predict')
+cohort = pytest.importorskip('icvmapper.segment.cohort')
+
+CORES = 8
+
+
+def scheduled_threads(tmp_path, bias, seqs):
+    """
+    Run two subjects through the cohort scheduler with stages recording the threads they are granted
+    """
+    for subj in ('subj1', 'subj2'):
+        (tmp_path / subj).mkdir()
+    args = argparse.Namespace(subjects=str(tmp_path / 'subj*'), cores=CORES, mem_gb=32., inference_threads=2,
+                              inference_mem=1., batch_summary=str(tmp_path / 'summary.csv'))
+
+    lock = threading.Lock()
+    granted = {}
+
+    def stage(name):
+        def run(ctx, threads=None):
+            with lock:
+                granted.setdefault(name, []).append(threads)
+            return ctx
+        return run
+
+    def setup(subj_args):
+        return dict(subj_dir=subj_args.subj, bias=bias, test_seqs=['t1', 'fl', 't2'][:seqs], mod_workers=3,
+                    pred_shape=[160, 160, 160])
+
+    cohort.run_scheduled(args, setup, dict((name, stage(name)) for name in cohort.STAGE_NEEDS))
+
+    return granted
+
+
+def test_preprocess_gets_its_own_threads_with_bias(tmp_path):
+    granted = scheduled_threads(tmp_path, bias=True, seqs=3)
+
+    # at least one core per sequence pre-processed concurrently, never more than the budget
+    assert all(3 <= threads <= CORES for threads in granted['preprocess'])
+    assert all(1 <= threads <= CORES for threads in granted['bias'])
+
+
+@pytest.mark.parametrize('bias,seqs', [(False, 3), (True, 1)])
+def test_preprocess_without_n4_is_not_elastic(tmp_path, bias, seqs):
+    granted = scheduled_threads(tmp_path, bias=bias, seqs=seqs)
+
+    assert granted['preprocess'] == [None, None]
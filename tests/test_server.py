@@ -0,0 +1,85 @@
+import threading
+import time
+
+import pytest
+
+server = pytest.importorskip('icvmapper.segment.server')
+
+
+@pytest.fixture
+def node_mem(monkeypatch):
+    """
+    Fake node memory, in MB available
+    """
+    mem = {'available': 64 * 1024.}
+    monkeypatch.setattr(server, 'system_memory', lambda: dict(mem))
+
+    return mem
+
+
+def wait_for(cond, timeout=5.):
+    start = time.time()
+    while not cond():
+        assert time.time() - start < timeout, "timed out"
+        time.sleep(0.01)
+
+
+def test_fits(node_mem):
+    budget = server.MemoryBudget(10.)
+    assert budget.fits(10.) and not budget.fits(10.5)
+
+    # the first job is admitted whatever the node has left, the next ones need the memory to be available
+    node_mem['available'] = 1024.
+    assert budget.fits(4.)
+    budget.acquire(4.)
+    assert not budget.fits(4.) and budget.fits(1.)
+
+    budget.release(4.)
+    assert budget.reserved == 0 and budget.running == 0
+
+
+def test_acquire_waits_for_release(node_mem):
+    budget = server.MemoryBudget(10.)
+    budget.acquire(6.)
+
+    events, locked = [], []
+
+    def probe():
+        free = budget.cond.acquire(blocking=False)
+        if free:
+            budget.cond.release()
+        locked.append(not free)
+
+    def on_wait(ahead):
+        # called without the budget lock held, checked from another thread since the lock is reentrant
+        thread = threading.Thread(target=probe)
+        thread.start()
+        thread.join()
+        events.append(('queued', ahead))
+
+    def job():
+        budget.acquire(6., on_wait=on_wait)
+        events.append(('admitted', budget.reserved))
+
+    waiter = threading.Thread(target=job, daemon=True)
+    waiter.start()
+    wait_for(lambda: events)
+    assert events == [('queued', 0)] and locked == [False]
+    assert budget.waiting == 1 and budget.running == 1
+
+    budget.release(6.)
+    waiter.join(timeout=5)
+    assert events[-1] == ('admitted', 6.)
+    assert budget.waiting == 0 and budget.running == 1
+
+
+def test_on_wait_failure_leaves_no_waiter(node_mem):
+    budget = server.MemoryBudget(10.)
+    budget.acquire(8.)
+
+    def on_wait(ahead):
+        raise BrokenPipeError("client went away")
+
+    with pytest.raises(BrokenPipeError):
+        budget.acquire(8., on_wait=on_wait)
+    assert budget.waiting == 0 and budget.reserved == 8.
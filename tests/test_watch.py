@@ -0,0 +1,76 @@
+import json
+import os
+
+import pytest
+
+watch = pytest.importorskip('icvmapper.segment.watch')
+
+
+class RecordingWatcher(watch.Watcher):
+    """
+    Watcher recording the scans it would segment instead of segmenting them
+    """
+    def ingest(self, path, digest):
+        with self.state_lock:
+            subj_dir = self.subject_dir(path, digest)
+            self.state[digest].update(subj_dir=subj_dir, status='done')
+        self.ingested.append((os.path.basename(path), subj_dir))
+
+
+def run_once(in_dir, out_dir, **kwargs):
+    watcher = RecordingWatcher(str(in_dir), str(out_dir), stable=0., **kwargs)
+    watcher.ingested = []
+    # the first poll records the files, the second submits them
+    watcher.poll()
+    watcher.poll()
+    watcher.wait()
+
+    return sorted(watcher.ingested), watcher.state
+
+
+@pytest.fixture
+def earlier_run(tmp_path):
+    """
+    Incoming dir with one scan per status left by an earlier watcher
+    """
+    in_dir, out_dir = tmp_path / 'incoming', tmp_path / 'subjects'
+    in_dir.mkdir()
+    out_dir.mkdir()
+
+    state = {}
+    for status in ('done', 'queued', 'running', 'failed'):
+        scan = in_dir / ('%s.nii.gz' % status)
+        scan.write_bytes(status.encode())
+        state[watch.content_hash(str(scan))] = dict(scan=scan.name, status=status,
+                                                    subj_dir=str(out_dir / status))
+    (out_dir / '.watch_state.json').write_text(json.dumps(state))
+
+    return in_dir, out_dir
+
+
+def test_restart_requeues_interrupted_scans(earlier_run):
+    in_dir, out_dir = earlier_run
+    ingested, state = run_once(in_dir, out_dir)
+
+    # interrupted scans go back to their own subject dirs
+    assert ingested == [('queued.nii.gz', str(out_dir / 'queued')), ('running.nii.gz', str(out_dir / 'running'))]
+    assert sorted(entry['status'] for entry in state.values()) == ['done', 'done', 'done', 'failed']
+
+
+def test_retry_failed(earlier_run):
+    in_dir, out_dir = earlier_run
+    ingested, _ = run_once(in_dir, out_dir, retry_failed=True)
+
+    assert [scan for scan, _ in ingested] == ['failed.nii.gz', 'queued.nii.gz', 'running.nii.gz']
+
+
+def test_same_content_is_segmented_once(tmp_path):
+    in_dir, out_dir = tmp_path / 'incoming', tmp_path / 'subjects'
+    in_dir.mkdir()
+    for name in ('a.nii.gz', 'b.nii'):
+        (in_dir / name).write_bytes(b'same scan')
+
+    ingested, state = run_once(in_dir, out_dir)
+
+    assert [scan for scan, _ in ingested] == ['a.nii.gz']
+    assert len(state) == 1